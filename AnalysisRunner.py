@@ -0,0 +1,317 @@
+'''
+Parallel analysis of whole sessions (or many sessions at once) of stored sweeps.
+
+An analysis is a kernel: statistics per bin (StatsKernel in BinStatistics.py), channel occupancy
+(OccupancyKernel in OccupancyAnalysis.py) or signal detections (DetectionKernel in HopTracker.py). The
+runner cuts the work up two ways:
+    ~time      - runs of whole sweeps (DBManager.partitionSession). About nParts pieces in total, shared
+                 out between the sessions by size.
+    ~frequency - freqSpans spans of bins per sweep, for kernels which can work on part of a sweep. Gives
+                 more jobs for a short session on a wide grid.
+Every (piece, span) is one job for a process pool. A job opens the database read only, reads its sweeps
+a chunk at a time (from the sweep store, only its span's columns), runs all of the kernels on each chunk
+and sends back their partial results, which are sized by bins or channels, never sweeps x bins. Reading
+is the slow part, so the kernels share one pass over the data. The partials are merged in time order as
+the jobs finish, then the spans are joined in frequency order.
+
+A kernel has:
+    name                                   - key of its result
+    splitFrequency                         - False if it needs whole sweeps (no frequency spans are made)
+    update(partial, seconds, freqs, power) - fold a chunk into partial (None to begin with) and return it
+    mergeTime(first, second)               - partials of back to back pieces
+    joinFrequency(parts)                   - partials of neighbouring spans, in frequency order
+    alignCut(freqs, cut)                   - move a span boundary (a bin index) to where the kernel can cut
+    result(partial)                        - what the caller gets
+Kernels are pickled to the workers, so keep them small. seconds is when each sweep of the chunk started,
+then when its last one ended (len(power) + 1 values). Sweep times are worked out once per session in
+planJobs, so they don't depend on how the session was split up.
+
+Only a session's main grid (the one with the most sweeps) is analyzed.
+
+    plan = ChannelPlan()
+    results = runAnalysis([sessionA, sessionB], [StatsKernel(aboveBaseline=10), OccupancyKernel(plan, aboveBaseline=10)])
+    results[sessionA]['occupancy'].summary(plan)
+
+    python AnalysisRunner.py <sessionID> ... --kernels stats occupancy --workers 8
+    python AnalysisRunner.py --benchmark    #Throughput against the number of workers
+'''
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+#pytables and DBManager are imported by the functions which read the database, so the kernel modules
+#(ex. HopTracker, which the live scan uses) can subclass AnalysisKernel without loading them
+
+class AnalysisKernel():
+    '''
+    Base for analysis kernels. threshold is one absolute dB level for every bin. Without it, the baseline
+    plus aboveBaseline is used if aboveBaseline is given, otherwise there is no threshold.
+    '''
+    name = 'kernel'
+    splitFrequency = True
+
+    def __init__(self, threshold=None, aboveBaseline=None):
+        self.threshold = threshold
+        self.aboveBaseline = aboveBaseline
+        self.DB_Name = None
+        self._thresholds = {}
+
+    def begin(self, DB_Name):
+        '''Called in the worker before the first chunk of a job'''
+        self.DB_Name = DB_Name
+
+    def binThreshold(self, freqs):
+        '''Threshold of every bin of freqs, or None. Worked out once per grid.'''
+        key = (freqs[0], freqs[-1], len(freqs))
+        if key not in self._thresholds:
+            if self.threshold is not None:
+                self._thresholds[key] = np.full(len(freqs), self.threshold, dtype=np.float64)
+            elif self.aboveBaseline is not None:
+                from BinStatistics import baselineThreshold
+                self._thresholds[key] = baselineThreshold(freqs, self.aboveBaseline, self.DB_Name)
+            else:
+                self._thresholds[key] = None
+        return self._thresholds[key]
+
+    def update(self, partial, seconds, freqs, power):
+        raise NotImplementedError
+
+    def mergeTime(self, first, second):
+        raise NotImplementedError
+
+    def joinFrequency(self, parts):
+        if len(parts) == 1:
+            return parts[0]
+        raise NotImplementedError
+
+    def alignCut(self, freqs, cut):
+        return cut
+
+    def result(self, partial):
+        return partial
+
+
+def _spanColumns(freqs, span, nSpans, kernels):
+    '''(first, last) bins of a span. Both neighbours of a cut work it out the same way, so spans never overlap.'''
+    cuts = []
+    for edge in (span, span + 1):
+        cut = int(round(len(freqs)*edge/nSpans))
+        if 0 < cut < len(freqs):
+            for kernel in kernels:
+                cut = kernel.alignCut(freqs, cut)
+        cuts.append(min(cut, len(freqs)))
+    return cuts[0], cuts[1]
+
+def _analysisWorker(sessionID, DB_Name, piece, seconds, gridID, span, nSpans, kernels, chunkRows):
+    '''
+    Process pool job. Runs every kernel over one piece of a session on one span, returns their partials.
+    seconds is the piece's sweep times and gridID the session's main grid, from planJobs.
+    '''
+    from DBManager import iterSessionSweeps
+    from FrequencyGrid import gridFor
+    for kernel in kernels:
+        kernel.begin(DB_Name)
+    columns = None
+    if nSpans > 1:
+        columns = lambda freqs: _spanColumns(freqs, span, nSpans, kernels)
+    #The row table is read whole anyway, so its span is cut here, where no chunk can be left out of the count
+    stored = len(piece[0]) == 3
+    partials = [None]*len(kernels)
+    done = 0
+    for times, freqs, power in iterSessionSweeps(sessionID, DB_Name, chunkRows, rowRanges=piece, columns=columns if stored else None):
+        chunkSeconds = seconds[done:done + len(power) + 1]
+        done += len(power)
+        if not stored:
+            #Stored pieces only hold the main grid's sweeps (partitionSession), the row table can have any.
+            #Grids with the same number of bins can still be different bands, so go by the grid id.
+            if gridFor(freqs)[0].id != gridID:
+                continue
+            if columns is not None:
+                first, last = columns(freqs)
+                if first >= last:
+                    continue
+                freqs, power = freqs[first:last], power[:, first:last]
+        partials = [kernel.update(partial, chunkSeconds, freqs, power) for kernel, partial in zip(kernels, partials)]
+    return partials
+
+def mainGrid(sweepRanges):
+    '''(gridID, sweeps) of the grid a session has the most sweeps on, from its (gridID, start, stop) sweep ranges'''
+    counts = {}
+    for gridID, start, stop in sweepRanges:
+        counts[gridID] = counts.get(gridID, 0) + stop - start
+    gridID = max(counts, key=counts.get)
+    return gridID, counts[gridID]
+
+def _pieceSeconds(pieces, h5file):
+    '''
+    Sweep times of each of a session's pieces, and the session's main grid. A piece's times are when each
+    sweep started, then when its last sweep ended. The stamps of the whole session are converted in one
+    go, so sweeps sharing a stamp are spread over their second the same way whatever the pieces are, and
+    every piece ends where the next one starts. Only the session's very last sweep is given a duration,
+    the median one.
+    '''
+    from DBManager import pieceSweeps, timeStampsToSeconds
+    stamps, grids = zip(*[pieceSweeps(piece, h5file) for piece in pieces]) if pieces else ((), ())
+    seconds = timeStampsToSeconds(np.concatenate(stamps)) if pieces else np.zeros(0)
+    if len(seconds) == 0:
+        return [seconds for piece in pieces], None
+    gridIDs, counts = np.unique(np.concatenate(grids), return_counts=True)
+    gridID = mainGrid([(int(grid), 0, int(count)) for grid, count in zip(gridIDs, counts)])[0]
+    lastDuration = np.median(np.diff(seconds)) if len(seconds) > 1 else 1.0
+    seconds = np.append(seconds, seconds[-1] + lastDuration)
+    edges = np.cumsum([0] + [len(s) for s in stamps])
+    return [seconds[first:last + 1] for first, last in zip(edges[:-1], edges[1:])], gridID
+
+def planJobs(sessionIDs, nParts, DB_Name="EARS_DB.h5"):
+    '''
+    Time pieces of each session: {sessionID: [(piece, seconds, gridID), ...]} in time order, where seconds
+    is what the piece's kernels get as sweep times and gridID is the session's main grid. nParts pieces in
+    total, shared out by the number of readings in each session. Stored sessions are cut on their main grid
+    only, and only sweeps on it are analyzed in row table sessions.
+    '''
+    from tables import open_file
+    from DBManager import partitionSession, getSessionSweepRanges, getSessionRowRanges
+    from FrequencyGrid import loadGrid
+    sizes, grids = {}, {}
+    with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+        for sessionID in sessionIDs:
+            sweepRanges = getSessionSweepRanges(sessionID, DB_Name, h5file)
+            if sweepRanges:
+                grids[sessionID], nSweeps = mainGrid(sweepRanges)
+                sizes[sessionID] = nSweeps*loadGrid(h5file, grids[sessionID]).count
+            else:
+                grids[sessionID] = None
+                sizes[sessionID] = sum(stop - start for start, stop in getSessionRowRanges(sessionID, DB_Name, h5file=h5file))
+    total = max(sum(sizes.values()), 1)
+    pieces = {}
+    for sessionID in sessionIDs:
+        if sizes[sessionID] == 0:
+            pieces[sessionID] = []
+            continue
+        nPieces = max(1, int(round(nParts*sizes[sessionID]/total)))
+        pieces[sessionID] = partitionSession(sessionID, nPieces, DB_Name, grids[sessionID])
+    with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+        for sessionID in sessionIDs:
+            seconds, gridID = _pieceSeconds(pieces[sessionID], h5file)
+            pieces[sessionID] = [(piece, pieceSeconds, gridID) for piece, pieceSeconds in zip(pieces[sessionID], seconds)]
+    return pieces
+
+def runAnalysis(sessionIDs, kernels, DB_Name="EARS_DB.h5", workers=None, nParts=None, freqSpans=1, chunkRows=500_000):
+    '''
+    Run kernels over each of sessionIDs in a process pool. Returns {sessionID: {kernel.name: result}},
+    with None for a kernel that didn't see any sweeps.
+    nParts is the total number of time pieces (default 4 per worker, which evens out the load).
+    freqSpans cuts every sweep into that many spans of bins, if all of the kernels allow it.
+    workers=1 runs everything in this process, which is handy for debugging.
+    '''
+    if isinstance(sessionIDs, (str, bytes)):
+        sessionIDs = [sessionIDs]
+    workers = workers or os.cpu_count()
+    nParts = nParts or 4*workers
+    if not all(kernel.splitFrequency for kernel in kernels):
+        freqSpans = 1
+    pieces = planJobs(sessionIDs, nParts, DB_Name)
+    jobs = [(sessionID, span, job) for sessionID in sessionIDs for span in range(freqSpans) for job in pieces[sessionID]]
+    #Partials for each (session, span), merged in time order as the jobs come back
+    merged = {}
+    def fold(sessionID, span, partials):
+        current = merged.setdefault((sessionID, span), [None]*len(kernels))
+        for i, (kernel, partial) in enumerate(zip(kernels, partials)):
+            if partial is not None:
+                current[i] = partial if current[i] is None else kernel.mergeTime(current[i], partial)
+    if workers == 1:
+        for sessionID, span, (piece, seconds, gridID) in jobs:
+            fold(sessionID, span, _analysisWorker(sessionID, DB_Name, piece, seconds, gridID, span, freqSpans, kernels, chunkRows))
+    else:
+        #Spawned, not forked: planJobs has had the database open, and pytables can deadlock in a forked child
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            futures = [pool.submit(_analysisWorker, sessionID, DB_Name, piece, seconds, gridID, span, freqSpans, kernels, chunkRows)
+                       for sessionID, span, (piece, seconds, gridID) in jobs]
+            for (sessionID, span, job), future in zip(jobs, futures):
+                fold(sessionID, span, future.result())
+    results = {}
+    for sessionID in sessionIDs:
+        results[sessionID] = {}
+        for i, kernel in enumerate(kernels):
+            parts = [merged[(sessionID, span)][i] for span in range(freqSpans) if (sessionID, span) in merged]
+            parts = [part for part in parts if part is not None]
+            results[sessionID][kernel.name] = kernel.result(kernel.joinFrequency(parts)) if parts else None
+    return results
+
+
+def benchmark(nSweeps=1000, freqRange='30M:400M', kernelNames=('stats', 'occupancy')):
+    '''
+    Sweeps per second of runAnalysis on a database of simulated sweeps, for 1 worker up to one per core.
+    Should go up close to linearly until the disk can't keep up.
+    '''
+    import tempfile
+    import time
+    from tables import open_file
+    from DBManager import appendSweeps
+    from SDRSimulator import SimulatedSDR
+    from ScanPlan import compilePlan
+    plan = compilePlan(freqRange)
+    sdr = SimulatedSDR(plan, [(100_000_000, 40, 200_000), (300_000_000, 25, 0)], seed=0)
+    fileName = os.path.join(tempfile.mkdtemp(), 'bench.h5')
+    with open_file(fileName, mode='w') as h5file:
+        for i in range(0, nSweeps, 100):
+            n = min(100, nSweeps - i)
+            appendSweeps(h5file, 'bench', plan.grid, np.array(['2024:01:01:00:00:{:02d}'.format(i//100)]*n, dtype='S20'), sdr.sweeps(n))
+    kernels = makeKernels(kernelNames, threshold=-40)
+    mb = nSweeps*plan.nBins*4/1e6
+    print('{} sweeps of {} bins ({:.0f} MB), kernels {}'.format(nSweeps, plan.nBins, mb, ', '.join(kernelNames)))
+    print('{:>8s} {:>10s} {:>10s} {:>8s}'.format('workers', 'sweeps/s', 'MB/s', 'speedup'))
+    workers, first = 1, None
+    while True:
+        start = time.perf_counter()
+        runAnalysis(['bench'], kernels, fileName, workers=workers)
+        rate = nSweeps/(time.perf_counter() - start)
+        first = first or rate
+        print('{:8d} {:10.0f} {:10.1f} {:8.2f}'.format(workers, rate, rate*plan.nBins*4/1e6, rate/first))
+        if workers >= os.cpu_count():
+            break
+        workers = min(2*workers, os.cpu_count())
+    os.remove(fileName)
+
+def makeKernels(names, threshold=None, aboveBaseline=None):
+    '''Kernels by name, with their default settings'''
+    from BinStatistics import StatsKernel
+    from OccupancyAnalysis import OccupancyKernel, ChannelPlan
+    from HopTracker import DetectionKernel
+    makers = {'stats': lambda: StatsKernel(threshold, aboveBaseline),
+              'occupancy': lambda: OccupancyKernel(ChannelPlan(), threshold, aboveBaseline),
+              'detections': lambda: DetectionKernel(threshold, aboveBaseline)}
+    return [makers[name]() for name in names]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Analyze stored sessions in parallel')
+    parser.add_argument('sessions', nargs='*', help='Session IDs')
+    parser.add_argument('--db', default='EARS_DB.h5')
+    parser.add_argument('--kernels', nargs='+', default=['stats', 'occupancy'], choices=['stats', 'occupancy', 'detections'])
+    parser.add_argument('--workers', type=int, default=None, help='Processes (default one per core)')
+    parser.add_argument('--parts', type=int, default=None, help='Time pieces in total (default 4 per worker)')
+    parser.add_argument('--spans', type=int, default=1, help='Frequency spans per sweep')
+    parser.add_argument('--threshold', type=float, default=None, help='Absolute threshold (dB)')
+    parser.add_argument('--above-baseline', type=float, default=10, help='Threshold over the baseline (dB) if no absolute one')
+    parser.add_argument('--benchmark', action='store_true', help='Measure throughput against workers on simulated data')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(kernelNames=args.kernels)
+    else:
+        kernels = makeKernels(args.kernels, args.threshold, None if args.threshold is not None else args.above_baseline)
+        results = runAnalysis([s.encode() for s in args.sessions], kernels, args.db, args.workers, args.parts, args.spans)
+        for sessionID, result in results.items():
+            print('Session {}'.format(sessionID.decode()))
+            for kernel in kernels:
+                value = result[kernel.name]
+                if value is None:
+                    print('{}: no sweeps'.format(kernel.name))
+                elif kernel.name == 'occupancy':
+                    print(value.summary(kernel.plan, minOccupancy=1))
+                elif hasattr(value, 'summary'):
+                    print(value.summary())
+                else:
+                    print(value)
@@ -0,0 +1,169 @@
+'''
+Versioned baseline store.
+
+The old /baseline group only ever held one baseline, and nothing said where or when it was taken. Our
+units move between sites and the background changes over the day, so now every calibration is kept as
+its own version under /baselines in the EARS database, tagged with:
+
+    ~location  - a site tag. Defaults to the EARS_LOCATION environment variable, or 'default'.
+    ~todBucket - time of day bucket the calibration was taken in (6 buckets of 4 hours by default)
+    ~gain      - SDR gain setting the calibration was taken with
+
+Each version stores compact frequency/power/spread arrays (compressed CArrays) in /baselines/v<N>, with
+the id of its frequency grid as the gridID attribute, and one row in the /baselines/index table. Selection only reads the index, picks the best version for each
+part of the requested range, then reads just those arrays, so it's quick enough to do at every scan start.
+
+Best match, in order of importance: same location, same gain, nearest time of day bucket, newest.
+A version only has to cover part of the requested range; the rest is filled in by the next best
+versions, so per band calibrations combine into one baseline.
+
+Only the newest `keep` versions for each (location, bucket, gain, range) are kept.
+'''
+
+import os
+import datetime
+import numpy as np
+from tables import *
+from FrequencyGrid import gridFor, saveGrid
+from ScanPlan import DEFAULT_GAIN
+
+DEFAULT_LOCATION = os.environ.get('EARS_LOCATION', 'default')
+TOD_BUCKETS = 6
+
+class baselineIndex(IsDescription):
+    version = Int32Col()
+    location = StringCol(32)
+    todBucket = Int8Col()
+    gain = Float32Col()
+    time = StringCol(20)
+    freqLow = Float64Col()
+    freqHigh = Float64Col()
+    nBins = Int32Col()
+    nSweeps = Int32Col()
+    simulated = BoolCol()
+
+def todBucket(when=None, buckets=TOD_BUCKETS):
+    '''Time of day bucket of a datetime, or of an EARS time stamp ("%Y:%m:%d:%H:%M:%S").'''
+    if when is None:
+        when = datetime.datetime.now()
+    if isinstance(when, bytes):
+        when = when.decode()
+    if isinstance(when, str):
+        when = datetime.datetime.strptime(when, "%Y:%m:%d:%H:%M:%S")
+    return (when.hour*60 + when.minute)*buckets//(24*60)
+
+def _getIndex(h5file):
+    if 'baselines' not in h5file.root:
+        group = h5file.create_group('/', 'baselines', 'Versioned RF power baselines')
+        group._v_attrs.nextVersion = 0
+        h5file.create_table(group, 'index', baselineIndex, 'Baseline versions')
+    return h5file.root.baselines.index
+
+def saveBaseline(freqs, power, spread=None, time=None, location=None, gain=DEFAULT_GAIN, simFlag=False, nSweeps=1, keep=5, DB_Name="EARS_DB.h5"):
+    '''
+    Store a baseline as a new version. Returns the version number.
+    spread is the per bin robust standard deviation; leave it out for single sweep baselines.
+    '''
+    time = time or datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
+    location = location or DEFAULT_LOCATION
+    freqs = np.asarray(freqs, dtype=np.float64)
+    order = np.argsort(freqs)
+    spread = np.full(len(freqs), np.nan) if spread is None else np.asarray(spread)
+    filters = Filters(complevel=5, complib='zlib', shuffle=True)
+    with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+        index = _getIndex(h5file)
+        group = h5file.root.baselines
+        version = int(group._v_attrs.nextVersion)
+        group._v_attrs.nextVersion = version + 1
+        node = h5file.create_group(group, 'v{}'.format(version), 'Baseline version {}'.format(version))
+        h5file.create_carray(node, 'frequency', obj=freqs[order], filters=filters)
+        h5file.create_carray(node, 'power', obj=np.asarray(power, dtype=np.float32)[order], filters=filters)
+        h5file.create_carray(node, 'spread', obj=spread.astype(np.float32)[order], filters=filters)
+        #The grid the calibration sweeps were on, so the baseline can be lined up with sweeps by bin
+        grid = gridFor(freqs[order])[0]
+        node._v_attrs.gridID = grid.id
+        saveGrid(h5file, grid)
+        row = index.row
+        row['version'] = version
+        row['location'] = location
+        row['todBucket'] = todBucket(time)
+        row['gain'] = gain
+        row['time'] = time
+        row['freqLow'] = freqs[order[0]]
+        row['freqHigh'] = freqs[order[-1]]
+        row['nBins'] = len(freqs)
+        row['nSweeps'] = nSweeps
+        row['simulated'] = simFlag
+        row.append()
+        index.flush()
+        _prune(h5file, index, keep)
+    return version
+
+def _prune(h5file, index, keep):
+    '''Drop all but the newest `keep` versions of each (location, bucket, gain, range).'''
+    rows = index.read()
+    seen = {}
+    drop = []
+    for i in np.argsort(-rows['version'], kind='stable'):
+        key = (rows['location'][i], rows['todBucket'][i], rows['gain'][i], rows['freqLow'][i], rows['freqHigh'][i])
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > keep:
+            drop.append(i)
+    for i in sorted(drop, reverse=True):
+        h5file.remove_node(h5file.root.baselines, 'v{}'.format(rows['version'][i]), recursive=True)
+        index.remove_row(i)
+
+def listBaselines(DB_Name="EARS_DB.h5"):
+    '''The index as a numpy record array, or None if there are no versioned baselines.'''
+    if not os.path.isfile(DB_Name):
+        return None
+    with open_file(DB_Name, mode="r") as h5file:
+        if 'baselines' not in h5file.root:
+            return None
+        return h5file.root.baselines.index.read()
+
+def rankBaselines(rows, location=None, gain=DEFAULT_GAIN, when=None, buckets=TOD_BUCKETS):
+    '''Order of preference of the index rows (best first) for a scan at this location, gain and time.'''
+    location = (location or DEFAULT_LOCATION).encode()
+    bucket = todBucket(when, buckets)
+    distance = np.abs(rows['todBucket'].astype(np.int64) - bucket)
+    distance = np.minimum(distance, buckets - distance) #Time of day wraps around midnight
+    #lexsort sorts on the last key first
+    return np.lexsort((-rows['version'], distance, rows['gain'] != gain, rows['location'] != location))
+
+def selectBaseline(freqMin, freqMax, location=None, gain=DEFAULT_GAIN, when=None, DB_Name="EARS_DB.h5"):
+    '''
+    Best matching baseline over [freqMin, freqMax]. Returns (freqs, power, spread, versions), where
+    versions are the baseline versions that were used, or None if no stored baseline overlaps the range.
+    '''
+    if not os.path.isfile(DB_Name):
+        return None
+    with open_file(DB_Name, mode="r") as h5file:
+        if 'baselines' not in h5file.root:
+            return None
+        rows = h5file.root.baselines.index.read()
+        rows = rows[(rows['freqHigh'] >= freqMin) & (rows['freqLow'] <= freqMax)]
+        if len(rows) == 0:
+            return None
+        covered = []
+        parts = []
+        versions = []
+        for i in rankBaselines(rows, location, gain, when):
+            low, high = max(rows['freqLow'][i], freqMin), min(rows['freqHigh'][i], freqMax)
+            if any(cLow <= low and high <= cHigh for cLow, cHigh in covered):
+                continue
+            node = h5file.root.baselines._f_get_child('v{}'.format(rows['version'][i]))
+            freqs = node.frequency[:]
+            keep = (freqs >= low) & (freqs <= high)
+            for cLow, cHigh in covered:
+                keep &= (freqs < cLow) | (freqs > cHigh)
+            if not keep.any():
+                continue
+            parts.append((freqs[keep], node.power[:][keep], node.spread[:][keep]))
+            covered.append((low, high))
+            versions.append(int(rows['version'][i]))
+    if not parts:
+        return None
+    freqs = np.concatenate([part[0] for part in parts])
+    order = np.argsort(freqs)
+    return freqs[order], np.concatenate([part[1] for part in parts])[order], np.concatenate([part[2] for part in parts])[order], versions
@@ -0,0 +1,207 @@
+'''
+Streaming per-frequency-bin statistics for whole sessions of recorded data.
+
+EARSAnalyzer used to load an entire session into a DataFrame and groupby('frequency'). That doesn't fit in
+memory on the Pi for anything longer than a few minutes. This module keeps running statistics per bin
+instead, and is fed one chunk of sweeps at a time:
+
+    ~count, mean and variance (Welford/Chan - the chunk's mean and M2 are merged into the running totals)
+    ~min and max
+    ~occupancy - number of sweeps where the bin was above a threshold (absolute, or baseline + margin)
+    ~approximate percentiles from a fixed per-bin histogram of dB values (percentiles=True)
+
+Memory is set by the number of bins, not the number of sweeps. The histogram is the big one:
+bins * (histHigh - histLow)/histRes * 4 bytes, ex. about 418 MB for a full 30M:1.7G scan, and every
+AnalysisRunner partial has its own. So it's off by default. Turn it on (and coarsen histRes for big
+grids) when you need percentiles.
+
+Typical use:
+    stats = analyzeSession(b'0f04cfdf-fe1c-4448-94e4-a89d7a48a662', aboveBaseline=10)
+    summary = stats.summary()
+'''
+
+import numpy as np
+import pandas as pd
+from DBManager import iterSessionSweeps, RetrieveBaselineData
+from AnalysisRunner import AnalysisKernel
+from FrequencyGrid import gridFor
+
+class BinStats():
+    '''
+    Running statistics for each frequency bin of a fixed grid. Call update() with (sweeps x bins) power
+    matrices. Two BinStats on the same grid can be combined with merge(), so chunks can be processed
+    in parallel.
+    '''
+    def __init__(self, freqs, threshold=None, percentiles=False, histLow=-130.0, histHigh=20.0, histRes=0.5):
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        nBins = len(self.freqs)
+        #Threshold can be one number for everything or one per bin (ex. baseline + margin)
+        self.threshold = None if threshold is None else np.broadcast_to(np.asarray(threshold, dtype=np.float32), (nBins,))
+        self.nSweeps = 0
+        self.mean = np.zeros(nBins, dtype=np.float64)
+        self.m2 = np.zeros(nBins, dtype=np.float64)
+        self.min = np.full(nBins, np.inf, dtype=np.float32)
+        self.max = np.full(nBins, -np.inf, dtype=np.float32)
+        self.occupied = np.zeros(nBins, dtype=np.int64)
+        self.histLow = histLow
+        self.histRes = histRes
+        self.nHist = int(np.ceil((histHigh - histLow)/histRes))
+        self.hist = np.zeros((nBins, self.nHist), dtype=np.uint32) if percentiles else None
+
+    def update(self, power):
+        power = np.asarray(power, dtype=np.float32)
+        if power.ndim == 1:
+            power = power[np.newaxis, :]
+        n = len(power)
+        if n == 0:
+            return
+        #Merge the chunk's mean and M2 into the running values. This is the parallel form of Welford's
+        #update, so it's numerically stable and works a whole chunk at a time.
+        chunkMean = power.mean(axis=0, dtype=np.float64)
+        chunkM2 = ((power - chunkMean)**2).sum(axis=0, dtype=np.float64)
+        total = self.nSweeps + n
+        delta = chunkMean - self.mean
+        self.mean += delta*n/total
+        self.m2 += chunkM2 + delta**2*self.nSweeps*n/total
+        self.nSweeps = total
+        np.minimum(self.min, power.min(axis=0), out=self.min)
+        np.maximum(self.max, power.max(axis=0), out=self.max)
+        if self.threshold is not None:
+            self.occupied += (power > self.threshold).sum(axis=0)
+        if self.hist is not None:
+            #Histogram cell for every reading, flattened to one index per (bin, cell). Counting the unique
+            #indices is much lighter than a bincount over the whole (bins x cells) table each chunk.
+            cell = np.clip(((power - self.histLow)/self.histRes).astype(np.int64), 0, self.nHist - 1)
+            flat = (cell + np.arange(power.shape[1])*self.nHist).ravel()
+            idx, counts = np.unique(flat, return_counts=True)
+            self.hist.ravel()[idx] += counts.astype(np.uint32)
+
+    def merge(self, other):
+        '''Fold another BinStats on the same grid into this one.'''
+        if len(other.freqs) != len(self.freqs):
+            raise ValueError('Can only merge statistics on the same frequency grid')
+        if other.nSweeps == 0:
+            return self
+        total = self.nSweeps + other.nSweeps
+        delta = other.mean - self.mean
+        self.mean += delta*other.nSweeps/total
+        self.m2 += other.m2 + delta**2*self.nSweeps*other.nSweeps/total
+        self.nSweeps = total
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self.occupied += other.occupied
+        if self.hist is not None and other.hist is not None:
+            self.hist += other.hist
+        return self
+
+    @classmethod
+    def join(cls, parts):
+        '''Statistics for neighbouring spans of a grid (same sweeps, in frequency order) as one BinStats'''
+        first = parts[0]
+        joined = cls(np.concatenate([p.freqs for p in parts]), percentiles=False, histLow=first.histLow,
+                     histHigh=first.histLow + first.nHist*first.histRes, histRes=first.histRes)
+        if all(p.threshold is not None for p in parts):
+            joined.threshold = np.concatenate([p.threshold for p in parts])
+        joined.nSweeps = first.nSweeps
+        for name in ('mean', 'm2', 'min', 'max', 'occupied'):
+            setattr(joined, name, np.concatenate([getattr(p, name) for p in parts]))
+        if all(p.hist is not None for p in parts):
+            joined.hist = np.concatenate([p.hist for p in parts])
+        return joined
+
+    def variance(self):
+        if self.nSweeps < 2:
+            return np.zeros_like(self.mean)
+        return self.m2/(self.nSweeps - 1)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def occupancy(self):
+        '''Fraction of sweeps each bin was above the threshold.'''
+        if self.threshold is None or self.nSweeps == 0:
+            return np.full(len(self.freqs), np.nan)
+        return self.occupied/self.nSweeps
+
+    def percentile(self, q, blockBins=4096):
+        '''
+        Approximate q-th percentile (0-100) per bin, interpolated inside the histogram cell. Accuracy is
+        about histRes. Done in blocks of bins so the cumulative sum doesn't need a full size copy.
+        '''
+        if self.hist is None:
+            raise ValueError('Percentiles were not enabled for these statistics')
+        out = np.full(len(self.freqs), np.nan)
+        if self.nSweeps == 0:
+            return out
+        target = q/100*self.nSweeps
+        for start in range(0, len(self.freqs), blockBins):
+            hist = self.hist[start:start + blockBins]
+            cum = np.cumsum(hist, axis=1, dtype=np.int64)
+            cell = np.argmax(cum >= target, axis=1)
+            rows = np.arange(len(hist))
+            below = cum[rows, cell] - hist[rows, cell]
+            frac = (target - below)/np.maximum(hist[rows, cell], 1)
+            out[start:start + blockBins] = self.histLow + (cell + np.clip(frac, 0, 1))*self.histRes
+        return out
+
+    def summary(self, percentiles=(10, 50, 90)):
+        '''One row per bin. This is small (bins, not sweeps x bins) so a DataFrame is fine here.'''
+        result = pd.DataFrame({'frequency': self.freqs, 'count': self.nSweeps, 'mean': self.mean,
+                               'std': self.std(), 'min': self.min, 'max': self.max,
+                               'occupancy': self.occupancy()})
+        if self.hist is not None:
+            for q in percentiles:
+                result['p{}'.format(q)] = self.percentile(q)
+        return result
+
+
+def baselineThreshold(freqs, margin, DB_Name="EARS_DB.h5"):
+    '''Baseline power interpolated onto freqs, plus a margin in dB. None if there is no baseline.'''
+    blData = RetrieveBaselineData(DB_Name=DB_Name, freqMin=freqs[0], freqMax=freqs[-1])
+    if not blData:
+        return None
+    bl = np.array(blData, dtype=np.float64)
+    bl = bl[np.argsort(bl[:, 0])]
+    return np.interp(freqs, bl[:, 0], bl[:, 1]) + margin
+
+def analyzeSession(sessionID, DB_Name="EARS_DB.h5", threshold=None, aboveBaseline=None, chunkRows=500_000, **kwargs):
+    '''
+    One pass over a stored session, chunk by chunk. Returns a BinStats for the session's grid.
+    Occupancy uses threshold (dB) if given, otherwise baseline + aboveBaseline (dB) if given.
+    Sweeps on a different grid than the first one (the scan command changed) are skipped.
+    '''
+    stats = None
+    for times, freqs, power in iterSessionSweeps(sessionID, DB_Name, chunkRows):
+        #Grids with the same number of bins can still be different bands
+        gridID = gridFor(freqs)[0].id
+        if stats is None:
+            if threshold is None and aboveBaseline is not None:
+                threshold = baselineThreshold(freqs, aboveBaseline, DB_Name)
+            stats = BinStats(freqs, threshold, **kwargs)
+            statsGrid = gridID
+        if gridID != statsGrid:
+            print('Skipping {} sweeps on a different frequency grid'.format(len(power)))
+            continue
+        stats.update(power)
+    return stats
+
+
+class StatsKernel(AnalysisKernel):
+    '''BinStats as an AnalysisRunner kernel. kwargs go to BinStats (percentiles, histRes...).'''
+    name = 'stats'
+
+    def __init__(self, threshold=None, aboveBaseline=None, **kwargs):
+        AnalysisKernel.__init__(self, threshold, aboveBaseline)
+        self.kwargs = kwargs
+
+    def update(self, partial, seconds, freqs, power):
+        if partial is None:
+            partial = BinStats(freqs, self.binThreshold(freqs), **self.kwargs)
+        partial.update(power)
+        return partial
+
+    def mergeTime(self, first, second):
+        return first.merge(second)
+
+    def joinFrequency(self, parts):
+        return parts[0] if len(parts) == 1 else BinStats.join(parts)
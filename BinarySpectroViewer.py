@@ -1,13 +1,21 @@
 import shlex
+import asyncio
 import subprocess as sb
-import matplotlib.pyplot as plt
 from multiprocessing import Process, Queue, set_start_method
 import threading
-from time import sleep
-import pandas as pd
-from DBManager import * 
 import datetime
-from numpy import maximum
+from uuid import uuid4
+import numpy as np
+from numpy import maximum, interp
+from HopTracker import HopTracker
+from JammingDetector import JammingDetector
+from PeakTracker import PeakTracker
+from Calibration import runDriver
+from FrequencyGrid import gridFor, indexMap
+from ScanPlan import parseRange, compilePlan
+from PlotDecimator import reduceForView
+#The GUI imports this module, and so does every scan process it spawns, so pandas, matplotlib and
+#pytables (DBManager) are imported where they're used instead of up here. See StartupTime.py.
 
 def processRFScan(scanData):
     data = str(scanData).strip().split('\\n')
@@ -41,47 +49,126 @@ def passCmdToDbLogger(cmd, simFlag):
         logQueue.put(dataToPass)
         return 'Sucess'
     
-def takeBaselineMeasurement():
+def takeBaselineMeasurement(bands=None, sweeps=5):
     '''
-    Measure power across a very broad spectrum and return the results from the stdout output.
+    Measure the baseline power across the calibration bands (30M:1.7G by default) and store it.
+    This blocks until every band is done. The GUIs run Calibration.calibrationWorker in a separate
+    process instead so they don't freeze.
     '''
-    simFlag = False #Sim isn't implemented yet. This is hardcoded false for now. 
-    cmd = 'rtl_power_fftw -f 30M:1.7G -b 500 -n 500 -g 100 -q'
-    args = shlex.split(cmd)
-    s = sb.run(args, stdout=sb.PIPE, stderr=sb.PIPE, shell=False)
-    while not s.returncode == 0:
-        if s.returncode == 1:
-            #We errored out. Most likely, RTL SDR is not plugged in
-            if 'No RTL-SDR' in str(s.stderr):
-                print('You forgot to plug in the RTL-SDR!')
-            print('Scan failed with error "{}"'.format(s.stderr))
-            return 'Error'
-        else:
-            #We need to just keep waiting to finish. This scan really does take awhile.
-            print('Still scanning....')
-            sleep(.5)
-    data = processRFScan(s.stdout)
-    time = curTime = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
-    BLData = (time, data, simFlag)
-    StoreBaselineData(pkt=BLData)
-
-    return 'Sucess'
+    from Calibration import calibrationWorker
+    return calibrationWorker(bands=bands, sweeps=sweeps)
 
 def convertFreqtoInt(freqStr):
     '''commanded freqs typically use an easy to read notation with prefixes. 
-    for example, cmdFreq = '30M:35M'
-    This utility converts them into normal strings.
-    TODO: Is there a smart way to have this function accept floats for the prefix? 
-    as in, 1.2M = 1.2 * 1_000_000 = 1200000
+    for example, cmdFreq = '30M:35M' or '30M:1.7G'
+    Kept for older callers - this is ScanPlan.parseRange.
     '''
-    lowFreq, highFreq = freqStr.split(':')
-    rep = [('M', '_000_000'), ('G', '_000_000_000'), ('K', '_000')]
-    for p, i in rep:
-        lowFreq = lowFreq.replace(p, i)
-        highFreq = highFreq.replace(p, i)
-    return (int(lowFreq), int(highFreq))
-
-def streamScan(cmdFreq = '88M:100M', SWBqueue=None, simFlag = False, simConfig = None):
+    return parseRange(freqStr)
+
+class ScanProcessor():
+    '''
+    Everything a scan view needs done to each sweep: max hold, hopper tracking and jamming detection
+    against the baseline for the scanned range. process() returns the software bus payload
+    (df, maxDF, baseline, extras). streamScan uses one of these, and the scan manager uses one per view.
+    Max hold is kept per bin of the first sweep's frequency grid (FrequencyGrid.py). Later sweeps on a
+    different grid are folded in through a cached index map rather than a join on rounded frequencies.
+    '''
+    def __init__(self, lowF, highF):
+        import time
+        import pandas as pd
+        from tables.exceptions import HDF5ExtError
+        from DBManager import RetrieveBaselineData
+        #Get the baseline data. A pooled scan (WorkerPool.py) can start while the long running logger is
+        #still writing the last scan's sweeps, so wait out its lock on the file for a moment.
+        for attempt in range(20):
+            try:
+                blData = RetrieveBaselineData(freqMin = lowF, freqMax = highF)
+                break
+            except HDF5ExtError:
+                time.sleep(.1)
+        else:
+            Warning('Database busy, scanning without a baseline')
+            blData = None
+        if blData is None:
+            print('Blank baseline data!')
+            self.baseline = pd.DataFrame(columns=['frequency', 'power'])
+        else:
+            self.baseline = pd.DataFrame(blData, columns=['frequency', 'power'])
+        #initialize the max
+        self.maxGrid = None
+        self.maxPower = None
+        #Link detections across sweeps so hoppers can be drawn as one emitter
+        self.hopTracker = HopTracker()
+        #Watch the noise floor for jamming. Seeded from the baseline on the first sweep, if we have one.
+        self.jamDetector = JammingDetector()
+        self.jamSeeded = False
+        #The strongest peaks, so viewers get a short list instead of searching the spectrum themselves
+        self.peakTracker = PeakTracker()
+        #What the viewer is showing, see setView
+        self.view = None
+        self.viewBaseline = None
+
+    def setView(self, low=None, high=None, widthPx=1000):
+        '''
+        From now on only send what a viewer showing low..high (the whole range if None) on widthPx pixels
+        needs (PlotDecimator.reduceForView). Detection still sees every bin. widthPx=None sends it all again.
+        '''
+        self.view = None if widthPx is None else (low, high, int(widthPx))
+        self.viewBaseline = None
+
+    def process(self, data):
+        '''data is the sweep as [(freq, dB)] (or an equivalent 2 column array)'''
+        import pandas as pd
+        data = np.asarray(data, dtype=np.float64)
+        df = pd.DataFrame(data, columns=['frequency', 'power']) #revisit this later. Profiling showed this wasn't a big eater, but the dataframe class is way beefier than I need for just a plot
+        grid, index = gridFor(data[:, 0])
+        row = grid.place(index, data[:, 1])
+        #Got the new data - calculate max
+        if self.maxGrid is None:
+            #Initialize the max to the last measurement
+            self.maxGrid = grid
+            self.maxPower = row.copy()
+        elif grid.id == self.maxGrid.id:
+            np.maximum(self.maxPower, row, out=self.maxPower)
+        else:
+            #Different grid (ex. the scan plan changed). Fold it in on the nearest max hold bins.
+            binMap = indexMap(grid, self.maxGrid)
+            inside = binMap >= 0
+            np.maximum.at(self.maxPower, binMap[inside], row[inside])
+        maxDF = pd.DataFrame({'freqCompare': self.maxGrid.freqs, 'frequency': self.maxGrid.freqs, 'power': self.maxPower})
+        now = datetime.datetime.now().timestamp()
+        self.hopTracker.update(df['frequency'].values, df['power'].values, now)
+        self.peakTracker.update(grid, row, now)
+        if not self.jamSeeded and not self.baseline.empty:
+            blSorted = self.baseline.sort_values('frequency')
+            self.jamDetector.seedFromBaseline(df['frequency'].values, 
+                                              interp(df['frequency'].values, blSorted['frequency'].values, blSorted['power'].values))
+        self.jamSeeded = True
+        jamStatus = self.jamDetector.update(df['frequency'].values, df['power'].values)
+        if jamStatus['changed']:
+            print('Jamming alarm: {}'.format(jamStatus['type']) if jamStatus['alarm'] else 'Jamming alarm cleared')
+        #Anything beyond the three dataframes goes in here so the viewers can pick out what they know about
+        extras = {'hoppers': self.hopTracker.hoppers(), 'jamming': jamStatus, 'gridID': grid.id,
+                  'peaks': self.peakTracker.peaks()}
+        if self.view is None:
+            return (df, maxDF, self.baseline, extras)
+        low, high, widthPx = self.view
+        extras['view'] = (low, high)
+        freqs, power = reduceForView(data[:, 0], data[:, 1], low, high, widthPx)
+        df = pd.DataFrame({'frequency': freqs, 'power': power})
+        freqs, power = reduceForView(self.maxGrid.freqs, self.maxPower, low, high, widthPx)
+        maxDF = pd.DataFrame({'freqCompare': freqs, 'frequency': freqs, 'power': power})
+        if self.viewBaseline is None:
+            #The baseline doesn't change during a scan, so it's only cut down when the view does
+            self.viewBaseline = self.baseline
+            if not self.baseline.empty:
+                blSorted = self.baseline.sort_values('frequency')
+                freqs, power = reduceForView(blSorted['frequency'].values.astype(np.float64),
+                                             blSorted['power'].values.astype(np.float64), low, high, widthPx)
+                self.viewBaseline = pd.DataFrame({'frequency': freqs, 'power': power})
+        return (df, maxDF, self.viewBaseline, extras)
+
+def streamScan(cmdFreq = '88M:100M', SWBqueue=None, simFlag = False, simConfig = None, cmdQueue = None, logTo = None, jobID = None):
     '''
     given a commanded set of frequencies and a queue to control the process, 
     perform the following steps in a loop.
@@ -91,92 +178,118 @@ def streamScan(cmdFreq = '88M:100M', SWBqueue=None, simFlag = False, simConfig =
         Max, last measured and baseline. 
     4. Check for a command in the queue. Execute any commands that are found. 
     5. Once the queue is empty, Send the dataframes back to the viewer.
+    The loop runs on an asyncio event loop (see _streamScanLoop). Commands go on cmdQueue if one is given,
+    which lets a QUIT stop the scan straight away instead of after the current sweep. Without one they're
+    read off SWBqueue between sweeps, like before. ('VIEW', jobID, low, high, widthPx) on cmdQueue tells
+    the scan what the viewer is showing, so it only sends that (ScanProcessor.setView).
+    A persistent scan worker (see WorkerPool.py) passes the queue of its long running logger as logTo,
+    so no logger is started or stopped here, and a jobID so a QUIT left over for an earlier scan on the
+    same cmdQueue is ignored. Those workers send ('QUIT', jobID) instead of 'QUIT'.
     '''
-    quitFlag = False
-    currentCommand = None
-
-    if simFlag:
-        #Make sim functions available only if we are going to use them
-        import StreamSim
+    asyncio.run(_streamScanLoop(cmdFreq, SWBqueue, simFlag, simConfig, cmdQueue, logTo, jobID))
+
+def _simSweep(cmdFreq, simConfig):
+    import StreamSim
+    if simConfig.scanType == 'fixedFreq':
+        return StreamSim.genFixedFreq(scannedFreqRange=cmdFreq, selectedFreq = simConfig.selectedFreq,\
+                                    peakPower = simConfig.peakPower, snr=simConfig.snr)
+    elif simConfig.scanType == 'widebandFreq':
+        return StreamSim.genWidebandTransmission(scannedFreqRange=cmdFreq, selectedFreq1 = simConfig.selectedFreq1, \
+                                              selectedFreq2 = simConfig.selectedFreq2, selectedFreq3 = simConfig.selectedFreq3, selectedFreq4 = simConfig.selectedFreq4, \
+                                              peakPower = simConfig.peakPower, snr=simConfig.snr)
+    elif simConfig.scanType == 'freqHopping':
+        return StreamSim.genFreqHopping(scannedFreqRange=cmdFreq, peakPower = simConfig.peakPower, snr=simConfig.snr)
+    return 'Unknown sim scan type {}'.format(simConfig.scanType)
+
+async def _streamScanLoop(cmdFreq, SWBqueue, simFlag, simConfig, cmdQueue, logTo=None, jobID=None):
+    '''
+    The body of streamScan. Nothing in here polls: the driver runs as an asyncio subprocess, the log
+    hand-off and the sim generators run in the default executor, and commands arrive through a thread
+    blocked on cmdQueue, so the process sleeps until a sweep finishes or a command comes in.
+    '''
+    loop = asyncio.get_event_loop()
+    quitEvent = asyncio.Event()
 
     print('Received command ', cmdFreq)
 
-    cmd = 'rtl_power_fftw -f {0} -b 500 -n 100 -g 100 -q'.format(cmdFreq)
-    args = shlex.split(cmd)
+    #Parsed and checked once; everything below works from the plan
+    plan = compilePlan(cmdFreq, bins=500, repeats=100, gain=100)
+    args = list(plan.args)
     global logQueue 
-    logQueue = Queue(25)
-    #Start up the logging thread
-    logger = Process(target=DB_Logger, args=(logQueue,), daemon=True)
-    logger.start()
-
-    #Get the baseline data
-    #Figure out the numeric equivalent of our commanded freqs
-    lowF, highF = convertFreqtoInt(cmdFreq)
-    blData = RetrieveBaselineData(freqMin = lowF, freqMax = highF)
-    if blData is None:
-        print('Blank baseline data!')
-        baseline = pd.DataFrame(columns=['frequency', 'power'])
+    if logTo is None:
+        from DBManager import DB_Logger
+        logQueue = Queue(25)
+        #Start up the logging thread
+        logger = Process(target=DB_Logger, args=(logQueue,), daemon=True)
+        logger.start()
     else:
-        baseline = pd.DataFrame(blData, columns=['frequency', 'power'])
-    #initialize the max
-    maxDF = pd.DataFrame(columns=['frequency', 'power'])
+        #The logger is already running, just start this scan's session in it
+        logQueue = logTo
+        logger = None
+        curTime = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
+        logQueue.put((curTime, str(uuid4()), simFlag, 'session'))
+
+    processor = ScanProcessor(plan.low, plan.high)
+    if cmdQueue is not None:
+        def waitForQuit():
+            while True:
+                cmd = cmdQueue.get()
+                if cmd == 'QUIT' or cmd == ('QUIT', jobID):
+                    break
+                if cmd == ('END', jobID):
+                    #The scan ended on its own, stop listening so the next job gets the queue
+                    return
+                if isinstance(cmd, tuple) and cmd[:2] == ('VIEW', jobID):
+                    #('VIEW', jobID, low, high, widthPx): the viewer zoomed or panned, see ScanProcessor.setView
+                    loop.call_soon_threadsafe(processor.setView, *cmd[2:])
+            print('ScanView got Quit')
+            loop.call_soon_threadsafe(quitEvent.set)
+        #Daemon thread, so a scan that ends on its own doesn't hang waiting for a command
+        threading.Thread(target=waitForQuit, daemon=True).start()
+
+    quitWait = asyncio.ensure_future(quitEvent.wait())
     #Start execution loop
-    while not quitFlag:
+    while not quitEvent.is_set():
         if not simFlag:
-            s = sb.run(args, stdout=sb.PIPE, stderr=sb.PIPE, shell=False)
-            while not s.returncode == 0:
-                if s.returncode == 1:
-                    #We errored out. Most likely, RTL SDR is not plugged in
-                    if 'No RTL-SDR' in str(s.stderr):
-                        print('You forgot to plug in the RTL-SDR!')
-                    print('Scan failed with error "{}"'.format(s.stderr))
-                    return
-                else:
-                    #We need to just keep waiting to finish. This scan can take awhile.
-                    sleep(.5)
-        else:
-            if simConfig.scanType == 'fixedFreq':
-                s = StreamSim.genFixedFreq(scannedFreqRange=cmdFreq, selectedFreq = simConfig.selectedFreq,\
-                                            peakPower = simConfig.peakPower, snr=simConfig.snr)
-            elif simConfig.scanType == 'widebandFreq':
-                s = StreamSim.genWidebandTransmission(scannedFreqRange=cmdFreq, selectedFreq1 = simConfig.selectedFreq1, \
-                                                      selectedFreq2 = simConfig.selectedFreq2, selectedFreq3 = simConfig.selectedFreq3, selectedFreq4 = simConfig.selectedFreq4, \
-                                                      peakPower = simConfig.peakPower, snr=simConfig.snr)
-            elif simConfig.scanType == 'freqHopping':
-                s = StreamSim.genFreqHopping(scannedFreqRange=cmdFreq, peakPower = simConfig.peakPower, snr=simConfig.snr)
-        data = processRFScan(s.stdout) #Process the bytes like object into the list of tuples we use for processing
-        df = pd.DataFrame(data, columns=['frequency', 'power']) #revisit this later. Profiling showed this wasn't a big eater, but the dataframe class is way beefier than I need for just a plot
-        threading.Thread(target=passToDbLogger, args=(data, simFlag)).start() #Go ahead and leave this in a different thread. This present thread should focus on processing the RF data        
-        
-        #Got the new data - calculate max
-        df['freqCompare'] = df['frequency'].round(0)
-        df = df.set_index('freqCompare')
-        if maxDF.empty:
-            #Initialize the max to the last measurement
-            maxDF = df
+            sweep = asyncio.ensure_future(runDriver(args))
         else:
-            #not the first time. compare more discreet freqs by rounding
-            #I basically don't care about the frequency column in maxDF, only the rounded one. 
-            maxDF = maxDF.combine(df, maximum, overwrite = False)
+            sweep = loop.run_in_executor(None, _simSweep, cmdFreq, simConfig)
+        await asyncio.wait((sweep, quitWait), return_when=asyncio.FIRST_COMPLETED)
+        if not sweep.done():
+            #Quit mid sweep. Cancelling kills the driver.
+            sweep.cancel()
+            break
+        s = sweep.result()
+        if isinstance(s, str):
+            #We errored out. Most likely, RTL SDR is not plugged in
+            print(s)
+            break
+        data = processRFScan(s if not simFlag else s.stdout) #Process the bytes like object into the list of tuples we use for processing
+        loop.run_in_executor(None, passToDbLogger, data, simFlag) #Hand off to the logger without holding up the RF processing
+        payload = processor.process(data)
         #Check if there is a command for us in the queue.
-        if not SWBqueue.empty():
-            currentCommand = SWBqueue.get()
+        if cmdQueue is None and not SWBqueue.empty():
+            if SWBqueue.get() == 'QUIT':
+                print('ScanView got Quit')
+                quitEvent.set()
         #Go ahead and put our data in the queue now. 
-        # #TODO visit if we need to execute command first. what if the user hits quit like 90 times super fast?
         if not SWBqueue.full():
-            SWBqueue.put((df, maxDF.reset_index(), baseline))
+            SWBqueue.put(payload)
         else:
             Warning('Software bus overflow: Dropping measurement data')
-        #Execute commands
-        #Only one command right now - quit
-        if currentCommand == 'QUIT':
-            print('ScanView got Quit')
-            quitFlag = True
+    quitWait.cancel()
     #This executes after breaking out of the execution loop. It needs to clean us up.
+    if logger is None:
+        #A pooled worker keeps its logger, and its cmdQueue for the next job
+        if cmdQueue is not None and not quitEvent.is_set():
+            cmdQueue.put(('END', jobID))
+        SWBqueue.put('Done')
+        return
     print('Closing logger...')
     logQueue.put('Quit')
-    #logger.join()    
     SWBqueue.put('Done')
+    #Let the logger write what it has. Exiting first would leave this process stuck flushing logQueue.
+    await loop.run_in_executor(None, logger.join, 30)
     return
 
 
@@ -184,6 +297,9 @@ def streamScan(cmdFreq = '88M:100M', SWBqueue=None, simFlag = False, simConfig =
 
 def streamScanTest(cmdFreq = '30M:35M', simFlag = False , input_center_freq = 32_000_000 , input_power = 0):
     #This is used to test the logic, processing, and any changes. 
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from DBManager import DB_Logger, RetrieveBaselineData
     if simFlag:
         #Make sim functions available only if we are going to use them
         import StreamSim
@@ -217,7 +333,7 @@ def streamScanTest(cmdFreq = '30M:35M', simFlag = False , input_center_freq = 32
     
 
     try:
-        lowF, highF = convertFreqtoInt(cmdFreq)
+        lowF, highF = parseRange(cmdFreq)
 
     except(ValueError):
         
@@ -240,17 +356,14 @@ def streamScanTest(cmdFreq = '30M:35M', simFlag = False , input_center_freq = 32
         #Very lazy loop to see plot updates
         #I want to be able to see the data from the cmd when I want and not flood the screen.
         if not simFlag:
+            #sb.run only returns once the driver has exited, so there's nothing left to wait for here
             s = sb.run(args, stdout=sb.PIPE, stderr=sb.PIPE, shell=False)
-            while not s.returncode == 0:
-                if s.returncode == 1:
-                    #We errored out. Most likely, RTL SDR is not plugged in
-                    if 'No RTL-SDR' in str(s.stderr):
-                        print('You forgot to plug in the RTL-SDR!')
-                    print('Scan failed with error "{}"'.format(s.stderr))
-                    return
-                else:
-                    #We need to just keep waiting to finish. This scan really does take awhile.
-                    sleep(.5)
+            if s.returncode != 0:
+                #We errored out. Most likely, RTL SDR is not plugged in
+                if 'No RTL-SDR' in str(s.stderr):
+                    print('You forgot to plug in the RTL-SDR!')
+                print('Scan failed with error "{}"'.format(s.stderr))
+                return
         else:
             #s = StreamSim.genFixedFreq(cmdFreq=cmdFreq, selectedFreq=32_000_000)
             s = StreamSim.genQuickAndDirtySimForWes(scannedFreqRange=cmdFreq, txCenterFreq = input_center_freq, peakPower = input_power)
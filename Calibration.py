@@ -0,0 +1,150 @@
+'''
+Baseline calibration, one band segment at a time.
+
+The old calibration ran one rtl_power_fftw over 30M:1.7G on the GUI thread and froze the window for
+minutes, then replaced the whole baseline at the end. Now:
+
+1. The calibration range is cut into fixed segments (CALIBRATION_BANDS). Segment edges never move, so
+   a recalibrated band lines up with the versions stored for it before.
+2. Each segment is swept several times and the baseline is the median power per bin, with the robust
+   spread (1.4826 * median absolute deviation) stored next to it. One strong burst during calibration no
+   longer ends up in the baseline.
+3. Each segment is written to the database as soon as it's done, as a new version in the baseline store
+   (BaselineStore.py) tagged with the location and gain, so a calibration that's cut short still leaves
+   the finished segments behind.
+4. calibrationWorker() is meant to be run in its own process, and reports progress on a queue:
+    ~('progress', index, total, name) - starting a segment
+    ~('segment', name, ok)            - a segment finished (ok False if it failed)
+    ~('done', nSegments)              - everything finished
+    ~('error', message)               - gave up, usually because the SDR isn't plugged in
+   Without a queue it just prints, which is what takeBaselineMeasurement() does.
+
+Partial recalibration of the bands in use: calibrationWorker(queue, bands=bandsInUse('88M:100M'))
+From the command line: python Calibration.py 88M:100M --location=siteA
+'''
+
+import asyncio
+import datetime
+import numpy as np
+from ScanPlan import parseRange, compilePlan, DEFAULT_GAIN
+
+#(name, lowHz, highHz). Together these cover the old 30M:1.7G calibration sweep.
+CALIBRATION_BANDS = [
+    ('VHF low', 30_000_000, 88_000_000),
+    ('VHF FM/air', 88_000_000, 174_000_000),
+    ('VHF high', 174_000_000, 225_000_000),
+    ('UHF military', 225_000_000, 400_000_000),
+    ('UHF', 400_000_000, 1_000_000_000),
+    ('L band', 1_000_000_000, 1_700_000_000),
+]
+
+def bandsInUse(freqRange, bands=CALIBRATION_BANDS):
+    '''Calibration bands which overlap a commanded range, ex. '88M:100M' or (88_000_000, 100_000_000).'''
+    low, high = parseRange(freqRange)
+    return [band for band in bands if band[1] < high and band[2] > low]
+
+def simulateSweep(lowFreq, highFreq, bins=500, rng=None):
+    '''Noise floor with a little ripple, on the same kind of grid rtl_power_fftw puts out (2.4 MHz hops).'''
+    rng = rng or np.random.default_rng()
+    freqs = compilePlan((lowFreq, highFreq), bins).grid.freqs
+    power = -60 + 2*np.sin(freqs/7e6) + rng.normal(0, 1.5, len(freqs))
+    return freqs, power
+
+async def runDriver(args):
+    '''
+    Run the SDR driver (ex. rtl_power_fftw) without blocking the event loop. Returns its stdout, or an
+    error message string. Cancelling the task kills the driver, so a quit doesn't wait for the sweep.
+    '''
+    try:
+        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        return 'Could not find {}. Is it installed?'.format(args[0])
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        if 'No RTL-SDR' in str(stderr):
+            return 'You forgot to plug in the RTL-SDR!'
+        return 'Scan failed with error "{}"'.format(stderr)
+    return stdout
+
+async def runSweepAsync(lowFreq, highFreq, bins=500, repeats=500, gain=DEFAULT_GAIN):
+    '''One sweep of the SDR over a segment. Returns (freqs, power) arrays, or an error message string.'''
+    from BinarySpectroViewer import processRFScan
+    stdout = await runDriver(compilePlan((lowFreq, highFreq), bins, repeats, gain).args)
+    if isinstance(stdout, str):
+        return stdout
+    data = np.array(processRFScan(stdout), dtype=np.float64)
+    if len(data) == 0:
+        return 'Scan returned no data'
+    data = data[np.argsort(data[:, 0])]
+    return data[:, 0], data[:, 1]
+
+def runSweep(lowFreq, highFreq, bins=500, repeats=500, gain=DEFAULT_GAIN):
+    '''Blocking version of runSweepAsync, for code that isn't running an event loop.'''
+    return asyncio.run(runSweepAsync(lowFreq, highFreq, bins, repeats, gain))
+
+def measureSegment(lowFreq, highFreq, sweeps=5, bins=500, repeats=500, gain=DEFAULT_GAIN, simFlag=False):
+    '''
+    Sweep a segment several times. Returns (freqs, median, spread) or an error message string.
+    Sweeps are put on the first sweep's grid in case the driver returns a slightly different one.
+    '''
+    rows = []
+    freqs = None
+    for i in range(sweeps):
+        if simFlag:
+            result = simulateSweep(lowFreq, highFreq, bins)
+        else:
+            result = runSweep(lowFreq, highFreq, bins, repeats, gain)
+        if isinstance(result, str):
+            return result
+        sweepFreqs, power = result
+        if freqs is None:
+            freqs = sweepFreqs
+            rows.append(power)
+        else:
+            rows.append(np.interp(freqs, sweepFreqs, power))
+    rows = np.vstack(rows)
+    median = np.median(rows, axis=0)
+    spread = 1.4826*np.median(np.abs(rows - median), axis=0)
+    return freqs, median, spread
+
+def calibrationWorker(progressQueue=None, bands=None, sweeps=5, simFlag=False, location=None, gain=DEFAULT_GAIN, DB_Name="EARS_DB.h5"):
+    '''
+    Calibrate the given bands (all of CALIBRATION_BANDS by default), storing each one as it finishes.
+    Run in a Process with a Queue so the GUI stays responsive. Returns 'Sucess' or 'Error'.
+    '''
+    #pytables only gets loaded by the process doing the calibration
+    from BaselineStore import saveBaseline
+    def report(*msg):
+        if progressQueue is None:
+            print(*msg)
+        else:
+            progressQueue.put(msg)
+
+    bands = CALIBRATION_BANDS if bands is None else bands
+    for i, (name, lowFreq, highFreq) in enumerate(bands):
+        report('progress', i, len(bands), name)
+        result = measureSegment(lowFreq, highFreq, sweeps, gain=gain, simFlag=simFlag)
+        if isinstance(result, str):
+            report('segment', name, False)
+            report('error', result)
+            return 'Error'
+        freqs, median, spread = result
+        time = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
+        saveBaseline(freqs, median, spread, time, location, gain, simFlag, sweeps, DB_Name=DB_Name)
+        report('segment', name, True)
+    report('done', len(bands))
+    return 'Sucess'
+
+
+if __name__ == '__main__':
+    import sys
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    location = [arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--location=')]
+    #No range calibrates everything, otherwise just the bands overlapping the given range
+    selected = bandsInUse(args[0]) if args else None
+    calibrationWorker(bands=selected, simFlag='--sim' in sys.argv, location=location[0] if location else None)
@@ -0,0 +1,369 @@
+'''
+Unattended capture jobs, ex. overnight collections. Replaces rtl_power_script.py's loop of os.system
+calls writing CSVs.
+
+Jobs come from a JSON file:
+    {"jobs": [
+        {"name": "vhf", "range": "30M:88M", "every": "15m", "duration": "2m", "output": "db"},
+        {"name": "uhf-night", "range": "225M:400M", "cron": "0 22-23,0-5 * * *", "duration": "30m",
+         "bins": 500, "gain": 300, "dwell": .02, "output": "files", "directory": "captures",
+         "maxBytes": "500M", "maxAge": "1h", "keep": 48}
+    ]}
+
+    python CaptureScheduler.py jobs.json --db EARS_DB.h5
+
+Each job is one band with its driver settings: bins per hop, gain, and repeats per hop, or dwell (seconds
+averaged per hop, turned into repeats). It runs for `duration` at a time, either every `every` from when
+the scheduler starts, or at the times a 5 field cron expression (minute hour day month weekday) matches.
+
+Output:
+    ~"db"    - every run is a new session in the sweep store of the database, with its pyramid built
+               when the run ends and a 'capture <job> <range>' line in the command log. "codec" picks how
+               power is stored (PowerCodec.py), ex. "int8" for long collections on the SD card.
+    ~"files" - rtl_power_fftw style binary matrices (<directory>/<name>_<time>.bin, one float32 row per
+               sweep, with a .met file describing it and a .times file with each sweep's time stamp).
+               A new file is started when the current one reaches maxBytes, is maxAge old, or the grid
+               changes. keep limits how many files a job leaves behind, oldest deleted first.
+
+The scheduler is the only thing using the SDR. Runs that are active at the same time and have the same
+driver settings are coalesced: their ranges are merged (ScanPlan.mergeRanges) and each merged segment
+is swept once, then every run gets the part of the sweep inside its own range. Runs with different
+settings take turns. Sweeps go through Calibration.runSweepAsync, so EARS_DRIVER (or --simulate) can
+point the scheduler at SDRSimulator instead of hardware.
+'''
+
+import asyncio
+import datetime
+import glob
+import json
+import os
+import re
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import ScanPlan
+from ScanPlan import compilePlan, parseDuration, parseFreq, mergeRanges, writeMetadata, HOP_BANDWIDTH
+from FrequencyGrid import gridFor
+from Calibration import runSweepAsync
+from PowerCodec import getCodec
+
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+def parseCron(expr):
+    '''(minutes, hours, days, months, weekdays) sets from a cron expression. Weekday 0 (or 7) is Sunday.'''
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError('Cron expression "{}" should have 5 fields: minute hour day month weekday'.format(expr))
+    sets = []
+    for field, (low, high) in zip(fields, CRON_FIELDS):
+        values = set()
+        for part in field.split(','):
+            try:
+                part, step = part.split('/') if '/' in part else (part, '1')
+                if part == '*':
+                    first, last = low, high
+                elif '-' in part:
+                    first, last = (int(x) for x in part.split('-'))
+                else:
+                    first = last = int(part)
+                    if step != '1':
+                        last = high
+                values.update(range(first, last + 1, int(step)))
+            except ValueError:
+                raise ValueError('Could not understand "{}" in cron expression "{}"'.format(field, expr)) from None
+        if high == 6 and 7 in values:
+            values.add(0)
+        if not values or min(values) < low or max(values) > max(high, 7 if high == 6 else high):
+            raise ValueError('Cron field "{}" is outside {}-{}'.format(field, low, high))
+        sets.append(values)
+    #Like cron, day and weekday are either-or when both are restricted
+    sets.append(fields[2] != '*' and fields[4] != '*')
+    return sets
+
+def nextCronTime(cron, after):
+    '''First minute after `after` (a datetime) which the parsed cron expression matches'''
+    minutes, hours, days, months, weekdays, either = cron
+    t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    limit = t + datetime.timedelta(days=366*5)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            continue
+        dayOK, weekdayOK = t.day in days, (t.weekday() + 1) % 7 in weekdays
+        if not ((dayOK or weekdayOK) if either else (dayOK and weekdayOK)):
+            t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            continue
+        if t.minute not in minutes:
+            t += datetime.timedelta(minutes=1)
+            continue
+        return t
+    raise ValueError('Cron expression never matches')
+
+def parseSize(value):
+    '''Bytes from a number or text like 500M or 2G'''
+    if isinstance(value, (int, float)):
+        return int(value)
+    return parseFreq(str(value).strip().upper().rstrip('B'))
+
+
+class CaptureJob():
+    def __init__(self, name, freqRange, duration, every=None, cron=None, bins=500, gain=100, repeats=None,
+                 dwell=None, output='db', directory='captures', maxBytes=None, maxAge=None, keep=None, codec=None):
+        if (every is None) == (cron is None):
+            raise ValueError('Job {} needs one of every or cron'.format(name))
+        if output not in ('db', 'files'):
+            raise ValueError('Job {} output should be db or files'.format(name))
+        self.name = name
+        self.duration = parseDuration(duration)
+        self.every = parseDuration(every) if every is not None else None
+        self.cron = parseCron(cron) if cron is not None else None
+        if repeats is None:
+            #dwell is seconds of samples per hop
+            repeats = max(1, int(round(float(dwell)*HOP_BANDWIDTH/bins))) if dwell is not None else 100
+        #Validates the range, and the settings runs are coalesced on
+        self.plan = compilePlan(freqRange, bins, repeats, gain)
+        self.settings = (self.plan.binsPerHop, self.plan.repeats, self.plan.gain)
+        self.output = output
+        self.directory = directory
+        self.maxBytes = parseSize(maxBytes) if maxBytes is not None else None
+        self.maxAge = parseDuration(maxAge) if maxAge is not None else None
+        self.keep = keep
+        self.codec = getCodec(codec).name
+        self.firstStart = None
+
+    def __repr__(self):
+        return 'CaptureJob({}, {}, {})'.format(self.name, self.plan.freqRange, 'every {}s'.format(self.every) if self.every else 'cron')
+
+    def nextStart(self, after):
+        '''When the job should next start, after the datetime `after`'''
+        if self.cron is not None:
+            return nextCronTime(self.cron, after)
+        if self.firstStart is None:
+            self.firstStart = after
+            return after
+        periods = int((after - self.firstStart).total_seconds()//self.every) + 1
+        return self.firstStart + datetime.timedelta(seconds=periods*self.every)
+
+def loadJobs(fileName):
+    with open(fileName) as f:
+        config = json.load(f)
+    jobs = []
+    for spec in config['jobs']:
+        spec = dict(spec)
+        jobs.append(CaptureJob(spec.pop('name'), spec.pop('range'), spec.pop('duration'), **spec))
+    return jobs
+
+
+class RollingMatrixWriter():
+    '''Sweeps into rtl_power_fftw style .bin/.met files, starting a new file on size, age or grid change.'''
+    def __init__(self, baseName, maxBytes=None, maxAge=None, keep=None, integrationTime=0):
+        self.baseName = baseName
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.keep = keep
+        self.integrationTime = integrationTime
+        self.file = None
+
+    def write(self, time, grid, row):
+        now = datetime.datetime.utcnow()
+        row = np.asarray(row, dtype=np.float32)
+        if (self.file is None or grid.id != self.grid.id
+                or (self.maxBytes and self.rows and (self.rows + 1)*row.nbytes > self.maxBytes)
+                or (self.maxAge and (now - self.first).total_seconds() >= self.maxAge)):
+            self._roll(grid, now)
+        self.file.write(row.tobytes())
+        self.file.flush()
+        self.times.write(time + '\n')
+        self.times.flush()
+        self.rows += 1
+        self.last = now
+
+    def _roll(self, grid, now):
+        self.close()
+        name = '{}_{}'.format(self.baseName, now.strftime('%Y%m%d_%H%M%S'))
+        while os.path.exists(name + '.bin'):
+            name += '_'
+        self.name, self.grid = name, grid
+        self.file = open(name + '.bin', 'wb')
+        self.times = open(name + '.times', 'w')
+        self.rows, self.first, self.last = 0, now, now
+        self._writeMetadata()
+        if self.keep:
+            #Count this job's files from earlier runs (and earlier scheduler restarts) too. Only exact
+            #<baseName>_<time stamp> names, so job uhf never takes job uhf_night's files for its own.
+            ours = re.compile(re.escape(os.path.basename(self.baseName)) + r'_\d{8}_\d{6}_*\.bin$')
+            files = sorted(name for name in glob.glob(glob.escape(self.baseName) + '_*.bin')
+                           if ours.match(os.path.basename(name)))
+            for oldName in files[:-self.keep]:
+                if oldName == self.name + '.bin':
+                    continue
+                for ext in ('.bin', '.met', '.times'):
+                    if os.path.exists(oldName[:-4] + ext):
+                        os.remove(oldName[:-4] + ext)
+
+    def _writeMetadata(self):
+        sweepTime = (self.last - self.first).total_seconds()/max(1, self.rows - 1)
+        writeMetadata(self.name + '.met', self.grid, self.rows, self.first, self.last, sweepTime, self.integrationTime)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.times.close()
+            self._writeMetadata()
+            self.file = None
+
+
+class DatabaseWriter():
+    '''A capture run as a new session of the sweep store'''
+    def __init__(self, DB_Name, command, simFlag=False, codec=None):
+        from uuid import uuid4
+        self.DB_Name = DB_Name
+        self.sessionID = str(uuid4())
+        self.command = command
+        self.simFlag = simFlag
+        self.codec = codec
+        self.rows = 0
+
+    def write(self, time, grid, row):
+        from tables import open_file
+        from DBManager import appendSweeps, logCommand
+        with open_file(self.DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+            if not self.rows:
+                logCommand(h5file, self.sessionID, time, self.command[:100], self.simFlag)
+            appendSweeps(h5file, self.sessionID, grid, [time], row[np.newaxis, :], self.simFlag, self.codec)
+        self.rows += 1
+
+    def close(self):
+        if self.rows:
+            from SpectrumPyramid import buildSessionPyramid
+            buildSessionPyramid(self.sessionID, self.DB_Name)
+
+
+class _Run():
+    def __init__(self, job, start, writer):
+        self.job = job
+        self.end = start + datetime.timedelta(seconds=job.duration)
+        self.writer = writer
+        self.sweeps = 0
+
+
+class CaptureScheduler():
+    def __init__(self, jobs, DB_Name="EARS_DB.h5", simFlag=False):
+        self.jobs = jobs
+        self.DB_Name = DB_Name
+        self.simFlag = simFlag
+        self.runs = {}
+        #Files and the database are only touched from this one thread, in order
+        self.writerThread = ThreadPoolExecutor(1)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopEvent.set)
+
+    def _startRun(self, job, now):
+        print('Capture {} starting on {} for {:.0f} s'.format(job.name, job.plan.freqRange, job.duration))
+        if job.output == 'files':
+            os.makedirs(job.directory, exist_ok=True)
+            writer = RollingMatrixWriter(os.path.join(job.directory, job.name), job.maxBytes, job.maxAge, job.keep,
+                                         job.plan.integrationTime)
+        else:
+            writer = DatabaseWriter(self.DB_Name, 'capture {} {}'.format(job.name, job.plan.freqRange), self.simFlag, job.codec)
+        self.runs[job.name] = _Run(job, now, writer)
+
+    def _endRun(self, run):
+        print('Capture {} finished, {} sweeps'.format(run.job.name, run.sweeps))
+        del self.runs[run.job.name]
+        return self.loop.run_in_executor(self.writerThread, run.writer.close)
+
+    def sweepPlan(self):
+        '''[(settings, low, high)] segments covering every active run, ranges merged where settings match'''
+        groups = {}
+        for run in self.runs.values():
+            groups.setdefault(run.job.settings, []).append((run.job.plan.low, run.job.plan.high))
+        return [(settings, low, high) for settings, ranges in groups.items() for low, high in mergeRanges(ranges)]
+
+    async def _waitOrStop(self, task):
+        '''task's result, or None if stop() came first (task is cancelled)'''
+        stopper = asyncio.ensure_future(self.stopEvent.wait())
+        await asyncio.wait((task, stopper), return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if not task.done():
+            task.cancel()
+            return None
+        return task.result()
+
+    async def run(self):
+        '''Capture until stop() (or SIGINT/SIGTERM)'''
+        self.loop = asyncio.get_event_loop()
+        self.stopEvent = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stopEvent.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        now = datetime.datetime.now()
+        nextStarts = {job.name: job.nextStart(now) for job in self.jobs}
+        pending = []
+        while not self.stopEvent.is_set():
+            now = datetime.datetime.now()
+            for run in [run for run in self.runs.values() if run.end <= now]:
+                pending.append(self._endRun(run))
+            for job in self.jobs:
+                if nextStarts[job.name] <= now:
+                    if job.name not in self.runs:
+                        self._startRun(job, now)
+                    nextStarts[job.name] = job.nextStart(now)
+            if not self.runs:
+                wait = (min(nextStarts.values()) - now).total_seconds()
+                print('Next capture at {}'.format(min(nextStarts.values()).strftime('%Y-%m-%d %H:%M:%S')))
+                await self._waitOrStop(asyncio.ensure_future(asyncio.sleep(max(0, wait))))
+                continue
+            for (bins, repeats, gain), low, high in self.sweepPlan():
+                result = await self._waitOrStop(asyncio.ensure_future(runSweepAsync(low, high, bins, repeats, gain)))
+                if result is None:
+                    break
+                if isinstance(result, str):
+                    #Most likely the SDR isn't plugged in. Don't spin on it.
+                    print(result)
+                    await self._waitOrStop(asyncio.ensure_future(asyncio.sleep(5)))
+                    continue
+                self._dispatch(bins, repeats, gain, *result)
+        for run in list(self.runs.values()):
+            pending.append(self._endRun(run))
+        print('Closing capture files...')
+        await asyncio.gather(*pending)
+        self.writerThread.shutdown()
+
+    def _dispatch(self, bins, repeats, gain, freqs, power):
+        curTime = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
+        for run in self.runs.values():
+            if run.job.settings != (bins, repeats, gain):
+                continue
+            inRange = (freqs >= run.job.plan.low) & (freqs <= run.job.plan.high)
+            if inRange.sum() < 2:
+                continue
+            grid, index = gridFor(freqs[inRange])
+            run.sweeps += 1
+            write = self.loop.run_in_executor(self.writerThread, run.writer.write, curTime, grid, grid.place(index, power[inRange]))
+            write.add_done_callback(self._reportError)
+
+    def _reportError(self, future):
+        #Writes aren't waited on, so say something if one fails (ex. the disk is full)
+        if not future.cancelled() and future.exception() is not None:
+            print('Capture write failed: {}'.format(future.exception()))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run scheduled EARS capture jobs')
+    parser.add_argument('jobs', help='JSON file of capture jobs')
+    parser.add_argument('--db', default='EARS_DB.h5', help='Database for jobs with "output": "db"')
+    parser.add_argument('--simulate', action='store_true', help='Capture from SDRSimulator instead of the SDR')
+    args = parser.parse_args()
+    if args.simulate:
+        ScanPlan.DRIVER = '"{}" "{}"'.format(sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SDRSimulator.py'))
+    scheduler = CaptureScheduler(loadJobs(args.jobs), args.db, args.simulate)
+    asyncio.get_event_loop().run_until_complete(scheduler.run())
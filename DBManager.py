@@ -1,7 +1,10 @@
 from tables import *
+import numpy as np
 import os
-from time import sleep
 from uuid import uuid4
+from BaselineStore import saveBaseline, selectBaseline, DEFAULT_GAIN
+from FrequencyGrid import gridFor, saveGrid, loadGrid
+from PowerCodec import getCodec
 
 sessionID = str(uuid4()) #This will be the unique session ID for this measurement session.
     #For future analysis, we will want to grab all the data for a particular session. 
@@ -23,12 +26,46 @@ class commandLog(IsDescription):
     command = StringCol(100)
     simulated = BoolCol()
 
-def DB_Logger(queue=None, DB_Name="EARS_DB.h5"):
+class sessionIndex(IsDescription):
+    #Row ranges of the measurement table belonging to each session, so analysis can jump straight
+    #to a session's rows instead of scanning the whole table for them.
+    sessionID = StringCol(36)
+    start = Int64Col()
+    stop = Int64Col() #exclusive
+
+class sweepIndex(IsDescription):
+    #Sweeps of each grid's matrix in /sweeps which belong to each session (see appendSweeps)
+    sessionID = StringCol(36)
+    gridID = UInt32Col()
+    start = Int64Col()
+    stop = Int64Col() #exclusive
+    simulated = BoolCol()
+
+def DB_Logger(queue=None, DB_Name="EARS_DB.h5", buildPyramid=True, rowTable=False, codec=None):
+    '''
+    Writes what comes in on the queue to the database until it gets 'Quit'. Sweeps go in the sweep store
+    (one power matrix per frequency grid, see appendSweeps). rowTable=True also writes the old one row per
+    reading /measurement/readout table, for tools which still query it directly. codec is how power is
+    stored for new grids (see PowerCodec.py). A 'session' packet switches to a new session ID, so one
+    logger can serve many scans.
+    '''
     print("Starting Logger")
     if not queue:
         Warning('No queue provided! Closing db manager.')
         return
     global sessionID
+    #The multi-resolution copy of this session for history browsing. Built as we log so there's no
+    #offline pass needed later. See SpectrumPyramid.py
+    #One pyramid per grid the session has sweeps on
+    pyramids = {}
+    if buildPyramid:
+        from SpectrumPyramid import PyramidStore
+    def flushPyramids():
+        #Pyramids are written a block of sweeps at a time, so the rest goes in when a session ends
+        if any(pyramid.pendingRows() for pyramid in pyramids.values()):
+            with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+                for pyramid in pyramids.values():
+                    pyramid.flush(h5file)
     if not os.path.isfile(DB_Name):
         #Check db file exists
         h5file = open_file(DB_Name, mode="w", title="EARS Measurements Record")
@@ -36,6 +73,7 @@ def DB_Logger(queue=None, DB_Name="EARS_DB.h5"):
         table = h5file.create_table(group, 'readout', RFMeasurements, "Measurements Record")
         cmdGroup = h5file.create_group("/", "Logs", 'System logging')
         cmdTable = h5file.create_table(cmdGroup, 'commandLog', commandLog, "Command Log")
+        h5file.close()
     with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
         #Check that the right tables have already been made. If not, make them. 
         dbNodes = str(h5file.list_nodes('/'))
@@ -48,35 +86,52 @@ def DB_Logger(queue=None, DB_Name="EARS_DB.h5"):
     while True:
         #Just keep going until the task is killed. If nothing is put in the queue, or if the queue is closed, 
         #this task should close the db file and close out. 
-        if not queue.empty():
-            try:
-                pkt = queue.get()
-            except ValueError as e:
-                #Pipe was closed and we didn't catch it for some reason. 
-                #That's annoying, but probably fine. Just give a grumpy warning and close the logger
-                Warning('LogQueue was closed before stopping the logger!')
-                return
-            if pkt == 'Quit':
-                #This is a daemon function, so just killing it is fine. 
-                #However, gracefully shutting down is quite nice too. 
-                print('Logger got Quit')
-                #Flush the queue before ending
-                while not queue.empty():
-                    flush = queue.get()
-                queue.close()
-                return
-            #Got data, get handle to DB
-            with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
-                if pkt[3] == 'measurement':
+        #get() sleeps until something arrives, so there's no polling delay and no waking up when idle.
+        try:
+            pkt = queue.get()
+        except (ValueError, OSError, EOFError) as e:
+            #Pipe was closed and we didn't catch it for some reason. 
+            #That's annoying, but probably fine. Just give a grumpy warning and close the logger
+            Warning('LogQueue was closed before stopping the logger!')
+            flushPyramids()
+            return
+        if pkt == 'Quit':
+            #This is a daemon function, so just killing it is fine. 
+            #However, gracefully shutting down is quite nice too. 
+            print('Logger got Quit')
+            #Flush the queue before ending
+            while not queue.empty():
+                flush = queue.get()
+            queue.close()
+            flushPyramids()
+            return
+        if pkt[3] == 'session':
+            #A long running logger (see WorkerPool.py) is told when a new scan starts, so each scan
+            #still gets its own session and pyramids. The format is (time, new session ID, simFlag).
+            flushPyramids()
+            sessionID = pkt[1]
+            pyramids = {}
+            continue
+        #Got data, get handle to DB
+        with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+            if pkt[3] == 'measurement':
+                '''
+                The expected format of these measurements is a tuple (time, data, simFlag) where time is a 20 char string
+                and data is a list of tuples containing (frequency, power). simFlag is a bool indicating whether 
+                this data was simulated. Session ID is a UUID which should uniquely identify the data from 
+                a particular session.
+                '''
+                if not len(pkt[1]):
+                    continue
+                reading = np.asarray(pkt[1], dtype=np.float64)
+                grid, index = gridFor(reading[:, 0])
+                row = grid.place(index, reading[:, 1])
+                appendSweeps(h5file, sessionID, grid, [pkt[0]], row[np.newaxis, :], pkt[2], codec)
+                if rowTable:
                     #table handles are retrieved from the file handle with the format file_handle.mount_point.group_handle.table_handle
                     table = h5file.root.measurement.readout
+                    startRow = table.nrows
                     measurement = table.row
-                    '''
-                    The expected format of these measurements is a tuple (time, data, simFlag) where time is a 20 char string
-                    and data is a list of tuples containing (frequency, power). simFlag is a bool indicating whether 
-                    this data was simulated. Session ID is a UUID which should uniquely identify the data from 
-                    a particular session.
-                    '''
                     for reading in pkt[1]:
                         measurement['time'] = pkt[0]
                         measurement['frequency'] = reading[0]
@@ -85,30 +140,176 @@ def DB_Logger(queue=None, DB_Name="EARS_DB.h5"):
                         measurement['simulated'] = pkt[2]
                         measurement.append()
                     table.flush()
-                elif pkt[3] == 'command':
-                    table = h5file.root.Logs.commandLog
-                    command = table.row
-                    '''
-                    The expected format of these commands is (time, command string, simFlag)
-                    '''
-                    #Build row for table
-                    command['time'] = pkt[0]
-                    command['command'] = pkt[1]
-                    command['simulated'] = pkt[2]
-                    command['sessionID'] = sessionID
-                    command.append()
-                    table.flush()
-        else:
-            #If there isn't anything in the queue, we can wait a pretty long time. 
-            #This doesn't need to be very fast. 1Hz is plenty.
-            sleep(1)
+                    _updateSessionIndex(h5file, sessionID, startRow, table.nrows)
+                if buildPyramid:
+                    if grid.id not in pyramids:
+                        pyramids[grid.id] = PyramidStore(sessionID, grid, firstGrid=not pyramids)
+                    pyramids[grid.id].addSweep(row, pkt[0])
+                    pyramids[grid.id].flush(h5file, force=False)
+            elif pkt[3] == 'command':
+                table = h5file.root.Logs.commandLog
+                command = table.row
+                '''
+                The expected format of these commands is (time, command string, simFlag)
+                '''
+                #Build row for table
+                command['time'] = pkt[0]
+                command['command'] = pkt[1]
+                command['simulated'] = pkt[2]
+                command['sessionID'] = sessionID
+                command.append()
+                table.flush()
 
 
-def DB_Retrieval(DB_Name="EARS_DB.h5", cols=['frequency', 'power'], query_string=None):
+def logCommand(h5file, sessionID, time, command, simFlag=False):
+    '''Add a line to the command log of an open database, for writers other than the logger (ex. importers).'''
+    if 'Logs' not in h5file.root:
+        h5file.create_group("/", "Logs", 'System logging')
+    if 'commandLog' not in h5file.root.Logs:
+        h5file.create_table(h5file.root.Logs, 'commandLog', commandLog, "Command Log")
+    table = h5file.root.Logs.commandLog
+    row = table.row
+    row['time'] = time
+    row['command'] = command
+    row['simulated'] = simFlag
+    row['sessionID'] = sessionID
+    row.append()
+    table.flush()
+
+
+def _sweepGroup(h5file, grid, codec=None, chunkRows=1):
+    '''
+    /sweeps/g<gridID>, made if needed: power (sweeps x bins) and the time stamp of every sweep. A new group
+    stores power with codec (see PowerCodec.py) in chunks of chunkRows sweeps (None for about 1 MB); an
+    existing one keeps the codec and chunks it was made with.
+    '''
+    if 'sweeps' not in h5file.root:
+        group = h5file.create_group('/', 'sweeps', 'Sweeps by frequency grid')
+        h5file.create_table(group, 'index', sweepIndex, 'Session sweep ranges')
+    name = 'g{}'.format(grid.id)
+    if name not in h5file.root.sweeps:
+        codec = getCodec(codec)
+        saveGrid(h5file, grid)
+        group = h5file.create_group(h5file.root.sweeps, name, 'Sweeps on grid {}'.format(grid.id))
+        group._v_attrs.gridID = grid.id
+        group._v_attrs.codec = codec.name
+        if chunkRows is None:
+            chunkRows = max(1, min(64, 1_048_576//(codec.dtype.itemsize*grid.count)))
+        filters = Filters(complevel=1, complib='zlib', shuffle=True)
+        h5file.create_earray(group, 'power', Atom.from_dtype(codec.dtype), (0, grid.count), 'Power (dB), one row per sweep',
+                             filters=filters, chunkshape=(chunkRows, grid.count))
+        if codec.perSweep:
+            #Uncompressed, so appending a value a sweep writes in place instead of rewriting a compressed chunk
+            h5file.create_earray(group, 'scale', Float32Atom(), (0,), 'Power scale of each sweep')
+            h5file.create_earray(group, 'offset', Float32Atom(), (0,), 'Power offset of each sweep')
+        h5file.create_earray(group, 'times', StringAtom(20), (0,), 'Sweep time stamps')
+    return h5file.root.sweeps._f_get_child(name)
+
+def _groupCodec(group):
+    #Groups from before codecs existed are float32
+    return getCodec(getattr(group._v_attrs, 'codec', 'float32'))
+
+def _readPower(group, start, stop, first=0, last=None):
+    '''Rows [start, stop), columns [first, last) of a grid group's power as float32, decoded'''
+    codec = _groupCodec(group)
+    if codec.perSweep:
+        return codec.decode(group.power[start:stop, first:last], group.scale[start:stop], group.offset[start:stop])
+    return codec.decode(group.power[start:stop, first:last])
+
+def appendSweeps(h5file, sessionID, grid, times, power, simFlag=False, codec=None, chunkRows=1):
+    '''
+    Add (sweeps x grid.count) power rows to the sweep store of an open database. Frequencies aren't stored
+    per reading: the grid id says where each column is (FrequencyGrid.loadGrid). codec and chunkRows are
+    only used if this is the first time the grid is stored.
+    chunkRows is the sweeps per compressed chunk. Appending to a partly filled chunk rewrites it, and HDF5
+    doesn't reuse the space of the old copy, so writers which add a sweep at a time (the logger, capture
+    jobs) keep the default of 1. Bulk writers (ex. the rtl_power importer) pass None for about 1 MB chunks.
+    '''
+    group = _sweepGroup(h5file, grid, codec, chunkRows)
+    start = group.power.nrows
+    values, scale, offset = _groupCodec(group).encode(power)
+    group.power.append(values)
+    if scale is not None and 'scale' in group:
+        group.scale.append(scale)
+        group.offset.append(offset)
+    group.times.append(np.asarray(times, dtype='S20'))
+    index = h5file.root.sweeps.index
+    if isinstance(sessionID, str):
+        sessionID = sessionID.encode()
+    #Sweeps on other grids can come in between, so look for this session's range on this grid
+    found = index.get_where_list('(sessionID == sid) & (gridID == gid) & (stop == end) & (simulated == sim)',
+                                 {'sid': sessionID, 'gid': np.uint32(grid.id), 'end': start, 'sim': simFlag})
+    if len(found):
+        #Still contiguous - just extend that range
+        index.cols.stop[found[-1]] = group.power.nrows
+    else:
+        row = index.row
+        row['sessionID'] = sessionID
+        row['gridID'] = grid.id
+        row['start'] = start
+        row['stop'] = group.power.nrows
+        row['simulated'] = simFlag
+        row.append()
+    index.flush()
+
+def getSessionSweepRanges(sessionID, DB_Name="EARS_DB.h5", h5file=None):
+    '''(gridID, start, stop) sweep ranges of a session in the sweep store. Empty for sessions only in the row table.'''
+    if isinstance(sessionID, str):
+        sessionID = sessionID.encode()
+    if h5file is None:
+        with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+            return getSessionSweepRanges(sessionID, DB_Name, h5file)
+    if 'sweeps' not in h5file.root:
+        return []
+    found = h5file.root.sweeps.index.read_where('sessionID == sid', {'sid': sessionID})
+    return [(int(grid), int(start), int(stop)) for grid, start, stop in zip(found['gridID'], found['start'], found['stop'])]
+
+def _iterStoredSweeps(h5file, sweepRanges, chunkRows, columns=None):
+    for gridID, rangeStart, rangeStop in sweepRanges:
+        grid = loadGrid(h5file, gridID)
+        group = h5file.root.sweeps._f_get_child('g{}'.format(gridID))
+        first, last = columns(grid.freqs) if columns else (0, grid.count)
+        if first >= last:
+            continue
+        #Same sweeps per chunk whatever the columns, so a span sees the same chunks as the whole grid
+        step = max(1, chunkRows//grid.count)
+        for start in range(rangeStart, rangeStop, step):
+            stop = min(start + step, rangeStop)
+            yield group.times[start:stop], grid.freqs[first:last], _readPower(group, start, stop, first, last)
+
+def readSessionSweeps(sessionID, gridID, start, stop, first=0, last=None, DB_Name="EARS_DB.h5", h5file=None):
+    '''
+    (times, power) of sweeps [start, stop) of a session on one grid, counted from the session's first sweep
+    on that grid, and only bins [first, last). power is (sweeps x bins) float32. For reading a window of
+    a stored session without walking it from the start (ex. level 0 of SpectrumPyramid.PyramidView).
+    '''
+    if h5file is None:
+        with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+            return readSessionSweeps(sessionID, gridID, start, stop, first, last, DB_Name, h5file)
+    group = h5file.root.sweeps._f_get_child('g{}'.format(gridID))
+    times, power = [], []
+    for grid, rangeStart, rangeStop in getSessionSweepRanges(sessionID, DB_Name, h5file):
+        if grid != gridID:
+            continue
+        length = rangeStop - rangeStart
+        if start < length and stop > 0:
+            times.append(group.times[rangeStart + max(start, 0):rangeStart + min(stop, length)])
+            power.append(_readPower(group, rangeStart + max(start, 0), rangeStart + min(stop, length), first, last))
+        start -= length
+        stop -= length
+    if not power:
+        last = group.power.shape[1] if last is None else last
+        return np.zeros(0, dtype='S20'), np.zeros((0, max(0, last - first)), dtype=np.float32)
+    return np.concatenate(times), np.vstack(power)
+
+def DB_Retrieval(DB_Name="EARS_DB.h5", cols=['frequency', 'power'], query_string=None, chunkRows=500_000):
     '''
     This is intended to provide an interface for our EARS database so that direct 
     pytables calls are not necessary in other modules. 
     This is likely to be an IO bound task, so good for concurrency/threading
+    query_string is a PyTables condition on the readout columns (sessionID, time, frequency, power,
+    simulated). It's run on the old row table and on the sweep store, where each sweep is looked at as
+    one row per bin, so sessions are found whichever way they were logged.
     '''
     if not query_string:
         Warning('No query provided to DB_Retrieval')
@@ -119,31 +320,372 @@ def DB_Retrieval(DB_Name="EARS_DB.h5", cols=['frequency', 'power'], query_string
         return "Error"
     
     with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
-        #table handles are retrieved from the file handle with the format file_handle.mount_point.group_handle.table_handle
-        table = h5file.root.measurement.readout
         #names = [ x['name'] for x in table.where("""(power > 3) & (20 <= frequency) & (frequency < 50) & (simulation == False)""") ]
         try:
-            #unfortunately, to make this sufficiently flexible, return a dictionary of tuples
-            result = {}
-            for key in cols:
-                result[key] = ( x[key] for x in table.where(query_string) )
-            return result
+            found = {key: [] for key in cols}
+            inRowTable = set()
+            if 'measurement' in h5file.root and 'readout' in h5file.root.measurement:
+                #table handles are retrieved from the file handle with the format file_handle.mount_point.group_handle.table_handle
+                rows = h5file.root.measurement.readout.read_where(query_string)
+                for key in cols:
+                    found[key].append(rows[key])
+                inRowTable = _rowTableSessions(h5file)
+            #Sessions logged with rowTable=True are in both, and were found already
+            for rows in _querySweeps(h5file, query_string, chunkRows, skip=inRowTable):
+                for key in cols:
+                    found[key].append(rows[key])
         except:
             Warning('Invalid query submitted')
             print('Did you make sure to format any string comparisons as bytes?')
             return 'Error'
+    #unfortunately, to make this sufficiently flexible, return a dictionary of tuples
+    result = {}
+    for key in cols:
+        result[key] = ( x for x in (np.concatenate(found[key]) if found[key] else []) )
+    return result
 
-def RetrieveBaselineData(queue=None, DB_Name="EARS_DB.h5", freqMin = 30_000_000, freqMax = 88_000_000):
+def _rowTableSessions(h5file, chunkRows=1_000_000):
+    '''Session IDs with rows in the readout table'''
+    if _sessionIndexComplete(h5file):
+        return set(h5file.root.measurement.sessionIndex.col('sessionID'))
+    table = h5file.root.measurement.readout
+    found = set()
+    for start in range(0, table.nrows, chunkRows):
+        found.update(np.unique(table.read(start, min(start + chunkRows, table.nrows), field='sessionID')))
+    return found
+
+def _querySweeps(h5file, condition, chunkRows=500_000, skip=()):
+    '''
+    The sweep store as readout table rows, a chunk of sweeps at a time. Yields a dictionary of column
+    arrays holding the rows which match condition. Sessions in skip are left out.
+    '''
+    import numexpr
+    if 'sweeps' not in h5file.root:
+        return
+    for entry in h5file.root.sweeps.index.read():
+        if entry['sessionID'] in skip:
+            continue
+        grid = loadGrid(h5file, int(entry['gridID']))
+        group = h5file.root.sweeps._f_get_child('g{}'.format(grid.id))
+        step = max(1, chunkRows//grid.count)
+        for start in range(int(entry['start']), int(entry['stop']), step):
+            stop = min(start + step, int(entry['stop']))
+            power = _readPower(group, start, stop).ravel()
+            rows = {'sessionID': np.full(len(power), entry['sessionID']),
+                    'time': np.repeat(group.times[start:stop], grid.count),
+                    'frequency': np.tile(grid.freqs, stop - start),
+                    'power': power,
+                    'simulated': np.full(len(power), entry['simulated'])}
+            match = numexpr.evaluate(condition, local_dict=rows)
+            yield {key: values[match] for key, values in rows.items()}
+
+def _sessionIndexComplete(h5file):
+    '''The index is only usable if it accounts for every row in the readout table.'''
+    if 'sessionIndex' not in h5file.root.measurement:
+        return False
+    index = h5file.root.measurement.sessionIndex
+    return index.attrs.coveredRows == h5file.root.measurement.readout.nrows
+
+def _updateSessionIndex(h5file, sessionID, start, stop):
+    '''
+    Record that rows [start, stop) of the readout table belong to sessionID. Called by the logger
+    after every append. If the table already had rows before the index existed, the index stays
+    marked incomplete until indexSessions() is run over the file.
+    '''
+    group = h5file.root.measurement
+    if 'sessionIndex' not in group:
+        index = h5file.create_table(group, 'sessionIndex', sessionIndex, "Session row ranges")
+        index.attrs.coveredRows = 0
+    index = group.sessionIndex
+    complete = index.attrs.coveredRows == start
+    if index.nrows and index.cols.sessionID[-1] == sessionID.encode() and index.cols.stop[-1] == start:
+        #Same session, still contiguous - just extend the last range
+        index.cols.stop[index.nrows - 1] = stop
+    else:
+        index.append([(sessionID, start, stop)])
+    index.flush()
+    if complete:
+        index.attrs.coveredRows = stop
+
+def indexSessions(DB_Name="EARS_DB.h5", chunkRows=1_000_000):
+    '''
+    One time pass which (re)builds the session index for a database written before the index
+    existed. After this, finding a session's rows doesn't need a scan of the whole table.
+    '''
+    with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+        group = h5file.root.measurement
+        if 'sessionIndex' in group:
+            h5file.remove_node(group, 'sessionIndex')
+        index = h5file.create_table(group, 'sessionIndex', sessionIndex, "Session row ranges")
+        table = group.readout
+        lastID, lastStart = None, 0
+        for start in range(0, table.nrows, chunkRows):
+            ids = table.read(start, min(start + chunkRows, table.nrows), field='sessionID')
+            changes = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+            for change, newID in zip(np.append(0, changes), ids[np.append(0, changes)]):
+                if newID != lastID:
+                    if lastID is not None:
+                        index.append([(lastID, lastStart, start + change)])
+                    lastID, lastStart = newID, start + change
+        if lastID is not None:
+            index.append([(lastID, lastStart, table.nrows)])
+        index.flush()
+        index.attrs.coveredRows = table.nrows
+
+def getSessionRowRanges(sessionID, DB_Name="EARS_DB.h5", chunkRows=1_000_000, h5file=None):
+    '''
+    Returns a list of (start, stop) row ranges in the measurement table which belong to a session.
+    Uses the session index when it is complete. Otherwise falls back to checking the sessionID
+    column a chunk at a time, which keeps memory bounded but has to read the whole table.
+    '''
+    if isinstance(sessionID, str):
+        sessionID = sessionID.encode()
+    if h5file is None:
+        with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+            return getSessionRowRanges(sessionID, DB_Name, chunkRows, h5file)
+    if _sessionIndexComplete(h5file):
+        found = h5file.root.measurement.sessionIndex.read_where('sessionID == sid', {'sid': sessionID})
+        found.sort(order='start')
+        return [(int(start), int(stop)) for start, stop in zip(found['start'], found['stop'])]
+    table = h5file.root.measurement.readout
+    ranges = []
+    for start in range(0, table.nrows, chunkRows):
+        ids = table.read(start, min(start + chunkRows, table.nrows), field='sessionID')
+        match = np.concatenate(([False], ids == sessionID, [False])).astype(np.int8)
+        #Edges alternate between the start of a run and the (exclusive) end of a run
+        edges = np.flatnonzero(np.diff(match))
+        for runStart, runStop in zip(edges[::2] + start, edges[1::2] + start):
+            if ranges and ranges[-1][1] == runStart:
+                #Run continues over the chunk boundary
+                ranges[-1] = (ranges[-1][0], int(runStop))
+            else:
+                ranges.append((int(runStart), int(runStop)))
+    return ranges
+
+def _sweepStarts(rows):
+    '''
+    Index of the first row of every sweep in a block of readout rows. A new sweep starts when the
+    time stamp changes or the frequency stops increasing (time only has 1 s resolution, so fast
+    sweeps can share a time stamp).
+    '''
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64)
+    freq = rows['frequency']
+    time = rows['time']
+    newSweep = (time[1:] != time[:-1]) | (freq[1:] <= freq[:-1])
+    return np.concatenate(([0], np.flatnonzero(newSweep) + 1))
+
+def _rowsToSweeps(rows, starts):
+    '''
+    Reshape a block of whole sweeps into (times, freqs, power) matrices. Consecutive sweeps with
+    the same number of bins and the same first and last frequency are grouped into a single
+    (sweeps x bins) matrix.
+    '''
+    if len(starts) == 0:
+        return
+    lengths = np.diff(np.append(starts, len(rows)))
+    firstFreq = rows['frequency'][starts]
+    lastFreq = rows['frequency'][starts + lengths - 1]
+    groupEdges = np.flatnonzero((np.diff(lengths) != 0) | (np.diff(firstFreq) != 0) | (np.diff(lastFreq) != 0)) + 1
+    for group in np.split(np.arange(len(starts)), groupEdges):
+        first = starts[group[0]]
+        nBins = int(lengths[group[0]])
+        last = first + nBins*len(group)
+        block = rows[first:last]
+        yield (block['time'][::nBins],
+               block['frequency'][:nBins].astype(np.float64),
+               block['power'].reshape(len(group), nBins))
+
+def iterSessionSweeps(sessionID, DB_Name="EARS_DB.h5", chunkRows=500_000, h5file=None, rowRanges=None, columns=None):
+    '''
+    Generator which walks a stored session in bounded memory and yields (times, freqs, power) where
+    power is a (sweeps x bins) float32 matrix. Each chunk only holds whole sweeps; a sweep which
+    crosses a chunk boundary is held back and finished with the next chunk.
+    Pass an open h5file to read from a file handle you already hold, and rowRanges to read only part
+    of the session (see partitionSession).
+    columns is an optional function of a grid's freqs returning the (first, last) bins to keep, for
+    working on one frequency span. The sweep store only reads those columns from disk.
+    Sessions in the sweep store are read from there, and freqs is their grid's frequencies. Older
+    sessions are read from the row table.
+    '''
+    if h5file is None:
+        if not os.path.isfile(DB_Name):
+            Warning("Provided DB file doesn't exist.")
+            return
+        with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+            yield from iterSessionSweeps(sessionID, DB_Name, chunkRows, h5file, rowRanges, columns)
+        return
+    if rowRanges is None:
+        sweepRanges = getSessionSweepRanges(sessionID, DB_Name, h5file)
+        if sweepRanges:
+            yield from _iterStoredSweeps(h5file, sweepRanges, chunkRows, columns)
+            return
+        rowRanges = getSessionRowRanges(sessionID, DB_Name, h5file=h5file)
+    elif rowRanges and len(rowRanges[0]) == 3:
+        #A piece of a stored session from partitionSession
+        yield from _iterStoredSweeps(h5file, rowRanges, chunkRows, columns)
+        return
+    if columns is not None:
+        #The row table has to be read whole, so cut the columns out afterwards
+        for times, freqs, power in iterSessionSweeps(sessionID, DB_Name, chunkRows, h5file, rowRanges):
+            first, last = columns(freqs)
+            if first < last:
+                yield times, freqs[first:last], power[:, first:last]
+        return
+    table = h5file.root.measurement.readout
+    carry = None
+    for rangeStart, rangeStop in rowRanges:
+        for start in range(rangeStart, rangeStop, chunkRows):
+            rows = table.read(start, min(start + chunkRows, rangeStop))
+            if carry is not None:
+                rows = np.concatenate((carry, rows))
+            starts = _sweepStarts(rows)
+            #The last sweep may not be finished yet
+            carry = rows[starts[-1]:]
+            yield from _rowsToSweeps(rows[:starts[-1]], starts[:-1])
+    if carry is not None and len(carry):
+        yield from _rowsToSweeps(carry, _sweepStarts(carry))
+
+def _nextSweepStart(table, row, stop, window=4096):
+    '''First row at or after row which starts a sweep. Reads a small window at a time.'''
+    while row < stop:
+        rows = table.read(row - 1, min(row + window, stop))
+        starts = _sweepStarts(rows)
+        if len(starts) > 1:
+            return row - 1 + int(starts[1])
+        row += window
+    return stop
+
+def partitionSession(sessionID, nParts, DB_Name="EARS_DB.h5", gridID=None):
+    '''
+    Split a session into about nParts pieces of similar size for parallel processing. Each piece is a
+    list of row ranges which starts and ends on a sweep boundary, so it can be handed straight to
+    iterSessionSweeps(rowRanges=...). For a session in the sweep store the pieces are (gridID, start, stop)
+    sweep ranges instead, and gridID picks out the sweeps on one grid.
+    '''
+    with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+        sweepRanges = getSessionSweepRanges(sessionID, DB_Name, h5file)
+        if gridID is not None:
+            return _partitionSweepRanges([r for r in sweepRanges if r[0] == gridID], nParts)
+        if sweepRanges:
+            return _partitionSweepRanges(sweepRanges, nParts)
+        table = h5file.root.measurement.readout
+        ranges = getSessionRowRanges(sessionID, DB_Name, h5file=h5file)
+        total = sum(stop - start for start, stop in ranges)
+        if total == 0:
+            return []
+        #Ideal cut points counted in session rows, then mapped back onto table rows
+        cuts = []
+        for target in np.linspace(0, total, nParts + 1)[1:-1].astype(np.int64):
+            for start, stop in ranges:
+                if target < stop - start:
+                    if target > 0:
+                        cuts.append(_nextSweepStart(table, start + int(target), stop))
+                    break
+                target -= stop - start
+        parts = [[]]
+        for start, stop in ranges:
+            for cut in sorted(set(c for c in cuts if start < c < stop)):
+                parts[-1].append((start, cut))
+                parts.append([])
+                start = cut
+            parts[-1].append((start, stop))
+        return [part for part in parts if part]
+
+def pieceSweeps(piece, h5file, chunkRows=1_000_000):
+    '''
+    (time stamps, grid ids) of every sweep in a piece of a session (see partitionSession), in order,
+    without reading their power. For the row table this reads the piece the same way iterSessionSweeps
+    does, so the sweeps line up one to one, and the grid id is FrequencyGrid.gridFor's for the sweep.
+    '''
+    if not piece:
+        return np.zeros(0, dtype='S20'), np.zeros(0, dtype=np.int64)
+    if len(piece[0]) == 3:
+        return (np.concatenate([h5file.root.sweeps._f_get_child('g{}'.format(gridID)).times[start:stop]
+                                for gridID, start, stop in piece]),
+                np.concatenate([np.full(stop - start, gridID, dtype=np.int64) for gridID, start, stop in piece]))
+    table = h5file.root.measurement.readout
+    stamps, grids = [], []
+    def addSweeps(rows, starts):
+        lengths = np.diff(np.append(starts, len(rows)))
+        stamps.append(rows['time'][starts])
+        grids.append(np.array([gridFor(rows['frequency'][start:start + length].astype(np.float64))[0].id
+                               for start, length in zip(starts, lengths)], dtype=np.int64))
+    carry = None
+    for rangeStart, rangeStop in piece:
+        for start in range(rangeStart, rangeStop, chunkRows):
+            rows = table.read(start, min(start + chunkRows, rangeStop))
+            if carry is not None:
+                rows = np.concatenate((carry, rows))
+            starts = _sweepStarts(rows)
+            carry = rows[starts[-1]:]
+            addSweeps(rows[:starts[-1]], starts[:-1])
+    if carry is not None and len(carry):
+        addSweeps(carry, _sweepStarts(carry))
+    if not stamps:
+        return np.zeros(0, dtype='S20'), np.zeros(0, dtype=np.int64)
+    return np.concatenate(stamps), np.concatenate(grids)
+
+def _partitionSweepRanges(sweepRanges, nParts):
+    '''Split stored sweep ranges into about nParts lists of ranges with similar numbers of sweeps.'''
+    total = sum(stop - start for grid, start, stop in sweepRanges)
+    size = max(1, -(-total//nParts))
+    parts = [[]]
+    room = size
+    for grid, start, stop in sweepRanges:
+        while start < stop:
+            take = min(room, stop - start)
+            parts[-1].append((grid, start, start + take))
+            start += take
+            room -= take
+            if room == 0:
+                parts.append([])
+                room = size
+    return [part for part in parts if part]
+
+def timeStampsToSeconds(times):
+    '''
+    Convert stored time stamps ("%Y:%m:%d:%H:%M:%S") to float seconds. The stamps only have 1 s
+    resolution, so sweeps which share a stamp are spread evenly over that second.
+    '''
+    import pandas as pd
+    times = np.asarray(times)
+    if len(times) == 0:
+        return np.zeros(0)
+    seconds = pd.to_datetime(pd.Series(times.astype('U20')), format="%Y:%m:%d:%H:%M:%S").to_numpy().astype('datetime64[s]').astype(np.float64)
+    groupStarts = np.concatenate(([0], np.flatnonzero(np.diff(seconds)) + 1))
+    groupSizes = np.diff(np.append(groupStarts, len(seconds)))
+    position = np.arange(len(seconds)) - np.repeat(groupStarts, groupSizes)
+    return seconds + position/np.repeat(groupSizes, groupSizes)
+
+def RetrieveBaselineData(queue=None, DB_Name="EARS_DB.h5", freqMin = 30_000_000, freqMax = 88_000_000, withSpread=False,
+                         location=None, gain=None, when=None):
     '''
     Special case of retrieval function which returns the baseline data between two freqs as list of tuples.
+    If the versioned baseline store (BaselineStore.py) has anything for this range, the best match for
+    location, gain and time of day (now, unless when is given) is used. Otherwise it's the old single sweep
+    baseline (see StoreBaselineData). With withSpread, tuples are (frequency, power, spread); single sweep
+    baselines have no spread so it comes back as nan.
     '''
     if not checkForBaselineData(DB_Name):
         #No baseline data available. Return none
         return None
+    selected = selectBaseline(freqMin, freqMax, location, gain or DEFAULT_GAIN, when, DB_Name)
+    if selected is not None:
+        freqs, power, spread, versions = selected
+        if withSpread:
+            return list(zip(freqs, power, spread))
+        return list(zip(freqs, power))
+    query = '(frequency>={}) & (frequency<={})'.format(freqMin, freqMax)
     with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+        if 'baseline' not in h5file.root or 'readout' not in h5file.root.baseline:
+            return None
         #table handles are retrieved from the file handle with the format file_handle.mount_point.group_handle.table_handle
-        table = h5file.root.baseline.readout 
-        return  [(x['frequency'], x['power']) for x in table.where('(frequency>={}) & (frequency<={})'.format(freqMin, freqMax))]
+        rows = h5file.root.baseline.readout.read_where(query)
+    data = sorted(zip(rows['frequency'], rows['power'], np.full(len(rows), np.nan)))
+    if withSpread:
+        return data
+    return [(freq, power) for freq, power, spread in data]
 
 def archiveDataBase(zipname=None, clearDB = False):
     ''' TODO
@@ -162,8 +704,8 @@ def checkForBaselineData(DB_Name="EARS_DB.h5"):
     if not os.path.isfile(DB_Name):
         #The file doesn't exist... so no baseline data
         return False
-    with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
-        return 'baseline' in str(h5file.list_nodes('/'))
+    with open_file(DB_Name, mode="r") as h5file:
+        return 'baseline' in h5file.root or 'baselines' in h5file.root
 
 def StoreBaselineData(pkt = None, queue=None, DB_Name="EARS_DB.h5"):
     '''
@@ -190,7 +732,7 @@ def StoreBaselineData(pkt = None, queue=None, DB_Name="EARS_DB.h5"):
     else:
         h5file = open_file(DB_Name, mode="a", title="EARS Measurements Record")
     #We need to delete the old baseline data if it's there. just delete the group, start clean
-    if 'baseline' in str(h5file.list_nodes('/')):
+    if 'baseline' in h5file.root:
          h5file.remove_node('/baseline', recursive=True)
     group = h5file.create_group("/", 'baseline', 'RF Power baseline information')
     table = h5file.create_table(group, 'readout', RFMeasurements, "Baseline Record")
@@ -210,4 +752,7 @@ def StoreBaselineData(pkt = None, queue=None, DB_Name="EARS_DB.h5"):
         measurement['simulated'] = pkt[2]
         measurement.append()
     table.flush()
-    h5file.close()
\ No newline at end of file
+    h5file.close()
+    #Keep a version in the baseline store as well, so it isn't lost the next time this gets overwritten
+    data = np.array(pkt[1], dtype=np.float64)
+    saveBaseline(data[:, 0], data[:, 1], time=pkt[0], simFlag=pkt[2], DB_Name=DB_Name)
\ No newline at end of file
@@ -13,86 +13,118 @@ attr:
 data more quickly
 '''
 
+import sys
 from tables import *
 import pandas as pd
-from DBManager import RetrieveBaselineData
-import numpy as np
+from DBManager import RetrieveBaselineData, checkForBaselineData
+from AnalysisRunner import runAnalysis
+from BinStatistics import StatsKernel
+from OccupancyAnalysis import ChannelPlan, OccupancyKernel
+from FrequencyGrid import gridFor, resample
 #import seaborn as sns
 import matplotlib.pyplot as plt
 #import datetime
 
-plt.ion()
-plt.style.use('dark_background')
-plt.grid(True)
+#Spawned analysis workers import this module too, so everything runs under the main guard
+if __name__ == '__main__':
+    plt.ion()
+    plt.style.use('dark_background')
+    plt.grid(True)
 
-with open_file('EARS_DB.h5', mode="a", title="EARS Measurements Record") as h5file:
-    dataTable = h5file.root.measurement.readout
-    commandTable = h5file.root.Logs.commandLog
-    baselineTable = h5file.root.baseline.readout
-    '''
-    Helpful notes:
-    faster queries (in kernel) are performed on database with the table.where function. 
-    Ex: table.where('(frequency>={}) & (frequency<={})'.format(freqMin, freqMax))
-    
-    to see all the unique session ID's in the data, use pd.unique(table.col('sessionID'))
-    this can take some time - it loads the whole column which is easily millions of rows.
-
-    It is probably much faster to query the command database to figure out what you want first. 
-    it's going to be WAY smaller, since just a few commands are sent per session and thousands
-    of RF measurements are made.
-    pd.unique(commandTable.col('sessionID'))
-    '''
-    cmd = pd.DataFrame(commandTable.read())
-    print(cmd[['command', 'time']])
-    # For our case, this is the session Id: b'2cb76486-67c4-4a44-a687-8b3057a703a4'
-    #This has a simulated constant fixed frequency signal
-    print('\n')
-    print("Using b'0f04cfdf-fe1c-4448-94e4-a89d7a48a662'")
-    print('\n')
-    data = pd.DataFrame(dataTable.read_where('''(sessionID == b'0f04cfdf-fe1c-4448-94e4-a89d7a48a662')'''))
+    with open_file('EARS_DB.h5', mode="r", title="EARS Measurements Record") as h5file:
+        commandTable = h5file.root.Logs.commandLog
+        '''
+        Helpful notes:
+        faster queries (in kernel) are performed on database with the table.where function. 
+        Ex: table.where('(frequency>={}) & (frequency<={})'.format(freqMin, freqMax))
+
+        to see all the unique session ID's in the data, use pd.unique(h5file.root.sweeps.index.col('sessionID'))
+        (sessions logged before the sweep store are in h5file.root.measurement.readout instead, and loading
+        its sessionID column can take some time - it's easily millions of rows).
+
+        It is probably much faster to query the command database to figure out what you want first. 
+        it's going to be WAY smaller, since just a few commands are sent per session and thousands
+        of RF measurements are made.
+        pd.unique(commandTable.col('sessionID'))
+        '''
+        cmd = pd.DataFrame(commandTable.read())
+        print(cmd[['command', 'time']])
+        # For our case, this is the session Id: b'2cb76486-67c4-4a44-a687-8b3057a703a4'
+        #This has a simulated constant fixed frequency signal
+        print('\n')
+        sessionID = b'0f04cfdf-fe1c-4448-94e4-a89d7a48a662'
+        print("Using {}".format(sessionID))
+        print('\n')
+
+    #Everything below is measured against the baseline
+    if not checkForBaselineData():
+        print('No baseline stored in EARS_DB.h5. Take a baseline measurement first.')
+        sys.exit(1)
+
+    #Per frequency statistics are calculated a chunk at a time, so the session never has to fit in memory.
+    #Occupancy counts sweeps more than 10 dB over the baseline. Both run in one pass over the data, with the
+    #session split between a pool of processes.
+    plan = ChannelPlan()
+    try:
+        results = runAnalysis([sessionID], [StatsKernel(aboveBaseline=10), OccupancyKernel(plan, aboveBaseline=10)])[sessionID]
+    except ValueError as e:
+        #The baseline doesn't cover the session's frequencies
+        print(e)
+        sys.exit(1)
+    stats = results['stats']
+    data = stats.summary()
     print(data)
     print('\n')
 
-#Now get the baseline data
-#Filter the baseline data to match the data we have
-blData = RetrieveBaselineData(freqMin = data['frequency'].min(), freqMax = data['frequency'].max())
-print('Baseline Data')
-bl = pd.DataFrame(blData, columns=['frequency', 'power'])
-#bl = bl.set_index('frequency')
-print(bl)
-print('\n\n')
-'''
-There are a lot of ways of looking at this data... 
-1. use a sequence of dataframes which each have one measurement. then look at how one compares to the next.
-2. transpose the data to a new type of dataframe, which has a column for each frequency bin. then 
-    I can look at how individual frequencies change at a time.
-    ~max
-    ~min
-    ~stddev
-    ~cumsum
-    ~
-3. group the measurements by frequency and look at the characteristics of the frequencies like that. 
-
-options 2 and 3 are conceptually similar but implementation very different. I think I would use
-opt 2 to think about HOW to look at the data, but implement a final solution using option 3.
-'''
-fig, ax = plt.subplots()
-data.plot(ax=ax, x='frequency', y='power')
-bl.plot(ax=ax, y='power')
-#Group data by frequency
-groupedData = data[['frequency', 'power']].groupby('frequency')
-#take the difference between the baseline data and our data
-filteredData = groupedData.max().combine(bl, np.subtract, overwrite = False)
-#interpolate between points. baseline has a lot less points then the measurement, so we end up with a lot of NANs
-filteredData = filteredData.interpolate()
-filteredData.plot(grid='on').figure.show()
-plt.pause(.1)
+    #How busy was each channel? Only show channels which were active at least 1% of the time.
+    occupancy = results['occupancy']
+    if occupancy is not None:
+        print('Channel occupancy')
+        print(occupancy.summary(plan, minOccupancy=1))
+        print('\n')
 
+    #Now get the baseline data
+    #Filter the baseline data to match the data we have
+    blData = RetrieveBaselineData(freqMin = data['frequency'].min(), freqMax = data['frequency'].max())
+    if not blData:
+        print('No baseline data between {} and {} Hz.'.format(data['frequency'].min(), data['frequency'].max()))
+        sys.exit(1)
+    print('Baseline Data')
+    bl = pd.DataFrame(blData, columns=['frequency', 'power'])
+    #bl = bl.set_index('frequency')
+    print(bl)
+    print('\n\n')
+    '''
+    There are a lot of ways of looking at this data... 
+    1. use a sequence of dataframes which each have one measurement. then look at how one compares to the next.
+    2. transpose the data to a new type of dataframe, which has a column for each frequency bin. then 
+        I can look at how individual frequencies change at a time.
+        ~max
+        ~min
+        ~stddev
+        ~cumsum
+        ~
+    3. group the measurements by frequency and look at the characteristics of the frequencies like that. 
 
+    options 2 and 3 are conceptually similar but implementation very different. I think I would use
+    opt 2 to think about HOW to look at the data, but implement a final solution using option 3.
+    '''
+    fig, ax = plt.subplots()
+    data.plot(ax=ax, x='frequency', y='max')
+    data.plot(ax=ax, x='frequency', y='mean')
+    bl.plot(ax=ax, x='frequency', y='power')
+    #take the difference between the baseline data and our max
+    #baseline has a lot less points then the measurement, so put it on the session's frequency grid
+    blSorted = bl.sort_values('frequency')
+    dataGrid, dataIndex = gridFor(data['frequency'].values)
+    blGrid, blIndex = gridFor(blSorted['frequency'].values)
+    filteredData = pd.DataFrame({'frequency': dataGrid.freqs,
+                                 'power': dataGrid.place(dataIndex, data['max'].values) - resample(blGrid.place(blIndex, blSorted['power'].values), blGrid, dataGrid)})
+    filteredData.plot(x='frequency', y='power', grid='on').figure.show()
+    plt.pause(.1)
 
 
 
-breakpoint()
 
 
-    
\ No newline at end of file
+    breakpoint()
@@ -10,11 +10,16 @@ SimWaterfallView is a clone of this module.
 '''
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
-from PyQt5.QtWidgets import QMainWindow, QAction, QMessageBox, QPushButton, QApplication, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel
+from PyQt5.QtWidgets import QMainWindow, QAction, QMessageBox, QPushButton, QApplication, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QTableWidget, QTableWidgetItem, QHeaderView
+from PyQt5.QtGui import QColor
 from PyQt5.QtCore import Qt, QTimer
 import pandas as pd
 import datetime
-from BinarySpectroViewer import *
+from BinarySpectroViewer import streamScan
+from HopTracker import drawHoppers
+from JammingDetector import drawJamming
+from PeakTracker import drawPeaks
+from PlotDecimator import PlotDecimator, ZoomPan, drawSpectrum
 from multiprocessing import Process, Queue
 
 #Imports for spectrogram
@@ -31,10 +36,48 @@ class MplCanvas(FigureCanvasQTAgg):
         super(MplCanvas, self).__init__(fig)
 
 
+class PeakTable(QTableWidget):
+    #The peak list the scan sends with every sweep (see PeakTracker.py). Click a header to sort by it,
+    #double click a peak to call onChoose with its frequency.
+    COLUMNS = ['#', 'MHz', 'dB', 'max dB', 'hits', 'first seen', 'last seen']
+
+    def __init__(self, parent=None, onChoose=None):
+        super().__init__(0, len(self.COLUMNS), parent)
+        self.setHorizontalHeaderLabels(self.COLUMNS)
+        self.verticalHeader().setVisible(False)
+        self.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.setSelectionBehavior(QTableWidget.SelectRows)
+        self.setSortingEnabled(True)
+        if onChoose is not None:
+            self.cellDoubleClicked.connect(lambda row, column: onChoose(self.item(row, 1).data(Qt.UserRole)))
+
+    def setPeaks(self, peaks):
+        # Sorting is off while the rows are filled in, or they'd move about under us. Turning it back on
+        # sorts by whatever column the user picked.
+        self.setSortingEnabled(False)
+        self.setRowCount(len(peaks))
+        for row, peak in enumerate(peaks):
+            seen = [datetime.datetime.fromtimestamp(peak[key]).strftime('%H:%M:%S') for key in ('firstSeen', 'lastSeen')]
+            values = [row + 1, round(peak['frequency']/1e6, 4), round(peak['power'], 1), round(peak['maxPower'], 1),
+                      peak['hits']] + seen
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                # Numbers go in as numbers so they sort as numbers
+                item.setData(Qt.DisplayRole, value)
+                item.setData(Qt.UserRole, peak['frequency'])
+                if not peak['live']:
+                    item.setForeground(QColor('gray'))
+                self.setItem(row, column, item)
+        self.setSortingEnabled(True)
+
+
 class EARSscanWindow(QMainWindow):
 
-    def __init__(self, cmdFreqs='30M:35M', simFlag=False, simConfig=None):
+    def __init__(self, cmdFreqs='30M:35M', simFlag=False, simConfig=None, subscription=None):
         super().__init__()
+        #With a subscription the sweeps come from the scan manager, which owns the SDR (see ScanManager.py)
+        self.subscription = subscription
         self.initUI(cmdFreqs, simFlag, simConfig)
 
     def initUI(self, cmdFreqs, simFlag, simConfig):
@@ -54,6 +97,11 @@ class EARSscanWindow(QMainWindow):
         self.axesRef = self.powerGraph.figure.axes[0]
         self.powerGraph.figure.tight_layout()
         self.updateCount = 0
+        # Sweeps are drawn from at most 2 points per pixel, see PlotDecimator.py
+        self.decimator = PlotDecimator()
+        self.lastPayload = None
+        # Scroll to zoom, drag to pan, double click for the whole range. The scan is told what's visible.
+        self.zoom = ZoomPan(self.powerGraph, self.axesRef, redraw=self.updatePlot, onChange=self.viewChanged)
         
         # call the update event This drives both the scanning calls and the graph updating
         # Set up the update function
@@ -62,15 +110,26 @@ class EARSscanWindow(QMainWindow):
         #Update interval is set in milliseconds
         self.updateTimer.setInterval(1000)
         self.updateTimer.start()
-        #Start software bus queue
-        self.SWBQueue = Queue(25)
-        # Add the graph widget which shows the moving average of the power, in decibels, of the band.
-        MainLayout.addWidget(self.powerGraph)
+        # Add the graph widget which shows the moving average of the power, in decibels, of the band,
+        # with the peak list next to it. Double clicking a peak zooms in on it.
+        self.peakTable = PeakTable(self, onChoose=lambda freq: self.zoom.setView((freq - 100e3, freq + 100e3)))
+        GraphLayout = QHBoxLayout()
+        GraphLayout.addWidget(self.powerGraph, 3)
+        GraphLayout.addWidget(self.peakTable, 1)
+        MainLayout.addLayout(GraphLayout)
         #Add a loading message to the power graph
         self.axesRef.text(0.05, .95, 'Loading data...')
-        #Start the hardware scanning process
-        self.hwScanProcess = Process(target=streamScan, args = (cmdFreqs, self.SWBQueue, simFlag, simConfig))
-        self.hwScanProcess.start()
+        if self.subscription is not None:
+            self.SWBQueue = self.subscription.queue
+            self.hwScanProcess = None
+        else:
+            #Start software bus queue
+            self.SWBQueue = Queue(25)
+            self.cmdQueue = Queue()
+            #Start the hardware scanning process
+            self.hwScanProcess = Process(target=streamScan, args = (cmdFreqs, self.SWBQueue, simFlag, simConfig, self.cmdQueue))
+            self.hwScanProcess.start()
+        self.viewChanged(None, None, self.zoom.widthPx())
 
         # Close Button setup
         self.Close_Button = QPushButton('End Scan')
@@ -100,49 +159,67 @@ class EARSscanWindow(QMainWindow):
 
         #check for an update in the queue
         if not self.SWBQueue.empty():
+            payload = self.SWBQueue.get()
+            if isinstance(payload, str):
+                #The scan ended ('Done')
+                self.statusBar().showMessage('Scan ended')
+                return
             self.updateCount += 1
             #Got data in the queue
-            df, maxDF, baseline = self.SWBQueue.get()
-            #Clear axes
-            self.axesRef.cla()
-            #Add time and number of updates annotation
-            curTime = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
-            curTimeUpdateText = 'Last update: ' + curTime
-            curUpdateText = 'Number of scans: ' + str(self.updateCount)
-            print(curUpdateText)
-            print(curTimeUpdateText)
-            self.axesRef.text(0.05, .95, curTimeUpdateText)
-            self.axesRef.text(0.05, .90, curUpdateText)
-            #Plot our data
-            maxDF.plot(ax=self.axesRef, x='freqCompare', y='power', style='y', linewidth = .5, label='max hold', grid='On', title = 'ScanView')
-            df.plot(ax=self.axesRef, x='frequency', y='power', grid='On', title = 'ScanView', label='current', alpha = .7, linewidth = .5)
-            self.axesRef.fill_between(df['frequency'], df['power'], df['power'].min(), alpha = .5)
-            baseline.plot(ax=self.axesRef, x='frequency', y='power', style='r-.', linewidth=.3, alpha = .7)
-            
-            #Draw and allow matplotlib to do plot update
-            self.powerGraph.draw()
+            self.lastPayload = payload
+            self.lastUpdate = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
+            print('Number of scans: ' + str(self.updateCount))
+            print('Last update: ' + self.lastUpdate)
+            jamming = payload[3].get('jamming')
+            if jamming and jamming['changed']:
+                self.statusBar().showMessage('JAMMING: ' + jamming['type'] if jamming['alarm'] else 'Jamming cleared')
+            self.peakTable.setPeaks(payload[3].get('peaks', []))
+            self.updatePlot()
+            #Allow matplotlib to do plot update
             matplotlib.pyplot.pause(.05)
 
-
-
     def updatePlot(self):
-        #Read in all the new data
-        pass
+        #Draw the last sweep in the current zoom. Also called while zooming and panning between sweeps.
+        if self.lastPayload is None:
+            return
+        df, maxDF, baseline, extras = self.lastPayload
+        #Clear axes
+        self.axesRef.cla()
+        #Add time and number of updates annotation
+        self.axesRef.text(0.05, .95, 'Last update: ' + self.lastUpdate, transform=self.axesRef.transAxes)
+        self.axesRef.text(0.05, .90, 'Number of scans: ' + str(self.updateCount), transform=self.axesRef.transAxes)
+        #Plot our data. A wide scan is millions of bins, so only the min/max per pixel is drawn.
+        drawSpectrum(self.axesRef, self.decimator, df, maxDF, baseline, self.zoom.view)
+        #Tracked hoppers are drawn as one emitter rather than left as noise in the max hold
+        drawHoppers(self.axesRef, extras.get('hoppers', []))
+        drawJamming(self.axesRef, extras.get('jamming'))
+        drawPeaks(self.axesRef, extras.get('peaks', []))
+        self.powerGraph.draw()
+
+    def viewChanged(self, low, high, widthPx):
+        # Only the visible range is sent at full resolution, see ScanProcessor.setView
+        if self.subscription is not None:
+            self.subscription.setView(low, high, widthPx)
+        elif getattr(self, 'cmdQueue', None) is not None:
+            self.cmdQueue.put(('VIEW', None, low, high, widthPx))
 
     def closeEvent(self, event):
         # Make sure we are gracefully ending the scan and not just leaving the process running in the background.
         # This would probably cause problems if the user then immediately tried to start another scan.
         print('gracefully closing...')
-        while not self.SWBQueue.empty():
-            print('Flushing queue...')
-            #Ensure the queue is empty before sending the command. 
-            #This ensures that this is the next item in the queue when the hw process looks.
-            flushVar = self.SWBQueue.get()
-        self.SWBQueue.put('QUIT')
+        if self.subscription is not None:
+            #The manager keeps the SDR; just stop sending to us
+            self.subscription.unsubscribe()
+            self.updateTimer.stop()
+            event.accept()
+            return
+        self.cmdQueue.put('QUIT')
         print('Closed the SWB Queue and hardware process.')
-        #self.hwScanProcess.join()
-        self.SWBQueue.get(block=True, timeout=300)
+        #Drain until the scan says it's done
+        while self.SWBQueue.get(block=True, timeout=300) != 'Done':
+            pass
         self.SWBQueue.close()
+        self.cmdQueue.close()
         self.hwScanProcess.terminate()
         print('Closed scan and queue')
         self.updateTimer.stop()
@@ -156,10 +233,10 @@ class EARSscanWindow(QMainWindow):
     pyqtRemoveInputHook()
     set_trace()
 '''
-def startScanWindow(cmdFreq = '30M:35M', simFlag = False, simConfig = None):
+def startScanWindow(cmdFreq = '30M:35M', simFlag = False, simConfig = None, subscription = None):
     import sys
     app = QApplication(sys.argv)
-    mainWindow = EARSscanWindow(cmdFreq, simFlag, simConfig)
+    mainWindow = EARSscanWindow(cmdFreq, simFlag, simConfig, subscription)
     #Start the application
     sys.exit(app.exec_())
 
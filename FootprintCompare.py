@@ -0,0 +1,317 @@
+'''
+RF footprint comparison between sessions, or between a session and the baseline.
+
+What did we give off (or what was around us) on Tuesday that wasn't there on Monday? Every session is
+boiled down once to a footprint: per bin sweep count, mean, standard deviation, max and occupancy (the
+fraction of sweeps over the baseline plus a margin, or over an absolute threshold). Footprints are made
+with the parallel AnalysisRunner and saved in the EARS database under /footprint/<session>, so after the
+first time comparing two overnight sessions only reads a few arrays per session.
+
+Two footprints are put on a common grid (the range they both cover, at the finer of their steps) and
+compared bin by bin:
+    ~delta          - change of mean power (dB)
+    ~maxDelta       - change of max hold (dB)
+    ~zScore         - delta over its standard error (Welch). Sweeps aren't independent, so this is only
+                      a guide; a bin counts as significant if |zScore| >= zThreshold AND |delta| >= minDelta.
+    ~occupancyDelta - change of occupancy
+Emitters are runs of bins occupied at least minOccupancy of the time. An emitter in the other session
+with nothing occupied under it in the reference is new, one in the reference with nothing under it in
+the other session is gone, and one in both whose max changed by minDelta or more has changed. The same
+numbers are rolled up per band.
+
+    diffs = compareSessions([monday, tuesday])          #or compareSessions([tuesday], baseline=True)
+    diffs[0].emitters()                                  #new/gone/changed emitters
+    diffs[0].bands()                                     #one row per band
+    plotDiff(diffs)                                      #the diff view
+
+    python FootprintCompare.py <reference session> <session> ... [--baseline] [--db EARS_DB.h5]
+'''
+
+import numpy as np
+import pandas as pd
+from tables import open_file, Filters
+from DBManager import getSessionSweepRanges, RetrieveBaselineData
+from FrequencyGrid import FrequencyGrid, registerGrid, gridFor, resample, saveGrid, loadGrid
+from SpectrumPyramid import sessionNodeName
+from OccupancyAnalysis import DEFAULT_BANDS
+
+class Footprint():
+    '''
+    Per bin summary of a session on its grid. nSweeps is None for the baseline, whose mean is taken as
+    known. occupancy is a fraction (0-1), NaN where there was no threshold.
+    '''
+    def __init__(self, label, grid, nSweeps, mean, std, maxHold, occupancy):
+        self.label = label
+        self.grid = grid
+        self.nSweeps = nSweeps
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.max = np.asarray(maxHold, dtype=np.float64)
+        self.occupancy = np.asarray(occupancy, dtype=np.float64)
+
+    @classmethod
+    def fromStats(cls, label, stats):
+        '''From a BinStats'''
+        grid, index = gridFor(stats.freqs)
+        values = [grid.place(index, v) for v in (stats.mean, stats.std(), stats.max, stats.occupancy())]
+        return cls(label, grid, stats.nSweeps, *values)
+
+    def onGrid(self, grid):
+        '''This footprint interpolated onto another grid'''
+        values = [resample(v, self.grid, grid) for v in (self.mean, self.std, self.max, self.occupancy)]
+        return Footprint(self.label, grid, self.nSweeps, *values)
+
+    def stdError(self):
+        '''Standard error of the mean of each bin, 0 for the baseline'''
+        if self.nSweeps is None:
+            return np.zeros(self.grid.count)
+        return np.nan_to_num(self.std)/np.sqrt(max(self.nSweeps, 1))
+
+    def save(self, h5file, node, settings):
+        '''Store under /footprint/<node> of an open database, replacing what's there'''
+        if 'footprint' not in h5file.root:
+            h5file.create_group('/', 'footprint', 'Per session RF footprints')
+        if node in h5file.root.footprint:
+            h5file.remove_node(h5file.root.footprint, node, recursive=True)
+        saveGrid(h5file, self.grid)
+        group = h5file.create_group(h5file.root.footprint, node, 'Footprint of {}'.format(self.label))
+        filters = Filters(complevel=1, complib='zlib', shuffle=True)
+        for name in ('mean', 'std', 'max', 'occupancy'):
+            h5file.create_carray(group, name, obj=getattr(self, name).astype(np.float32), filters=filters)
+        group._v_attrs.gridID = self.grid.id
+        group._v_attrs.nSweeps = self.nSweeps
+        group._v_attrs.settings = settings
+
+    @classmethod
+    def load(cls, h5file, node, label):
+        '''(footprint, settings) from /footprint/<node>, or None if it isn't stored'''
+        if 'footprint' not in h5file.root or node not in h5file.root.footprint:
+            return None
+        group = h5file.root.footprint._f_get_child(node)
+        attrs = group._v_attrs
+        grid = loadGrid(h5file, int(attrs.gridID))
+        return cls(label, grid, int(attrs.nSweeps), group.mean.read(), group.std.read(), group.max.read(),
+                   group.occupancy.read()), attrs.settings
+
+
+def _label(sessionID):
+    return sessionID.decode() if isinstance(sessionID, bytes) else str(sessionID)
+
+def sessionFootprints(sessionIDs, DB_Name="EARS_DB.h5", threshold=None, aboveBaseline=10, rebuild=False, workers=None):
+    '''
+    Footprint of each session, in order. Stored footprints are used if they were made with the same
+    threshold settings and (for sessions in the sweep store) the session hasn't grown since. The rest
+    are made in one parallel pass and stored.
+    '''
+    from AnalysisRunner import runAnalysis, mainGrid
+    from BinStatistics import StatsKernel
+    settings = 'threshold={} aboveBaseline={}'.format(threshold, aboveBaseline)
+    found = {}
+    with open_file(DB_Name, mode="r", title="EARS Measurements Record") as h5file:
+        for sessionID in sessionIDs:
+            stored = None if rebuild else Footprint.load(h5file, sessionNodeName(sessionID), _label(sessionID))
+            if stored is None or stored[1] != settings:
+                continue
+            #The footprint only covers the session's main grid, the one runAnalysis picks
+            sweepRanges = getSessionSweepRanges(sessionID, DB_Name, h5file)
+            if not sweepRanges or mainGrid(sweepRanges) == (stored[0].grid.id, stored[0].nSweeps):
+                found[sessionID] = stored[0]
+    missing = [sessionID for sessionID in sessionIDs if sessionID not in found]
+    if missing:
+        print('Making footprints for {} sessions'.format(len(missing)))
+        results = runAnalysis(missing, [StatsKernel(threshold, aboveBaseline, percentiles=False)], DB_Name, workers)
+        with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+            for sessionID in missing:
+                stats = results[sessionID]['stats']
+                if stats is None:
+                    raise ValueError('Session {} has no sweeps'.format(_label(sessionID)))
+                found[sessionID] = Footprint.fromStats(_label(sessionID), stats)
+                found[sessionID].save(h5file, sessionNodeName(sessionID), settings)
+    return [found[sessionID] for sessionID in sessionIDs]
+
+def baselineFootprint(freqLow, freqHigh, DB_Name="EARS_DB.h5", **kwargs):
+    '''The baseline between two frequencies as a footprint. kwargs pick the baseline version (see RetrieveBaselineData).'''
+    data = RetrieveBaselineData(DB_Name=DB_Name, freqMin=freqLow, freqMax=freqHigh, withSpread=True, **kwargs)
+    if not data:
+        raise ValueError('No baseline data available between {} and {} Hz'.format(freqLow, freqHigh))
+    data = np.array(data, dtype=np.float64)
+    grid, index = gridFor(data[:, 0])
+    power = grid.place(index, data[:, 1])
+    spread = grid.place(index, np.nan_to_num(data[:, 2]))
+    #Nothing is active in the baseline by definition
+    return Footprint('baseline', grid, None, power, spread, power, np.zeros(grid.count))
+
+def commonGrid(footprints):
+    '''Grid over the range every footprint covers, at the finest step among them'''
+    low = max(f.grid.start for f in footprints)
+    high = min(f.grid.stop for f in footprints)
+    if high < low:
+        raise ValueError('The footprints have no frequencies in common')
+    step = min(f.grid.step for f in footprints if f.grid.step > 0)
+    return registerGrid(FrequencyGrid(low, step, int(np.floor((high - low)/step + 1e-9)) + 1))
+
+def _runs(mask):
+    '''(starts, stops) of the runs of True in mask'''
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+class FootprintDiff():
+    '''Comparison of other against reference on their common grid'''
+    def __init__(self, reference, other, minDelta=3.0, zThreshold=5.0, minOccupancy=.05):
+        grid = commonGrid([reference, other])
+        self.grid = grid
+        self.freqs = grid.freqs
+        self.reference = reference.onGrid(grid)
+        self.other = other.onGrid(grid)
+        self.minDelta = minDelta
+        self.minOccupancy = minOccupancy
+        self.delta = self.other.mean - self.reference.mean
+        self.maxDelta = self.other.max - self.reference.max
+        self.occupancyDelta = self.other.occupancy - self.reference.occupancy
+        error = np.sqrt(self.reference.stdError()**2 + self.other.stdError()**2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.zScore = np.where(error > 0, self.delta/error, np.sign(self.delta)*np.inf)
+        self.significant = (np.abs(self.zScore) >= zThreshold) & (np.abs(self.delta) >= minDelta)
+
+    def __repr__(self):
+        return 'FootprintDiff({} -> {})'.format(self.reference.label, self.other.label)
+
+    def _present(self, footprint):
+        return np.nan_to_num(footprint.occupancy) >= self.minOccupancy
+
+    def bins(self, significantOnly=False):
+        '''Per bin table'''
+        result = pd.DataFrame({'frequency': self.freqs, 'refMean': self.reference.mean, 'mean': self.other.mean,
+                               'delta': self.delta, 'maxDelta': self.maxDelta, 'zScore': self.zScore,
+                               'refOccupancy': self.reference.occupancy, 'occupancy': self.other.occupancy,
+                               'occupancyDelta': self.occupancyDelta, 'significant': self.significant})
+        return result[result['significant']].reset_index(drop=True) if significantOnly else result
+
+    def emitters(self, statuses=('new', 'gone', 'changed')):
+        '''
+        One row per emitter: status (new, gone, changed or steady), its frequency range, the frequency
+        of its peak, and its peak and occupancy in each footprint.
+        '''
+        refPresent, present = self._present(self.reference), self._present(self.other)
+        rows = []
+        for mask, against, fromOther in ((present, refPresent, True), (refPresent, present, False)):
+            footprint = self.other if fromOther else self.reference
+            for start, stop in zip(*_runs(mask)):
+                if not against[start:stop].any():
+                    status = 'new' if fromOther else 'gone'
+                elif not fromOther:
+                    #Emitters in both are reported once, from the other session's side
+                    continue
+                else:
+                    status = 'changed' if np.abs(self.maxDelta[start:stop]).max() >= self.minDelta else 'steady'
+                if status not in statuses:
+                    continue
+                peak = start + int(np.argmax(footprint.max[start:stop]))
+                rows.append({'status': status, 'freqLow': self.freqs[start], 'freqHigh': self.freqs[stop - 1],
+                             'peakFrequency': self.freqs[peak], 'refPeak': self.reference.max[start:stop].max(),
+                             'peak': self.other.max[start:stop].max(),
+                             'refOccupancy': np.nanmax(self.reference.occupancy[start:stop]),
+                             'occupancy': np.nanmax(self.other.occupancy[start:stop])})
+        columns = ['status', 'freqLow', 'freqHigh', 'peakFrequency', 'refPeak', 'peak', 'refOccupancy', 'occupancy']
+        result = pd.DataFrame(rows, columns=columns)
+        result['peakDelta'] = result['peak'] - result['refPeak']
+        return result.sort_values('freqLow').reset_index(drop=True)
+
+    def bands(self, bands=DEFAULT_BANDS):
+        '''Per band roll up. bands are (lowHz, highHz, ...), like the channel plan.'''
+        emitters = self.emitters()
+        refPresent, present = self._present(self.reference), self._present(self.other)
+        rows = []
+        for band in bands:
+            low, high = band[0], band[1]
+            first, stop = self.grid.binRange(low, high)
+            if first >= stop:
+                continue
+            inBand = (emitters['peakFrequency'] >= low) & (emitters['peakFrequency'] <= high)
+            rows.append({'freqLow': low, 'freqHigh': high, 'bins': stop - first,
+                         'meanDelta': self.delta[first:stop].mean(),
+                         'peakDelta': self.other.max[first:stop].max() - self.reference.max[first:stop].max(),
+                         'refOccupied': refPresent[first:stop].mean(), 'occupied': present[first:stop].mean(),
+                         'significantBins': int(self.significant[first:stop].sum()),
+                         'new': int((inBand & (emitters['status'] == 'new')).sum()),
+                         'gone': int((inBand & (emitters['status'] == 'gone')).sum()),
+                         'changed': int((inBand & (emitters['status'] == 'changed')).sum())})
+        return pd.DataFrame(rows)
+
+
+def compareFootprints(footprints, **kwargs):
+    '''Compare every footprint after the first against the first. kwargs go to FootprintDiff.'''
+    if len(footprints) < 2:
+        raise ValueError('Need a reference and at least one footprint to compare with it')
+    return [FootprintDiff(footprints[0], other, **kwargs) for other in footprints[1:]]
+
+def compareSessions(sessionIDs, DB_Name="EARS_DB.h5", baseline=False, threshold=None, aboveBaseline=10,
+                    rebuild=False, workers=None, **kwargs):
+    '''
+    Compare sessions against the first one, or with baseline=True every session against the baseline.
+    Returns a list of FootprintDiff.
+    '''
+    footprints = sessionFootprints(sessionIDs, DB_Name, threshold, aboveBaseline, rebuild, workers)
+    if baseline:
+        grid = commonGrid(footprints)
+        footprints = [baselineFootprint(grid.start, grid.stop, DB_Name)] + footprints
+    return compareFootprints(footprints, **kwargs)
+
+def plotDiff(diffs, fig=None):
+    '''
+    Diff view. Top: reference and compared mean spectra, with the max holds faint. Bottom: the change of
+    mean power, significant bins marked, and new (green) and gone (red) emitters shaded.
+    '''
+    import matplotlib.pyplot as plt
+    if isinstance(diffs, FootprintDiff):
+        diffs = [diffs]
+    if fig is None:
+        fig = plt.figure()
+    fig.clear()
+    top, bottom = fig.subplots(2, 1, sharex=True)
+    reference = diffs[0].reference
+    line, = top.plot(diffs[0].freqs/1e6, reference.mean, label='{} mean'.format(reference.label))
+    top.plot(diffs[0].freqs/1e6, reference.max, color=line.get_color(), alpha=.3)
+    for diff in diffs:
+        line, = top.plot(diff.freqs/1e6, diff.other.mean, label='{} mean'.format(diff.other.label))
+        top.plot(diff.freqs/1e6, diff.other.max, color=line.get_color(), alpha=.3)
+        bottom.plot(diff.freqs/1e6, diff.delta, color=line.get_color(), label=diff.other.label)
+        bottom.plot(diff.freqs[diff.significant]/1e6, diff.delta[diff.significant], '.', color=line.get_color())
+        for _, emitter in diff.emitters(('new', 'gone')).iterrows():
+            bottom.axvspan(emitter['freqLow']/1e6, emitter['freqHigh']/1e6, alpha=.3,
+                           color='g' if emitter['status'] == 'new' else 'r')
+    bottom.axhline(0, color='grey', linewidth=.5)
+    top.set_ylabel('Power (dB)')
+    bottom.set_ylabel('Change (dB)')
+    bottom.set_xlabel('Frequency (MHz)')
+    top.legend(loc='upper right')
+    top.grid(True)
+    bottom.grid(True)
+    return fig
+
+
+if __name__ == '__main__':
+    import argparse
+    import matplotlib.pyplot as plt
+    parser = argparse.ArgumentParser(description='Compare the RF footprint of sessions')
+    parser.add_argument('sessions', nargs='+', help='Session IDs. The first is the reference unless --baseline.')
+    parser.add_argument('--db', default='EARS_DB.h5')
+    parser.add_argument('--baseline', action='store_true', help='Compare every session against the baseline')
+    parser.add_argument('--threshold', type=float, default=None, help='Absolute occupancy threshold (dB)')
+    parser.add_argument('--above-baseline', type=float, default=10, help='Occupancy threshold over the baseline (dB)')
+    parser.add_argument('--min-delta', type=float, default=3.0, help='Smallest change that counts (dB)')
+    parser.add_argument('--rebuild', action='store_true', help='Remake stored footprints')
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args()
+    diffs = compareSessions([s.encode() for s in args.sessions], args.db, args.baseline, args.threshold,
+                            args.above_baseline, args.rebuild, minDelta=args.min_delta)
+    for diff in diffs:
+        print('{} -> {}'.format(diff.reference.label, diff.other.label))
+        print(diff.bands())
+        print(diff.emitters())
+        print('\n')
+    if not args.no_plot:
+        plt.style.use('dark_background')
+        plotDiff(diffs)
+        plt.show()
@@ -0,0 +1,237 @@
+'''
+Compact binary frames for live spectrum data, for the scan daemon's viewers and anything else that needs
+sweeps sent between processes or over the network. A pickled DataFrame of a Full Scan sweep is several MB.
+
+Frame = 64 byte header + payload.
+
+Header (big endian):
+    magic 'EF', version, flags, session (16 byte UUID), sequence number, timestamp (unix seconds, double),
+    frequency grid id, number of bins, first frequency, last frequency, scale, offset
+Flags:
+    bit 0     - 16 bit values (otherwise 8 bit)
+    bit 1     - delta frame (otherwise keyframe)
+    bits 2-3  - compression: 0 none, 1 zlib, 2 lz4 (needs the lz4 package)
+    bit 4     - sparse frame: only some bins of the grid (ex. a sweep cut down to what a viewer shows,
+                see PlotDecimator.reduceForView). Always a keyframe.
+
+Payload: power quantized to unsigned 8 or 16 bit steps, power = offset + scale*value. A keyframe picks
+its scale and offset to fit the sweep (never finer than the resolution asked for). Delta frames reuse the
+last keyframe's scale and offset and store value - previous value, wrapping around, so mostly unchanged
+sweeps (max hold especially) turn into runs of zeros that compress to almost nothing. The encoder falls
+back to a keyframe whenever the grid changes, a sweep goes outside the keyframe's range, every
+keyframeInterval frames, or when asked with forceKeyframe() (ex. a new viewer joined).
+
+A sparse frame's payload is the number of values (uint32), the bin of each value on the header's grid
+(uint32, stored as the difference from the one before so it compresses), then the values.
+
+The decoder keeps the previous frame too. If it misses a frame (sequence gap) it returns None for delta
+frames until the next keyframe.
+
+Run this file for a benchmark against pickled DataFrames.
+'''
+
+import struct
+import time
+import zlib
+import uuid
+import numpy as np
+from FrequencyGrid import FrequencyGrid
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+MAGIC = b'EF'
+VERSION = 1
+HEADER = struct.Struct('>2sBB16sIdIIddff')
+FLAG_16BIT = 1
+FLAG_DELTA = 2
+FLAG_SPARSE = 16
+COMPRESSION = {'none': 0, 'zlib': 1, 'lz4': 2}
+
+def gridID(freqLow, freqHigh, nBins):
+    '''Id of the evenly spaced grid from freqLow to freqHigh, the same as FrequencyGrid's id for it.'''
+    return FrequencyGrid(freqLow, (freqHigh - freqLow)/(nBins - 1) if nBins > 1 else 0.0, nBins).id
+
+def _compress(data, codec, level):
+    if codec == 1:
+        return zlib.compress(data, level)
+    if codec == 2:
+        return lz4frame.compress(data)
+    return data
+
+def _decompress(data, codec):
+    if codec == 1:
+        return zlib.decompress(data)
+    if codec == 2:
+        if lz4frame is None:
+            raise ImportError('Frame is lz4 compressed but the lz4 package is not installed')
+        return lz4frame.decompress(data)
+    return data
+
+
+class FrameEncoder():
+    '''
+    Stateful encoder for one stream of sweeps.
+    :param bits: 8 or 16
+    :param resolution: finest dB step to quantize to. Defaults to .5 dB for 8 bit, .01 dB for 16 bit.
+    :param compression: 'zlib', 'lz4' or 'none'
+    '''
+    def __init__(self, session=None, bits=8, resolution=None, delta=True, keyframeInterval=50, compression='zlib', level=1):
+        if bits not in (8, 16):
+            raise ValueError('bits must be 8 or 16')
+        if compression == 'lz4' and lz4frame is None:
+            raise ImportError('lz4 compression needs the lz4 package (pip install lz4)')
+        #session is a UUID, as a string (DBManager.sessionID), its bytes, or None for a new one
+        if session is None:
+            session = uuid.uuid4()
+        elif isinstance(session, bytes) and len(session) == 16:
+            session = uuid.UUID(bytes=session)
+        else:
+            session = uuid.UUID(session.decode() if isinstance(session, bytes) else str(session))
+        self.session = session.bytes
+        self.dtype = np.uint8 if bits == 8 else np.uint16
+        self.maxLevel = np.iinfo(self.dtype).max
+        self.resolution = resolution or (.5 if bits == 8 else .01)
+        self.delta = delta
+        self.keyframeInterval = keyframeInterval
+        self.codec = COMPRESSION[compression]
+        self.level = level
+        self.seq = 0
+        self.prev = None
+        self.sinceKeyframe = 0
+
+    def forceKeyframe(self):
+        self.prev = None
+
+    def encode(self, freqs, power, timestamp=None):
+        freqs = np.asarray(freqs)
+        power = np.asarray(power, dtype=np.float64)
+        timestamp = time.time() if timestamp is None else timestamp
+        grid = (float(freqs[0]), float(freqs[-1]), len(freqs))
+        flags = FLAG_16BIT if self.dtype == np.uint16 else 0
+        values = None
+        if self.delta and self.prev is not None and grid == self.grid and self.sinceKeyframe < self.keyframeInterval:
+            values = np.round((power - self.offset)/self.scale)
+            if values.min() < 0 or values.max() > self.maxLevel:
+                #Outside what the keyframe can represent
+                values = None
+        if values is None:
+            #Keyframe: fit the scale and offset to this sweep
+            low, high = power.min(), power.max()
+            self.offset = np.float32(low)
+            self.scale = np.float32(max(self.resolution, (high - low)/self.maxLevel))
+            values = np.clip(np.round((power - self.offset)/self.scale), 0, self.maxLevel).astype(self.dtype)
+            payload = values
+            self.grid = grid
+            self.sinceKeyframe = 0
+        else:
+            values = values.astype(self.dtype)
+            payload = values - self.prev #Wraps around, the decoder wraps it back
+            flags |= FLAG_DELTA
+            self.sinceKeyframe += 1
+        self.prev = values
+        return self._frame(flags, timestamp, grid, payload.astype(payload.dtype.newbyteorder('<')).tobytes())
+
+    def encodeSparse(self, freqs, bins, power, timestamp=None):
+        '''
+        Sparse frame of power at bins of the sweep grid freqs. Always a keyframe, and the next encode()
+        is one too.
+        '''
+        freqs = np.asarray(freqs)
+        bins = np.asarray(bins, dtype=np.uint32)
+        power = np.asarray(power, dtype=np.float64)
+        timestamp = time.time() if timestamp is None else timestamp
+        flags = (FLAG_16BIT if self.dtype == np.uint16 else 0) | FLAG_SPARSE
+        low, high = (power.min(), power.max()) if len(power) else (0, 0)
+        self.offset = np.float32(low)
+        self.scale = np.float32(max(self.resolution, (high - low)/self.maxLevel))
+        values = np.clip(np.round((power - self.offset)/self.scale), 0, self.maxLevel).astype(self.dtype)
+        self.prev = None
+        payload = (struct.pack('<I', len(bins)) + np.diff(bins, prepend=np.uint32(0)).astype('<u4').tobytes()
+                   + values.astype(values.dtype.newbyteorder('<')).tobytes())
+        return self._frame(flags, timestamp, (float(freqs[0]), float(freqs[-1]), len(freqs)), payload)
+
+    def _frame(self, flags, timestamp, grid, payload):
+        flags |= self.codec << 2
+        self.seq += 1
+        header = HEADER.pack(MAGIC, VERSION, flags, self.session, self.seq, timestamp,
+                             gridID(*grid), grid[2], grid[0], grid[1], self.scale, self.offset)
+        return header + _compress(payload, self.codec, self.level)
+
+
+class FrameDecoder():
+    '''Stateful decoder for one stream. decode() returns a dict, or None while waiting for a keyframe.'''
+    def __init__(self):
+        self.prev = None
+        self.seq = None
+
+    def decode(self, frame):
+        magic, version, flags, session, seq, timestamp, grid, nBins, freqLow, freqHigh, scale, offset = HEADER.unpack_from(frame)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not an EARS frame (or an unsupported version)')
+        dtype = np.dtype('<u2' if flags & FLAG_16BIT else '<u1')
+        payload = _decompress(frame[HEADER.size:], (flags >> 2) & 3)
+        freqs = np.linspace(freqLow, freqHigh, nBins)
+        if flags & FLAG_SPARSE:
+            count, = struct.unpack_from('<I', payload)
+            bins = np.cumsum(np.frombuffer(payload, dtype='<u4', count=count, offset=4), dtype=np.int64)
+            values = np.frombuffer(payload, dtype=dtype, offset=4 + 4*count)
+            #Delta frames can't follow a sparse one
+            self.prev = None
+            self.seq = seq
+            return {'session': str(uuid.UUID(bytes=session)), 'seq': seq, 'time': timestamp, 'gridID': grid,
+                    'keyframe': True, 'freqs': freqs[bins], 'power': offset + scale*values.astype(np.float32)}
+        values = np.frombuffer(payload, dtype=dtype)
+        if flags & FLAG_DELTA:
+            if self.prev is None or self.seq is None or seq != self.seq + 1 or len(self.prev) != nBins:
+                #Missed something, can't rebuild this one
+                self.prev = None
+                return None
+            values = self.prev + values
+        self.prev = values
+        self.seq = seq
+        return {'session': str(uuid.UUID(bytes=session)), 'seq': seq, 'time': timestamp, 'gridID': grid,
+                'keyframe': not flags & FLAG_DELTA,
+                'freqs': freqs,
+                'power': offset + scale*values.astype(np.float32)}
+
+
+def benchmark(nSweeps=20, freqRange=(30_000_000, 1_700_000_000)):
+    '''Frame sizes and encode/decode times against a pickled DataFrame, on a simulated Full Scan.'''
+    import pickle
+    import pandas as pd
+    from Calibration import simulateSweep
+    rng = np.random.default_rng(0)
+    freqs, floor = simulateSweep(*freqRange, rng=rng)
+    #A few fixed emitters on top of the noise
+    floor[rng.integers(0, len(freqs), 40)] += 40
+    live = [floor + rng.normal(0, 1.5, len(freqs)) for i in range(nSweeps)]
+    maxHold = np.maximum.accumulate(live, axis=0)
+    df = pd.DataFrame({'frequency': freqs, 'power': live[0]})
+    print('{} bins per sweep. Pickled DataFrame: {:.0f} KB'.format(len(freqs), len(pickle.dumps(df))/1024))
+    configs = [('int8 zlib', {}), ('int8 zlib, no delta', {'delta': False}), ('int16 zlib', {'bits': 16}),
+               ('int8 none', {'compression': 'none'})]
+    if lz4frame is not None:
+        configs.append(('int8 lz4', {'compression': 'lz4'}))
+    print('{:22s} {:>12s} {:>12s} {:>10s} {:>10s} {:>10s}'.format('', 'live KB', 'maxhold KB', 'enc ms', 'dec ms', 'err dB'))
+    for name, options in configs:
+        sizes = []
+        for sweeps in (live, maxHold):
+            encoder = FrameEncoder(**options)
+            frames = [encoder.encode(freqs, sweep) for sweep in sweeps]
+            sizes.append(np.mean([len(frame) for frame in frames[1:]])/1024)
+        start = time.perf_counter()
+        encoder = FrameEncoder(**options)
+        frames = [encoder.encode(freqs, sweep) for sweep in live]
+        encodeTime = (time.perf_counter() - start)/nSweeps*1000
+        start = time.perf_counter()
+        decoded = [decoder.decode(frame) for decoder in [FrameDecoder()] for frame in frames]
+        decodeTime = (time.perf_counter() - start)/nSweeps*1000
+        error = max(np.abs(d['power'] - sweep).max() for d, sweep in zip(decoded, live))
+        print('{:22s} {:12.1f} {:12.1f} {:10.2f} {:10.2f} {:10.3f}'.format(name, sizes[0], sizes[1], encodeTime, decodeTime, error))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,189 @@
+'''
+Frequency grids. A grid is (start, step, count): bin i is at start + i*step Hz. Everything that holds
+a sweep's worth of numbers (live max hold, the sweep store in the database, pyramids, baselines) can
+say which grid it's on with the grid's integer id, and address bins by index instead of carrying a
+float frequency for every value.
+
+    grid, index = gridFor(freqs)        #Fit (or look up) the grid a sweep is on
+    row = grid.place(index, power)      #The sweep as one value per grid bin
+    other = resample(row, grid, baselineGrid)
+
+The id is a crc32 of (start, step, count), so it's the same in every process and across runs, and it's
+what the frame protocol carries (FrameProtocol.gridID).
+
+rtl_power_fftw's bins aren't always exactly evenly spaced across hops. gridFor() fits the grid from the
+median bin spacing and snaps each frequency to the nearest bin (never more than half a step away).
+Bins no frequency landed on are filled in from their neighbours by place().
+
+Mapping between two grids (nearest bin, or linear interpolation) is worked out once per pair of grids
+and cached, so lining up a sweep with the max hold or the baseline is just fancy indexing.
+
+Grids are registered per process (registerGrid/getGrid) and saved to the /grids table of the EARS
+database by saveGrid(), so a stored grid id can be turned back into frequencies with loadGrid().
+'''
+
+import struct
+import zlib
+import numpy as np
+
+
+class FrequencyGrid():
+    def __init__(self, start, step, count):
+        self.start = float(start)
+        self.step = float(step)
+        self.count = int(count)
+        self.id = zlib.crc32(struct.pack('>ddQ', self.start, self.step, self.count))
+        self._freqs = None
+
+    def __repr__(self):
+        return 'FrequencyGrid({}, {}, {}) id {}'.format(self.start, self.step, self.count, self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, FrequencyGrid) and self.id == other.id
+
+    def __hash__(self):
+        return self.id
+
+    @property
+    def stop(self):
+        '''Frequency of the last bin'''
+        return self.start + self.step*(self.count - 1)
+
+    @property
+    def freqs(self):
+        if self._freqs is None:
+            self._freqs = self.start + self.step*np.arange(self.count)
+            self._freqs.setflags(write=False)
+        return self._freqs
+
+    def indexOf(self, freqs):
+        '''Nearest bin of each frequency. Can be outside [0, count).'''
+        if self.step == 0:
+            return np.zeros(len(freqs), dtype=np.int64)
+        return np.rint((np.asarray(freqs, dtype=np.float64) - self.start)/self.step).astype(np.int64)
+
+    def binRange(self, freqLow, freqHigh):
+        '''(first, stop) bins inside [freqLow, freqHigh], clipped to the grid'''
+        if self.step == 0:
+            return 0, self.count
+        first = max(0, int(np.ceil((freqLow - self.start)/self.step - 1e-9)))
+        stop = min(self.count, int(np.floor((freqHigh - self.start)/self.step + 1e-9)) + 1)
+        return first, max(first, stop)
+
+    def place(self, index, values):
+        '''
+        values (from gridFor's index) as one float32 per bin. Bins hit twice keep the larger value, and
+        bins nothing landed on are interpolated from their neighbours.
+        '''
+        values = np.asarray(values, dtype=np.float32)
+        if index is None:
+            return values
+        row = np.full(self.count, np.nan, dtype=np.float32)
+        np.fmax.at(row, index, values)
+        holes = np.isnan(row)
+        if holes.any():
+            filled = np.flatnonzero(~holes)
+            row[holes] = np.interp(np.flatnonzero(holes), filled, row[filled])
+        return row
+
+
+#Registry of grids seen by this process, and caches keyed on grid ids
+_grids = {}
+_fits = {}
+_maps = {}
+
+def registerGrid(grid):
+    '''The registered grid with grid's id, registering it if it's new. Registered grids share their caches.'''
+    return _grids.setdefault(grid.id, grid)
+
+def getGrid(gridID):
+    '''A grid registered in this process (see loadGrid for grids stored in the database)'''
+    return _grids[gridID]
+
+def gridFor(freqs, tolerance=.05):
+    '''
+    (grid, index) for a sweep's frequencies. index is None when the sweep is exactly on the grid, else
+    the bin of each frequency, for grid.place(). Repeated sweeps with the same first and last frequency
+    and length reuse the first fit.
+    '''
+    freqs = np.asarray(freqs, dtype=np.float64)
+    key = (freqs[0], freqs[-1], len(freqs))
+    fit = _fits.get(key)
+    if fit is not None:
+        return fit
+    n = len(freqs)
+    step = (freqs[-1] - freqs[0])/(n - 1) if n > 1 else 0.0
+    grid = FrequencyGrid(freqs[0], step, n)
+    index = None
+    if step == 0 or np.abs(freqs - grid.freqs).max() > tolerance*step:
+        #Not evenly spaced. Use the typical spacing and snap every frequency to its nearest bin.
+        step = float(np.median(np.diff(freqs)))
+        grid = FrequencyGrid(freqs[0], step, int(np.rint((freqs[-1] - freqs[0])/step)) + 1) if step > 0 else FrequencyGrid(freqs[0], 0, 1)
+        index = grid.indexOf(freqs)
+    fit = (registerGrid(grid), index)
+    _fits[key] = fit
+    return fit
+
+def indexMap(src, dst):
+    '''For each bin of src, the nearest bin of dst, or -1 where src is outside dst. Cached per pair.'''
+    key = ('nearest', src.id, dst.id)
+    if key not in _maps:
+        index = dst.indexOf(src.freqs)
+        index[(index < 0) | (index >= dst.count)] = -1
+        _maps[key] = index
+    return _maps[key]
+
+def interpMap(src, dst):
+    '''(lower, upper, weight) to linearly interpolate values on src onto the bins of dst. Cached per pair.'''
+    key = ('linear', src.id, dst.id)
+    if key not in _maps:
+        if src.step == 0 or src.count < 2:
+            lower = np.zeros(dst.count, dtype=np.int64)
+            weight = np.zeros(dst.count, dtype=np.float32)
+        else:
+            position = np.clip((dst.freqs - src.start)/src.step, 0, src.count - 1)
+            lower = np.minimum(position.astype(np.int64), src.count - 2)
+            weight = (position - lower).astype(np.float32)
+        _maps[key] = (lower, np.minimum(lower + 1, src.count - 1), weight)
+    return _maps[key]
+
+def resample(values, src, dst, how='linear'):
+    '''
+    values on grid src, moved onto grid dst. 'linear' interpolates (holding the end values outside src),
+    'nearest' takes the nearest src bin and leaves NaN where dst is outside src. values can be a
+    (sweeps x bins) matrix.
+    '''
+    values = np.asarray(values)
+    if src.id == dst.id:
+        return values
+    if how == 'nearest':
+        index = indexMap(dst, src)
+        out = np.full(values.shape[:-1] + (dst.count,), np.nan, dtype=np.float32)
+        inside = index >= 0
+        out[..., inside] = values[..., index[inside]]
+        return out
+    lower, upper, weight = interpMap(src, dst)
+    return values[..., lower]*(1 - weight) + values[..., upper]*weight
+
+def saveGrid(h5file, grid):
+    '''Record a grid in the /grids table of an open EARS database, if it isn't there already.'''
+    if 'grids' not in h5file.root:
+        #pytables is only needed here, so viewers can use grids without it
+        from tables import UInt32Col, Float64Col, Int64Col
+        h5file.create_table('/', 'grids', {'gridID': UInt32Col(pos=0), 'start': Float64Col(pos=1), 'step': Float64Col(pos=2),
+                                           'count': Int64Col(pos=3)}, 'Frequency grids by id')
+    table = h5file.root.grids
+    if not len(table.get_where_list('gridID == gid', {'gid': np.uint32(grid.id)})):
+        table.append([(grid.id, grid.start, grid.step, grid.count)])
+        table.flush()
+
+def loadGrid(h5file, gridID):
+    '''A grid stored with saveGrid, registered in this process. None if the database doesn't have it.'''
+    if gridID in _grids:
+        return _grids[gridID]
+    if 'grids' not in h5file.root:
+        return None
+    rows = h5file.root.grids.read_where('gridID == gid', {'gid': np.uint32(gridID)})
+    if len(rows) == 0:
+        return None
+    return registerGrid(FrequencyGrid(rows['start'][0], rows['step'][0], rows['count'][0]))
@@ -1,21 +1,20 @@
 import sys
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QPushButton, QLabel, QVBoxLayout, QHBoxLayout, QStackedLayout, QTextEdit, QSizePolicy, QLineEdit, QFormLayout, QDialog, QDialogButtonBox, QMessageBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QIntValidator, QDoubleValidator
 import pickle
 import os.path
-from BinarySpectroViewer import *
-from multiprocessing import set_start_method
-from EARSscan import *
-import EARSscan
-from StreamSim import *
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-import matplotlib
-matplotlib.use('Qt5Agg')
+import datetime
+from WorkerPool import WorkerPool
+from HopTracker import drawHoppers
+from JammingDetector import drawJamming
+from PeakTracker import drawPeaks
+from PlotDecimator import PlotDecimator, ZoomPan, drawSpectrum
+from Calibration import calibrationWorker, bandsInUse
+from ScanPlan import parseFreq, compilePlan
+from multiprocessing import Process, Queue, set_start_method
+#With spawn, every scan and calibration process re-imports this module, so nothing heavy goes up here.
+#matplotlib (and the scan window canvas) is imported when the plotting page is first built.
 
 
 ''' Let's set globals up here for any formatting that will be used across all pages'''
@@ -67,17 +66,6 @@ LabelStyleSheet = '''
 SubPageHeaderStyleSheet = '''font-size: 15pt; font-weight: bold; color: white;'''
 SubPageInfoStyleSheet = '''font-size: 10pt; font-weight: bold; color: white;'''
 
-def convert_to_int(value):
-    suffixes = {'K': 10**3, 'M': 10**6, 'G': 10**9}
-    try:
-        suffix = value[-1]
-        number = float(value[:-1])
-        if suffix in suffixes:
-            return int(number * suffixes[suffix])
-    except ValueError:
-        pass
-    raise ValueError("Invalid input")
-
 class MainWidget(QMainWindow):
     def __init__(self, stackLayout):
         super().__init__()
@@ -87,6 +75,17 @@ class MainWidget(QMainWindow):
         # changing the background color to black
         self.setStyleSheet(BackgroundStyle)
 
+        # Hardware scan ranges run this session, so calibration can offer to redo just those bands
+        self.scannedRanges = []
+
+        # Pages are built the first time they're opened and reused after that, see showCachedPage
+        self.pages = {}
+        # Scans run on pre-started scan and logger processes (see WorkerPool.py), so pressing a band button
+        # doesn't wait for new processes to start up. The plotting page is built as soon as the window is up.
+        self.workerPool = WorkerPool()
+        self.scanJob = None
+        QTimer.singleShot(0, self.buildPlottingWidget)
+
         # Set up central widget and layout
         self.central_widget = QWidget()
         self.central_layout = QHBoxLayout()
@@ -154,6 +153,8 @@ class MainWidget(QMainWindow):
         self.stackLayout = stackLayout
 
     def openQuickScanWidget(self):
+        if self.showCachedPage('quickScan'):
+            return
         self.quickScanWidget = QWidget()
         self.quickScanWidget.setStyleSheet(BackgroundStyle)
         self.quickScanLayout = QVBoxLayout()
@@ -172,6 +173,7 @@ class MainWidget(QMainWindow):
         self.quickScanLayout.addWidget(self.quickScanBackButton)
         self.quickScanWidget.setLayout(self.quickScanLayout)
         self.stackLayout.addWidget(self.quickScanWidget)
+        self.pages['quickScan'] = self.quickScanWidget
         self.stackLayout.setCurrentWidget(self.quickScanWidget)
 
         # set connections for buttons
@@ -182,6 +184,8 @@ class MainWidget(QMainWindow):
         self.GPSScanButton.clicked.connect(self.GPSScanMethod)
 
     def openToggleScanWidget(self):
+        if self.showCachedPage('toggleScan'):
+            return
         self.ToggleScanWidget = QWidget()
         self.ToggleScanWidget.setStyleSheet(BackgroundStyle)
 
@@ -253,6 +257,7 @@ class MainWidget(QMainWindow):
 
         # Add the ToggleScanWidget to the stack layout
         self.stackLayout.addWidget(self.ToggleScanWidget)
+        self.pages['toggleScan'] = self.ToggleScanWidget
         self.stackLayout.setCurrentWidget(self.ToggleScanWidget)
 
         # Set connections for buttons
@@ -261,6 +266,8 @@ class MainWidget(QMainWindow):
 
 
     def openSimulatedScanWidget(self):
+        if self.showCachedPage('simulatedScan'):
+            return
         self.simulatedScanWidget = QWidget()
         self.simulatedScanWidget.setStyleSheet(BackgroundStyle)
         self.simScanLayout = QVBoxLayout()
@@ -278,6 +285,7 @@ class MainWidget(QMainWindow):
         self.simScanLayout.addWidget(self.simScanBackButton)
         self.simulatedScanWidget.setLayout(self.simScanLayout)
         self.stackLayout.addWidget(self.simulatedScanWidget)
+        self.pages['simulatedScan'] = self.simulatedScanWidget
         self.stackLayout.setCurrentWidget(self.simulatedScanWidget)
 
         # set connections for buttons
@@ -287,6 +295,8 @@ class MainWidget(QMainWindow):
         self.widebandTransmissionScanButton.clicked.connect(self.openWidebandTransmissionWidget)
 
     def openFixedFreqWidget(self):
+        if self.showCachedPage('fixedFreq'):
+            return
         self.FixFreqWidget = QWidget()
         self.FixFreqWidget.setStyleSheet(BackgroundStyle)
 
@@ -396,6 +406,7 @@ class MainWidget(QMainWindow):
 
         # Add the FixFreqWidget to the stack layout
         self.stackLayout.addWidget(self.FixFreqWidget)
+        self.pages['fixedFreq'] = self.FixFreqWidget
         self.stackLayout.setCurrentWidget(self.FixFreqWidget)
 
         # Set connections for buttons
@@ -403,6 +414,8 @@ class MainWidget(QMainWindow):
         self.FixFreqScanButton.clicked.connect(self.fixedFrequencyScanMethod)
 
     def openFreqHoppingWidget(self):
+        if self.showCachedPage('freqHopping'):
+            return
         self.FreqHopWidget = QWidget()
         self.FreqHopWidget.setStyleSheet(BackgroundStyle)
 
@@ -498,6 +511,7 @@ class MainWidget(QMainWindow):
 
         # Add the FreqHopWidget to the stack layout
         self.stackLayout.addWidget(self.FreqHopWidget)
+        self.pages['freqHopping'] = self.FreqHopWidget
         self.stackLayout.setCurrentWidget(self.FreqHopWidget)
 
         # Set connections for buttons
@@ -505,6 +519,8 @@ class MainWidget(QMainWindow):
         self.FreqHopScanButton.clicked.connect(self.frequencyHoppingScanMethod)
 
     def openWidebandTransmissionWidget(self):
+        if self.showCachedPage('wideband'):
+            return
         self.WidebandWidget = QWidget()
         self.WidebandWidget.setStyleSheet(BackgroundStyle)
 
@@ -618,69 +634,113 @@ class MainWidget(QMainWindow):
 
         # Add the WidebandWidget to the stack layout
         self.stackLayout.addWidget(self.WidebandWidget)
+        self.pages['wideband'] = self.WidebandWidget
         self.stackLayout.setCurrentWidget(self.WidebandWidget)
 
         # Set connections for buttons
         self.WidebandBackButton.clicked.connect(self.openSimulatedScanWidget)
         self.WidebandScanButton.clicked.connect(self.widebandTransmissionScanMethod)
 
+    def showCachedPage(self, name):
+        '''Show a page that was already built. Returns False if it hasn't been built yet.'''
+        if name not in self.pages:
+            return False
+        self.stackLayout.setCurrentWidget(self.pages[name])
+        return True
+
     def openPlottingWidget(self, cmdFreqs, simFlag, simConfig):
-        # Set up the plotting widget
-        self.plottingWidget = QWidget()
-        self.plottingWidget.setStyleSheet(BackgroundStyle)
-        self.plottingLayout = QVBoxLayout()
+        # The page, canvas and update timer are built once and reused for every scan. Only the scan job
+        # is new each time; it runs on a worker of the pool.
+        try:
+            # Catch a bad range here rather than in the scan process where nobody sees the error
+            compilePlan(cmdFreqs)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Invalid frequency range', str(e))
+            return
+        if 'plotting' not in self.pages:
+            self.buildPlottingWidget()
+        # Only one scan at a time has the SDR
+        self.stopScan()
 
         print('Initializing scan...')
-        matplotlib.pyplot.style.use('dark_background')
+        if not simFlag and cmdFreqs not in self.scannedRanges:
+            self.scannedRanges.append(cmdFreqs)
 
         # Start the first scan so there is data in the pipe
         self.initScanMethod()
 
+        # Clear out whatever the last scan left on the page
+        self.updateCount = 0
+        self.lastPayload = None
+        self.zoom.view = None
+        self.peakTable.setPeaks([])
+        self.jammingLabel.setText('')
+        self.axesRef.cla()
+        #Add a loading message to the power graph
+        self.axesRef.text(0.05, .95, 'Loading data...')
+        self.powerGraph.draw()
+        #Hand the scan to a waiting worker. The job reads like the old software bus queue.
+        self.scanJob = self.workerPool.startScan(cmdFreqs, simFlag, simConfig)
+        self.scanJob.setView(None, None, self.zoom.widthPx())
+        self.updateTimer.start()
+        self.stackLayout.setCurrentWidget(self.plottingWidget)
+
+        simConfigObj.clear(self)
+
+    def buildPlottingWidget(self):
+        if 'plotting' in self.pages:
+            return
+        # Set up the plotting widget
+        self.plottingWidget = QWidget()
+        self.plottingWidget.setStyleSheet(BackgroundStyle)
+        self.plottingLayout = QVBoxLayout()
+        from EARSscan import MplCanvas, PeakTable
+        import matplotlib.pyplot
+        matplotlib.pyplot.style.use('dark_background')
+
         # Show the scan Data
         self.powerGraph = MplCanvas(self)
         self.axesRef = self.powerGraph.figure.axes[0]
         self.powerGraph.figure.tight_layout()
         self.updateCount = 0
+        # Sweeps are drawn from at most 2 points per pixel, see PlotDecimator.py
+        self.decimator = PlotDecimator()
+        self.lastPayload = None
+        # Scroll to zoom, drag to pan, double click for the whole range. The scan is told what's visible.
+        self.zoom = ZoomPan(self.powerGraph, self.axesRef, redraw=self.updatePlot, onChange=self.viewChanged)
         
         # call the update event This drives both the scanning calls and the graph updating
-        # Set up the update function
+        # Set up the update function. It's started when a scan starts.
         self.updateTimer = QTimer()
         self.updateTimer.timeout.connect(self.updateMethod)
-        #Update interval is set in milliseconds
-        self.updateTimer.setInterval(1000)
-        self.updateTimer.start()
-        #Start software bus queue
-        self.SWBQueue = Queue(25)
-        # Add the graph widget which shows the moving average of the power, in decibels, of the band.
-        self.plottingLayout.addWidget(self.powerGraph)
-        #Add a loading message to the power graph
-        self.axesRef.text(0.05, .95, 'Loading data...')
-        #Start the hardware scanning process
-        self.hwScanProcess = Process(target=streamScan, args = (cmdFreqs, self.SWBQueue, simFlag, simConfig))
-        self.hwScanProcess.start()
+        #Update interval is set in milliseconds. Checking an empty queue is cheap, and a long interval
+        #would hold back the first frame of a scan.
+        self.updateTimer.setInterval(100)
+        # Jamming alarm banner. Empty until the scan raises an alarm
+        self.jammingLabel = QLabel('')
+        self.jammingLabel.setAlignment(Qt.AlignCenter)
+        self.jammingLabel.setStyleSheet(SubPageHeaderStyleSheet + 'color: red;')
+        self.plottingLayout.addWidget(self.jammingLabel)
+        # Add the graph widget which shows the moving average of the power, in decibels, of the band,
+        # with the peak list next to it. Double clicking a peak zooms in on it.
+        self.peakTable = PeakTable(self, onChoose=lambda freq: self.zoom.setView((freq - 100e3, freq + 100e3)))
+        graphLayout = QHBoxLayout()
+        graphLayout.addWidget(self.powerGraph, 3)
+        graphLayout.addWidget(self.peakTable, 1)
+        self.plottingLayout.addLayout(graphLayout)
 
         # Close Button setup
         self.Close_Button = QPushButton('End Scan')
         self.Close_Button.setStyleSheet(BackButtonStyleSheet)
-        self.Close_Button.clicked.connect(self.close)
-        self.Close_Button.clicked.connect(self.openMainWidget)
+        self.Close_Button.clicked.connect(self.endScanMethod)
         self.plottingLayout.addWidget(self.Close_Button)
         #Final setup for the plotting widget
         self.plottingWidget.setLayout(self.plottingLayout)
         self.stackLayout.addWidget(self.plottingWidget)
-        self.stackLayout.setCurrentWidget(self.plottingWidget)
-
-        simConfigObj.clear(self)
+        self.pages['plotting'] = self.plottingWidget
 
     # All the the necessary items from old EARSscan will be here
 
-    class MplCanvas(FigureCanvasQTAgg):
-        #This is a class for setting up the embedded matplotlib figure
-        def __init__(self, parent=None, width=5, height=4, dpi=100):
-            fig = Figure(figsize=(width, height), dpi=dpi)
-            self.axes = fig.add_subplot(111)
-            super(MplCanvas, self).__init__(fig)
-
     def initScanMethod(self):
         # we have not started the first scan. Build the Command
         #Return True if the method completed without issues. Return False if there were errors.
@@ -690,51 +750,72 @@ class MainWidget(QMainWindow):
     def updateMethod(self):
 
         #check for an update in the queue
-        if not self.SWBQueue.empty():
+        if self.scanJob is not None and not self.scanJob.empty():
+            payload = self.scanJob.get()
+            if isinstance(payload, str):
+                #The scan ended on its own ('Done')
+                return
             self.updateCount += 1
             #Got data in the queue
-            df, maxDF, baseline = self.SWBQueue.get()
-            #Clear axes
-            self.axesRef.cla()
-            #Add time and number of updates annotation
-            curTime = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
-            curTimeUpdateText = 'Last update: ' + curTime
-            curUpdateText = 'Number of scans: ' + str(self.updateCount)
-            print(curUpdateText)
-            print(curTimeUpdateText)
-            self.axesRef.text(0.05, .95, curTimeUpdateText)
-            self.axesRef.text(0.05, .90, curUpdateText)
-            #Plot our data
-            maxDF.plot(ax=self.axesRef, x='freqCompare', y='power', style='y', linewidth = .5, label='max hold', grid='On', title = 'ScanView')
-            df.plot(ax=self.axesRef, x='frequency', y='power', grid='On', title = 'ScanView', label='current', alpha = .7, linewidth = .5)
-            self.axesRef.fill_between(df['frequency'], df['power'], df['power'].min(), alpha = .5)
-            baseline.plot(ax=self.axesRef, x='frequency', y='power', style='r-.', linewidth=.5, alpha = .7, label = 'baseline')
-            
-            #Draw and allow matplotlib to do plot update
-            self.powerGraph.draw()
+            self.lastPayload = payload
+            self.lastUpdate = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
+            print('Number of scans: ' + str(self.updateCount))
+            print('Last update: ' + self.lastUpdate)
+            jamming = payload[3].get('jamming')
+            if jamming and jamming['changed']:
+                self.jammingLabel.setText('JAMMING: ' + jamming['type'] if jamming['alarm'] else '')
+            self.peakTable.setPeaks(payload[3].get('peaks', []))
+            self.updatePlot()
+            #Allow matplotlib to do plot update
+            import matplotlib.pyplot
             matplotlib.pyplot.pause(.05)
 
     def updatePlot(self):
-        #Read in all the new data
-        pass
+        #Draw the last sweep in the current zoom. Also called while zooming and panning between sweeps.
+        if self.lastPayload is None:
+            return
+        df, maxDF, baseline, extras = self.lastPayload
+        #Clear axes
+        self.axesRef.cla()
+        #Add time and number of updates annotation
+        self.axesRef.text(0.05, .95, 'Last update: ' + self.lastUpdate, transform=self.axesRef.transAxes)
+        self.axesRef.text(0.05, .90, 'Number of scans: ' + str(self.updateCount), transform=self.axesRef.transAxes)
+        #Plot our data. A wide scan is millions of bins, so only the min/max per pixel is drawn.
+        drawSpectrum(self.axesRef, self.decimator, df, maxDF, baseline, self.zoom.view)
+        #Tracked hoppers are drawn as one emitter rather than left as noise in the max hold
+        drawHoppers(self.axesRef, extras.get('hoppers', []))
+        drawJamming(self.axesRef, extras.get('jamming'))
+        drawPeaks(self.axesRef, extras.get('peaks', []))
+        self.powerGraph.draw()
+
+    def viewChanged(self, low, high, widthPx):
+        # Only the visible range is sent at full resolution, see ScanProcessor.setView
+        if self.scanJob is not None:
+            self.scanJob.setView(low, high, widthPx)
+
+    def stopScan(self, timeout=60):
+        '''
+        Gracefully end the running scan, if there is one. Its worker goes back to waiting for the next one.
+        Waits for the current sweep to finish (up to timeout seconds) so the SDR is free for the next scan;
+        a worker that doesn't is replaced.
+        '''
+        if self.scanJob is None:
+            return
+        print('gracefully closing...')
+        self.updateTimer.stop()
+        #The scan stops right away, even mid sweep
+        self.scanJob.stop(timeout)
+        self.scanJob = None
+        print('Closed scan')
+
+    def endScanMethod(self):
+        self.stopScan()
+        self.openMainWidget()
 
     def closeEvent(self, event):
         # Make sure we are gracefully ending the scan and not just leaving the process running in the background.
         # This would probably cause problems if the user then immediately tried to start another scan.
-        print('gracefully closing...')
-        while not self.SWBQueue.empty():
-            print('Flushing queue...')
-            #Ensure the queue is empty before sending the command. 
-            #This ensures that this is the next item in the queue when the hw process looks.
-            flushVar = self.SWBQueue.get()
-        self.SWBQueue.put('QUIT')
-        print('Closed the SWB Queue and hardware process.')
-        #self.hwScanProcess.join()
-        self.SWBQueue.get(block=True, timeout=300)
-        self.SWBQueue.close()
-        self.hwScanProcess.terminate()
-        print('Closed scan and queue')
-        self.updateTimer.stop()
+        self.stopScan()
         event.accept()
 
     '''TODO: Need to figure out how errors and updates will be handled with new button scheme
@@ -782,7 +863,7 @@ class MainWidget(QMainWindow):
         if self.FixFreqinput_field1.text() == "":
             selectedFreq = 33_000_000
         else:
-            selectedFreq = convert_to_int(self.FixFreqinput_field1.text())
+            selectedFreq = parseFreq(self.FixFreqinput_field1.text())
         
         
         FixFreq_starting_freq = self.FixFreqinput_field3.text()
@@ -851,10 +932,10 @@ class MainWidget(QMainWindow):
             simConfig.selectedFreq3 = 33_000_000
             simConfig.selectedFreq4 = 34_000_000
         else:
-            simConfig.selectedFreq1 = convert_to_int(self.Widebandinput_field1_1.text())
-            simConfig.selectedFreq2 = convert_to_int(self.Widebandinput_field1_2.text())
-            simConfig.selectedFreq3 = convert_to_int(self.Widebandinput_field1_3.text())
-            simConfig.selectedFreq4 = convert_to_int(self.Widebandinput_field1_4.text())
+            simConfig.selectedFreq1 = parseFreq(self.Widebandinput_field1_1.text())
+            simConfig.selectedFreq2 = parseFreq(self.Widebandinput_field1_2.text())
+            simConfig.selectedFreq3 = parseFreq(self.Widebandinput_field1_3.text())
+            simConfig.selectedFreq4 = parseFreq(self.Widebandinput_field1_4.text())
 
         if self.Widebandinput_field2.text() == "":
             peakPower = -30
@@ -895,40 +976,63 @@ class MainWidget(QMainWindow):
         will later be used to determine whether anything unexpected is happening
         in the spectrum.
 
-        'rtl_power_fftw -f 30M:1.7G -b 500 -n 500 -g 100 -q'
-        frequency range is from 30 MHz to 1.7 GHz. 
-        Each fft bin is sampled 500 times.
+        The calibration runs in its own process (Calibration.calibrationWorker) one band segment
+        at a time, and each segment is stored as soon as it's measured. checkCalibration polls the
+        progress queue so the window stays responsive while it runs.
         '''
-        #This takes forever, so Popup a message that the cal is starting.
+        if getattr(self, 'calibrationProcess', None) is not None and self.calibrationProcess.is_alive():
+            self.statusBar().showMessage('Calibration already running')
+            return
+        bands = None
+        if self.scannedRanges:
+            #Offer to redo just the bands we've been scanning, which is much quicker than all of them
+            reply = QMessageBox.question(self, 'Calibrate', 'Recalibrate only the bands in use?\n{}'.format(', '.join(self.scannedRanges)),
+                                         QMessageBox.Yes | QMessageBox.No)
+            if reply == QMessageBox.Yes:
+                bands = sorted({band for freqRange in self.scannedRanges for band in bandsInUse(freqRange)}, key=lambda band: band[1])
         print("starting Calibration")
+        self.calibrationQueue = Queue()
+        self.calibrationProcess = Process(target=calibrationWorker, args=(self.calibrationQueue, bands))
+        self.calibrationProcess.start()
+        self.statusBar().showMessage('Calibrating')
+        self.calibrationTimer = QTimer()
+        self.calibrationTimer.timeout.connect(self.checkCalibration)
+        #Update interval is set in milliseconds
+        self.calibrationTimer.setInterval(250)
+        self.calibrationTimer.start()
+
+    def checkCalibration(self):
+        '''Show calibration progress and pop up the result when the worker is finished.'''
+        finished = None
+        while not self.calibrationQueue.empty():
+            msg = self.calibrationQueue.get()
+            if msg[0] == 'progress':
+                self.statusBar().showMessage('Calibrating {} ({} of {})'.format(msg[3], msg[1] + 1, msg[2]))
+            elif msg[0] in ('done', 'error'):
+                finished = msg
+        if finished is None and self.calibrationProcess.is_alive():
+            return
+        if finished is None:
+            #The worker died without saying why
+            finished = ('error', 'Calibration process exited with code {}'.format(self.calibrationProcess.exitcode))
+        self.calibrationTimer.stop()
+        self.calibrationProcess.join()
+        self.calibrationProcess = None
         self.msgBox = QMessageBox()
-        self.msgBox.setWindowTitle('Calibrating')
         self.msgBox.setIcon(QMessageBox.Information)
-        self.msgBox.setText("Calibrating system...\nThis typically takes several minutes")
         self.msgBox.setStandardButtons(QMessageBox.Ok)
-        self.statusBar().showMessage('Calibrating')
-        self.msgBox.exec()
-
-        if takeBaselineMeasurement() == 'Error':
-            self.msgBox.close()
-            self.msgBox = QMessageBox()
+        if finished[0] == 'error':
+            print(finished[1])
             self.msgBox.setWindowTitle('Error!')
-            self.msgBox.setIcon(QMessageBox.Information)
             self.msgBox.setText("Failed to Calibrate System\nCheck hardware connections")
-            self.msgBox.setStandardButtons(QMessageBox.Ok)
             self.statusBar().showMessage('Error Calibrating')
-            self.msgBox.exec()
         else:
-            self.msgBox.close()
             #Popup a message that the cal was successful.
             print("succesfully performed Calibration")
-            self.msgBox = QMessageBox()
             self.msgBox.setWindowTitle('Sucess!')
-            self.msgBox.setIcon(QMessageBox.Information)
             self.msgBox.setText("Successfully Calibrated System")
-            self.msgBox.setStandardButtons(QMessageBox.Ok)
             self.statusBar().showMessage('Done Calibrating')
-            self.msgBox.exec()
+        self.msgBox.exec()
 
 class simConfigObj():
     '''
@@ -996,6 +1100,12 @@ class MainWindow(QWidget):
         #self.showMaximized()
         self.resize(800, 480)  # Replace the width and height values for testing what GUI looks like on PI screen
 
+    def closeEvent(self, event):
+        # The main widget is never closed itself, so end its scan and its workers here
+        self.mainWidget.stopScan()
+        self.mainWidget.workerPool.shutdown()
+        event.accept()
+
 
 
 if __name__ == '__main__':
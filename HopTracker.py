@@ -0,0 +1,280 @@
+'''
+Frequency hopping tracker. Links per sweep detections into hop sequences so a hopper can be shown as one
+emitter instead of a smear of noise in the max hold.
+
+Each sweep:
+1. detectSignals() finds contiguous runs of bins over a threshold (noise floor + margin by default) and
+   turns each run into a detection: center frequency, bandwidth and peak power.
+2. HopTracker.update() assigns detections to tracks:
+    ~a detection at the frequency a track was last seen on continues that track (it's still dwelling)
+    ~otherwise it is matched to a recently seen track with a similar bandwidth and power - that is a hop
+    ~anything left over starts a new track
+   Tracks are found through two dictionaries, one keyed by frequency bucket and one keyed by a coarse
+   (bandwidth, power) signature, so assignment cost stays linear in the number of detections per sweep.
+3. Tracks which have hopped at least minHops times to different frequencies are reported as hoppers, with
+   an estimate of their hop band, dwell time, hop rate and power profile.
+
+The tracker only sees the spectrum when the sweep passes over it. Against a fast hopper (hundreds of hops
+per second) each sweep catches one or two dwells, so the hop rate is a lower bound and the dwell time is
+capped by the sweep interval. The hop band is still a good estimate after a few dozen sweeps.
+
+The same tracker runs live in streamScan and offline with trackSession().
+'''
+
+import numpy as np
+from collections import deque
+from AnalysisRunner import AnalysisKernel
+
+def detectSignals(freqs, power, threshold=None, margin=10.0, minBins=1):
+    '''
+    Find contiguous runs of bins above threshold (dB, scalar or per bin). If no threshold is given, the
+    median of the sweep plus margin is used as a rough noise floor.
+    Returns (center, bandwidth, peak) arrays, one entry per detection.
+    '''
+    freqs = np.asarray(freqs, dtype=np.float64)
+    power = np.asarray(power, dtype=np.float64)
+    if threshold is None:
+        threshold = np.median(power) + margin
+    mask = power > threshold
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    keep = (stops - starts) >= minBins
+    starts, stops = starts[keep], stops[keep]
+    if len(starts) == 0:
+        empty = np.zeros(0)
+        return empty, empty, empty
+    #Every reduceat segment runs from one detection's start up to the next one's, so blank the bins
+    #which aren't part of a detection.
+    inRun = np.where(mask, power, -np.inf)
+    peak = np.maximum.reduceat(inRun, starts)
+    linear = np.where(mask, 10**(power/10), 0.0)
+    center = np.add.reduceat(linear*freqs, starts)/np.add.reduceat(linear, starts)
+    step = freqs[1] - freqs[0] if len(freqs) > 1 else 0.0
+    bandwidth = freqs[stops - 1] - freqs[starts] + step
+    return center, bandwidth, peak
+
+
+class Track():
+    '''One emitter. Keeps running values only, plus a short history of recent hops for the GUI.'''
+    def __init__(self, trackID, freq, bandwidth, power, t, historyLength=64):
+        self.trackID = trackID
+        self.freq = freq
+        self.bandwidth = bandwidth
+        self.power = power
+        self.firstSeen = t
+        self.lastSeen = t
+        self.dwellStart = t
+        self.lowFreq = freq
+        self.highFreq = freq
+        self.hits = 1
+        self.nHops = 0
+        self.dwellSum = 0.0
+        self.nDwells = 0
+        #Running mean/M2 of the peak power (Welford)
+        self.powerMean = power
+        self.powerM2 = 0.0
+        self.powerMax = power
+        self.history = deque([(t, freq, power)], maxlen=historyLength)
+        self.frequencies = {round(freq, -3)}
+        self.assignedAt = None
+
+    def hit(self, freq, bandwidth, power, t, hopped):
+        if hopped:
+            self.nHops += 1
+            #The dwell ended somewhere between the last sighting and now; take now so an emitter seen
+            #on a frequency once still gets a dwell of up to one sweep interval
+            self.dwellSum += t - self.dwellStart
+            self.nDwells += 1
+            self.dwellStart = t
+            if len(self.frequencies) < 1024:
+                self.frequencies.add(round(freq, -3))
+        self.hits += 1
+        delta = power - self.powerMean
+        self.powerMean += delta/self.hits
+        self.powerM2 += delta*(power - self.powerMean)
+        self.powerMax = max(self.powerMax, power)
+        #Smooth the signature so one odd reading doesn't throw the track off
+        self.bandwidth += (bandwidth - self.bandwidth)/4
+        self.power += (power - self.power)/4
+        self.freq = freq
+        self.lowFreq = min(self.lowFreq, freq)
+        self.highFreq = max(self.highFreq, freq)
+        self.lastSeen = t
+        self.history.append((t, freq, power))
+
+    def isHopper(self, minHops):
+        return self.nHops >= minHops and len(self.frequencies) > 2
+
+    def summary(self):
+        elapsed = self.lastSeen - self.firstSeen
+        return {'trackID': self.trackID,
+                'bandLow': self.lowFreq - self.bandwidth/2,
+                'bandHigh': self.highFreq + self.bandwidth/2,
+                'bandwidth': self.bandwidth,
+                'hops': self.nHops,
+                'hopRate': self.nHops/elapsed if elapsed > 0 else np.nan,
+                'dwell': self.dwellSum/self.nDwells if self.nDwells else np.nan,
+                'powerMean': self.powerMean,
+                'powerStd': np.sqrt(self.powerM2/(self.hits - 1)) if self.hits > 1 else 0.0,
+                'powerMax': self.powerMax,
+                'firstSeen': self.firstSeen,
+                'lastSeen': self.lastSeen,
+                'recent': list(self.history)}
+
+
+class HopTracker():
+    '''
+    Incremental detection to track assignment.
+    :param maxGap: seconds a track can go unseen before it is retired
+    :param powerTol: dB difference still considered the same emitter when matching a hop
+    :param bwTol: fractional bandwidth difference still considered the same emitter
+    :param minHops: hops (to different frequencies) before a track is reported as a hopper
+    '''
+    def __init__(self, margin=10.0, maxGap=10.0, powerTol=6.0, bwTol=0.5, minHops=3, bucketHz=25_000, maxRetired=100):
+        self.margin = margin
+        self.maxGap = maxGap
+        self.powerTol = powerTol
+        self.bwTol = bwTol
+        self.minHops = minHops
+        self.bucketHz = bucketHz
+        self.tracks = {}
+        self.retired = deque(maxlen=maxRetired)
+        self.nextID = 0
+        self.byFreq = {}
+        self.bySignature = {}
+
+    def _signature(self, bandwidth, power):
+        #Coarse enough that similar emitters land in the same or a neighbouring cell
+        return (int(np.log2(max(bandwidth, 1.0))), int(power//self.powerTol))
+
+    def _index(self, track):
+        self.byFreq.setdefault(int(track.freq//self.bucketHz), set()).add(track.trackID)
+        self.bySignature.setdefault(self._signature(track.bandwidth, track.power), set()).add(track.trackID)
+
+    def _unindex(self, track):
+        self.byFreq.get(int(track.freq//self.bucketHz), set()).discard(track.trackID)
+        self.bySignature.get(self._signature(track.bandwidth, track.power), set()).discard(track.trackID)
+
+    def _similar(self, track, bandwidth, power):
+        return abs(track.power - power) <= self.powerTol and \
+               abs(track.bandwidth - bandwidth) <= self.bwTol*max(track.bandwidth, bandwidth)
+
+    def update(self, freqs, power, t, threshold=None):
+        '''Run detection on a sweep and feed it to the tracker. Returns the detections.'''
+        detections = detectSignals(freqs, power, threshold, self.margin)
+        self.addDetections(*detections, t)
+        return detections
+
+    def addDetections(self, centers, bandwidths, peaks, t):
+        unmatched = []
+        #Pass 1: same frequency as last time - the emitter is still dwelling
+        for freq, bandwidth, power in zip(centers, bandwidths, peaks):
+            best = None
+            bucket = int(freq//self.bucketHz)
+            for key in (bucket - 1, bucket, bucket + 1):
+                for trackID in self.byFreq.get(key, ()):
+                    track = self.tracks[trackID]
+                    if track.assignedAt == t or abs(track.freq - freq) > max(track.bandwidth, bandwidth)/2:
+                        continue
+                    if best is None or abs(track.freq - freq) < abs(best.freq - freq):
+                        best = track
+            if best is None:
+                unmatched.append((freq, bandwidth, power))
+            else:
+                self._assign(best, freq, bandwidth, power, t, hopped=False)
+        #Pass 2: a similar emitter somewhere else - call it a hop
+        for freq, bandwidth, power in unmatched:
+            best = None
+            bw, pw = self._signature(bandwidth, power)
+            for key in ((bw + i, pw + j) for i in (-1, 0, 1) for j in (-1, 0, 1)):
+                for trackID in self.bySignature.get(key, ()):
+                    track = self.tracks[trackID]
+                    if track.assignedAt == t or not self._similar(track, bandwidth, power):
+                        continue
+                    if best is None or track.lastSeen > best.lastSeen or \
+                            (track.lastSeen == best.lastSeen and track.hits > best.hits):
+                        best = track
+            if best is None:
+                track = Track(self.nextID, freq, bandwidth, power, t)
+                track.assignedAt = t
+                self.tracks[track.trackID] = track
+                self._index(track)
+                self.nextID += 1
+            else:
+                self._assign(best, freq, bandwidth, power, t, hopped=True)
+        self._retire(t)
+
+    def _assign(self, track, freq, bandwidth, power, t, hopped):
+        self._unindex(track)
+        track.hit(freq, bandwidth, power, t, hopped)
+        track.assignedAt = t
+        self._index(track)
+
+    def _retire(self, t):
+        for trackID in [k for k, track in self.tracks.items() if t - track.lastSeen > self.maxGap]:
+            track = self.tracks.pop(trackID)
+            self._unindex(track)
+            if track.isHopper(self.minHops):
+                self.retired.append(track.summary())
+
+    def hoppers(self, includeRetired=False):
+        '''Summaries of the tracks that behave like hoppers. Live ones first.'''
+        live = [track.summary() for track in self.tracks.values() if track.isHopper(self.minHops)]
+        return live + list(self.retired) if includeRetired else live
+
+
+def drawHoppers(ax, hoppers):
+    '''
+    Draw tracked hoppers on a matplotlib axes as one entity each: the hop band shaded, recent hops as
+    dots and a label with the hop rate.
+    '''
+    for hopper in hoppers:
+        ax.axvspan(hopper['bandLow'], hopper['bandHigh'], color='m', alpha=.15)
+        recent = hopper['recent']
+        ax.plot([hop[1] for hop in recent], [hop[2] for hop in recent], 'm.', markersize=3)
+        ax.text(hopper['bandLow'], .85, 'Hopper {}: {:.2f} hops/s, {:.0f} kHz'.format(
+                hopper['trackID'], hopper['hopRate'], hopper['bandwidth']/1000),
+                transform=ax.get_xaxis_transform(), color='m')
+
+class DetectionKernel(AnalysisKernel):
+    '''
+    Every detection of a session as an AnalysisRunner kernel. The result is a DataFrame of time (s), center,
+    bandwidth and peak. Needs whole sweeps: a signal on a span boundary would be cut in two, and the
+    default threshold is the median of the whole sweep.
+    '''
+    name = 'detections'
+    splitFrequency = False
+
+    def __init__(self, threshold=None, aboveBaseline=None, margin=10.0, minBins=1):
+        AnalysisKernel.__init__(self, threshold, aboveBaseline)
+        self.margin = margin
+        self.minBins = minBins
+
+    def update(self, partial, seconds, freqs, power):
+        binThreshold = self.binThreshold(freqs)
+        found = []
+        for t, row in zip(seconds, power):
+            center, bandwidth, peak = detectSignals(freqs, row, binThreshold, self.margin, self.minBins)
+            found.append(np.column_stack((np.full(len(center), t), center, bandwidth, peak)))
+        #A list of blocks, so merging is cheap; they're only put together in result()
+        return (partial or []) + [np.concatenate(found)]
+
+    def mergeTime(self, first, second):
+        return first + second
+
+    def result(self, partial):
+        import pandas as pd
+        return pd.DataFrame(np.concatenate(partial), columns=['time', 'center', 'bandwidth', 'peak'])
+
+
+def trackSession(sessionID, DB_Name="EARS_DB.h5", threshold=None, **kwargs):
+    '''Offline pass of the tracker over a stored session. Returns a DataFrame of hoppers.'''
+    import pandas as pd
+    from DBManager import iterSessionSweeps, timeStampsToSeconds
+    tracker = HopTracker(**kwargs)
+    for times, freqs, power in iterSessionSweeps(sessionID, DB_Name):
+        for t, row in zip(timeStampsToSeconds(times), power):
+            tracker.update(freqs, row, t, threshold)
+    result = pd.DataFrame(tracker.hoppers(includeRetired=True))
+    return result.drop(columns='recent') if len(result) else result
@@ -0,0 +1,170 @@
+'''
+Jamming detector - indications and warnings of RF jamming, the third of the EARS functions.
+
+Jamming shows up as the noise floor coming up, not as a nice narrow peak, so this watches the floor:
+
+1. The sweep is cut into segments (1 MHz by default). Each segment's floor for this sweep is a low
+   percentile of its bins, so a few real signals in the segment don't move it.
+2. Each segment has a rolling robust estimate of its normal floor (median) and spread (median absolute
+   deviation). These are updated incrementally every sweep with a fixed size step toward the new value,
+   so there's no window of old sweeps to keep or re-sort. The estimate is seeded from the calibration
+   baseline when there is one (so a jammer that's already on when the scan starts is still caught), or
+   from the first few sweeps otherwise. Segments that look jammed stop learning, so the detector doesn't
+   get used to the jammer.
+3. A segment is elevated when its floor is more than zThresh robust standard deviations and minRise dB
+   above normal. Neighbouring elevated segments are merged into spans.
+4. The sweep is classified:
+    ~barrage      - most of the scanned band is elevated
+    ~sweep        - a narrower elevated span which shows up in a different place every sweep
+    ~partial-band - a narrower elevated span that stays put
+5. Alarms are debounced: raised after raiseCount flagged sweeps in a row, cleared after clearCount clean
+   sweeps in a row.
+
+The per sweep cost is one np.partition over the sweep plus a few operations per segment, which the Pi
+keeps up with at any sweep rate the SDR can manage.
+'''
+
+import numpy as np
+from collections import deque, Counter
+
+class JammingDetector():
+    def __init__(self, segmentHz=1_000_000, percentile=25, zThresh=4.0, minRise=3.0, barrageFraction=.6,
+                 raiseCount=3, clearCount=5, rate=.05, warmup=10, window=10):
+        self.segmentHz = segmentHz
+        self.percentile = percentile
+        self.zThresh = zThresh
+        self.minRise = minRise
+        self.barrageFraction = barrageFraction
+        self.raiseCount = raiseCount
+        self.clearCount = clearCount
+        self.rate = rate
+        self.warmup = warmup
+        self.gridKey = None
+        self.floor = None
+        self.spread = None
+        self.warmupFloors = []
+        self.recentSpans = deque(maxlen=window)
+        self.recentTypes = deque(maxlen=raiseCount)
+        self.flaggedRun = 0
+        self.cleanRun = 0
+        self.alarm = False
+        self.alarmType = None
+
+    def _setup(self, freqs):
+        freqs = np.asarray(freqs, dtype=np.float64)
+        self.gridKey = (freqs[0], freqs[-1], len(freqs))
+        step = freqs[1] - freqs[0] if len(freqs) > 1 else self.segmentHz
+        self.segBins = int(min(len(freqs), max(4, round(self.segmentHz/step))))
+        self.nSeg = -(-len(freqs)//self.segBins)
+        self.pad = self.nSeg*self.segBins - len(freqs)
+        self.kth = int(self.percentile/100*(self.segBins - 1))
+        first = np.arange(self.nSeg)*self.segBins
+        self.segLow = freqs[first]
+        self.segHigh = freqs[np.minimum(first + self.segBins, len(freqs)) - 1]
+        self.floor = None
+        self.spread = None
+        self.warmupFloors = []
+        self.recentSpans.clear()
+
+    def segmentFloors(self, power):
+        '''Low percentile of each segment. Short last segments are padded with their own edge value.'''
+        power = np.asarray(power, dtype=np.float32)
+        if self.pad:
+            power = np.pad(power, (0, self.pad), mode='edge')
+        return np.partition(power.reshape(self.nSeg, self.segBins), self.kth, axis=1)[:, self.kth]
+
+    def seedFromBaseline(self, freqs, baselinePower, spread=1.0):
+        '''Start from the calibration baseline (interpolated onto freqs) instead of learning from scratch.'''
+        self._setup(freqs)
+        self.floor = self.segmentFloors(baselinePower).astype(np.float64)
+        self.spread = np.broadcast_to(np.asarray(spread, dtype=np.float64), (self.nSeg,)).copy()
+
+    def update(self, freqs, power):
+        '''
+        Process one sweep. Returns a status dict:
+        alarm (bool), type, spans [(lowHz, highHz, riseDb)], fraction of the band elevated, and
+        changed (True on the sweep the alarm was raised or cleared).
+        '''
+        freqs = np.asarray(freqs)
+        if self.gridKey != (freqs[0], freqs[-1], len(freqs)):
+            self._setup(freqs)
+        current = self.segmentFloors(power).astype(np.float64)
+        if self.floor is None:
+            #No baseline, learn what normal looks like first
+            self.warmupFloors.append(current)
+            if len(self.warmupFloors) >= self.warmup:
+                history = np.vstack(self.warmupFloors)
+                self.floor = np.median(history, axis=0)
+                self.spread = np.maximum(np.median(np.abs(history - self.floor), axis=0), .5)
+                self.warmupFloors = []
+            return self._status([], 0.0, None)
+
+        rise = current - self.floor
+        sigma = 1.4826*np.maximum(self.spread, .25)
+        elevated = (rise > self.zThresh*sigma) & (rise > self.minRise)
+
+        #Incremental median/MAD: move a fixed fraction of the spread toward the new reading. Elevated
+        #segments only creep, so a long jammer isn't learned as the new normal for a long time.
+        step = self.rate*np.maximum(self.spread, .5)*np.where(elevated, .02, 1.0)
+        self.floor += step*np.sign(rise)
+        self.spread += step*np.sign(np.abs(rise) - self.spread)
+        np.maximum(self.spread, .1, out=self.spread)
+
+        spans = self._spans(elevated, rise)
+        fraction = elevated.mean()
+        jamType = self._classify(spans, fraction)
+        return self._status(spans, fraction, jamType)
+
+    def _spans(self, elevated, rise):
+        edges = np.diff(np.concatenate(([0], elevated.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        stops = np.flatnonzero(edges == -1)
+        return [(self.segLow[a], self.segHigh[b - 1], float(rise[a:b].mean())) for a, b in zip(starts, stops)]
+
+    def _classify(self, spans, fraction):
+        if not spans:
+            self.recentSpans.append(None)
+            return None
+        if fraction >= self.barrageFraction:
+            self.recentSpans.append(None)
+            return 'barrage'
+        #Center and width of the biggest span this sweep
+        low, high, _ = max(spans, key=lambda span: span[1] - span[0])
+        self.recentSpans.append(((low + high)/2, high - low))
+        seen = [span for span in self.recentSpans if span is not None]
+        if len(seen) >= 3:
+            centers = np.array([span[0] for span in seen])
+            widths = np.array([span[1] for span in seen])
+            #A swept jammer is somewhere new each sweep; a partial band jammer sits still
+            if np.std(centers) > 2*max(np.mean(widths), self.segmentHz):
+                return 'sweep'
+        return 'partial-band'
+
+    def _status(self, spans, fraction, jamType):
+        changed = False
+        if jamType is None:
+            self.cleanRun += 1
+            self.flaggedRun = 0
+            if self.alarm and self.cleanRun >= self.clearCount:
+                self.alarm, self.alarmType, changed = False, None, True
+        else:
+            self.flaggedRun += 1
+            self.cleanRun = 0
+            self.recentTypes.append(jamType)
+            if self.flaggedRun >= self.raiseCount:
+                newType = Counter(self.recentTypes).most_common(1)[0][0]
+                changed = not self.alarm or newType != self.alarmType
+                self.alarm, self.alarmType = True, newType
+        return {'alarm': self.alarm, 'type': self.alarmType, 'spans': spans,
+                'fraction': float(fraction), 'changed': changed}
+
+
+def drawJamming(ax, status):
+    '''Mark the elevated spans and put a warning on the plot while the alarm is up.'''
+    if not status:
+        return
+    for low, high, rise in status['spans']:
+        ax.axvspan(low, high, color='r', alpha=.2)
+    if status['alarm']:
+        ax.text(0.05, .80, 'JAMMING: {} ({:.0f}% of band)'.format(status['type'], 100*status['fraction']),
+                transform=ax.transAxes, color='r', fontweight='bold')
@@ -0,0 +1,255 @@
+'''
+Channel occupancy and duty cycle analysis over stored sessions.
+
+Max hold tells you something was on a frequency at some point. This tells you how busy each channel was.
+Given a channel plan (fixed channel spacing per band), every sweep is collapsed from bins to channels
+and each channel is marked active or idle for that sweep. A channel is active if any of its bins is over
+the threshold (an absolute dB level, or the baseline plus a margin). From that we get, per channel:
+
+    ~occupancy %    - percent of sweeps the channel was active
+    ~duty cycle %   - percent of session time the channel was active (sweeps weighted by their duration)
+    ~mean dwell     - active time / number of activations, in seconds
+    ~revisit time   - mean time between the starts of consecutive activations, in seconds
+    ~activations    - number of times the channel went from idle to active
+
+Everything is done on the (sweeps x channels) matrix with numpy, a chunk of sweeps at a time. The session
+is split into pieces which are analyzed in a process pool (AnalysisRunner.py), and each piece returns a
+small per channel summary (ChannelActivity) which can be stitched onto its neighbours, so nothing of size
+sweeps x bins is ever kept around or sent between processes.
+
+A sweep lasts until the next one starts. Sweep times are worked out once for the whole session before
+it is split up (AnalysisRunner.planJobs), so each piece ends exactly where the next one starts and the
+result doesn't depend on how the session was split. Only the session's last sweep is given the median
+sweep duration.
+
+Typical use:
+    plan = ChannelPlan([(30_000_000, 88_000_000, 25_000)])
+    summary = analyzeOccupancy(sessionID, plan, aboveBaseline=10).summary(plan, minOccupancy=1)
+'''
+
+import numpy as np
+import pandas as pd
+from AnalysisRunner import AnalysisKernel, runAnalysis
+
+#Bands are (lowHz, highHz, channelSpacingHz). Channel centers are lowHz + n*spacing.
+DEFAULT_BANDS = [
+    (30_000_000, 88_000_000, 25_000), #VHF low, tactical FM
+    (136_000_000, 174_000_000, 12_500), #VHF high
+    (225_000_000, 400_000_000, 25_000), #Military UHF
+]
+
+class ChannelPlan():
+    '''Fixed spacing channel plan. Bands must not overlap.'''
+    def __init__(self, bands=DEFAULT_BANDS):
+        self.bands = sorted(bands)
+        centers, bandIndex = [], []
+        for i, (low, high, spacing) in enumerate(self.bands):
+            bandCenters = np.arange(low, high + spacing/2, spacing, dtype=np.float64)
+            centers.append(bandCenters)
+            bandIndex.append(np.full(len(bandCenters), i))
+        self.centers = np.concatenate(centers)
+        self.bandIndex = np.concatenate(bandIndex)
+        self._channelMaps = {}
+
+    def channelMap(self, freqs):
+        '''
+        Channel number of every bin in freqs, or -1 for bins outside the plan. The map is cached per
+        grid since every sweep in a session uses the same one.
+        '''
+        freqs = np.asarray(freqs, dtype=np.float64)
+        key = (freqs[0], freqs[-1], len(freqs))
+        if key not in self._channelMaps:
+            channel = np.full(len(freqs), -1, dtype=np.int64)
+            offset = 0
+            for low, high, spacing in self.bands:
+                nChannels = int(round((high - low)/spacing)) + 1
+                inBand = (freqs >= low - spacing/2) & (freqs < high + spacing/2)
+                channel[inBand] = offset + np.round((freqs[inBand] - low)/spacing).astype(np.int64)
+                offset += nChannels
+            self._channelMaps[key] = channel
+        return self._channelMaps[key]
+
+    def reduce(self, power, threshold, freqs):
+        '''
+        Collapse a (sweeps x bins) matrix into a (sweeps x channels) active matrix and the list of
+        channel numbers it covers. Bins are sorted by frequency, so each channel is a contiguous run
+        of bins and the reduction is a single reduceat.
+        '''
+        channel = self.channelMap(freqs)
+        keep = np.flatnonzero(channel >= 0)
+        if len(keep) == 0:
+            return np.zeros((len(power), 0), dtype=bool), np.zeros(0, dtype=np.int64)
+        excess = power[:, keep] - threshold[keep]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(channel[keep])) + 1))
+        return np.maximum.reduceat(excess, starts, axis=1) > 0, channel[keep][starts]
+
+
+class ChannelActivity():
+    '''
+    Per channel activity over a contiguous stretch of a session. Two of these for back to back
+    stretches can be stitched together with merge(), which is how the pieces from the process pool
+    are put back together.
+    '''
+    def __init__(self, channels, nSweeps, t0, t1, occupied, activeTime, rises, firstRise, lastRise, startState, endState):
+        self.channels = channels
+        self.nSweeps = nSweeps
+        self.t0 = t0
+        self.t1 = t1
+        self.occupied = occupied
+        self.activeTime = activeTime
+        self.rises = rises
+        self.firstRise = firstRise
+        self.lastRise = lastRise
+        self.startState = startState
+        self.endState = endState
+
+    @classmethod
+    def fromChunk(cls, channels, active, seconds):
+        '''
+        Build from a (sweeps x channels) active matrix, the start time of each sweep and the end time of
+        the last one (len(active) + 1 values).
+        '''
+        duration = np.diff(seconds)
+        edges = np.diff(active.astype(np.int8), axis=0)
+        riseRow, riseChannel = np.nonzero(edges == 1)
+        riseTime = seconds[riseRow + 1]
+        nChannels = active.shape[1]
+        firstRise = np.full(nChannels, np.nan)
+        lastRise = np.full(nChannels, np.nan)
+        #nonzero is row major, so rises come out in time order; last write wins for lastRise
+        lastRise[riseChannel] = riseTime
+        firstRise[riseChannel[::-1]] = riseTime[::-1]
+        return cls(channels, len(active), seconds[0], seconds[-1],
+                   active.sum(axis=0), np.minimum(duration @ active, seconds[-1] - seconds[0]),
+                   np.bincount(riseChannel, minlength=nChannels), firstRise, lastRise,
+                   active[0].copy(), active[-1].copy())
+
+    def merge(self, other):
+        '''Stitch on the stretch which comes directly after this one.'''
+        #A channel idle at the end of this stretch and active at the start of the next rose at the boundary
+        boundaryRise = np.where(~self.endState & other.startState, other.t0, np.nan)
+        return ChannelActivity(self.channels, self.nSweeps + other.nSweeps, self.t0, other.t1,
+                               self.occupied + other.occupied,
+                               np.minimum(self.activeTime + other.activeTime, other.t1 - self.t0),
+                               self.rises + other.rises + (~self.endState & other.startState),
+                               np.fmin(np.fmin(self.firstRise, boundaryRise), other.firstRise),
+                               np.fmax(np.fmax(self.lastRise, boundaryRise), other.lastRise),
+                               self.startState, other.endState)
+
+    @classmethod
+    def join(cls, parts):
+        '''Activity of neighbouring channel spans over the same sweeps, in frequency order'''
+        def cat(name):
+            return np.concatenate([getattr(p, name) for p in parts])
+        return cls(cat('channels'), parts[0].nSweeps, min(p.t0 for p in parts), max(p.t1 for p in parts),
+                   cat('occupied'), cat('activeTime'), cat('rises'), cat('firstRise'), cat('lastRise'),
+                   cat('startState'), cat('endState'))
+
+    def summary(self, plan=None, minOccupancy=0.0):
+        '''Compact table, one row per channel. Set minOccupancy (%) to drop channels that were quiet.'''
+        duration = max(self.t1 - self.t0, 1e-9)
+        #A channel already active when the session started counts as an activation too
+        activations = self.rises + self.startState
+        with np.errstate(invalid='ignore', divide='ignore'):
+            meanDwell = np.where(activations > 0, self.activeTime/activations, np.nan)
+            revisit = np.where(self.rises > 1, (self.lastRise - self.firstRise)/(self.rises - 1), np.nan)
+        result = pd.DataFrame({'channel': self.channels,
+                               'occupancy': 100*self.occupied/max(self.nSweeps, 1),
+                               'dutyCycle': 100*self.activeTime/duration,
+                               'meanDwell': meanDwell,
+                               'revisit': revisit,
+                               'activations': activations})
+        if plan is not None:
+            result.insert(1, 'frequency', plan.centers[self.channels])
+            result.insert(2, 'band', plan.bandIndex[self.channels])
+        return result[result['occupancy'] >= minOccupancy].reset_index(drop=True)
+
+
+class OccupancyKernel(AnalysisKernel):
+    '''
+    Channel activity as an AnalysisRunner kernel. Frequency spans are only cut between channels, so every
+    channel is worked out by exactly one span.
+    '''
+    name = 'occupancy'
+
+    def __init__(self, plan=None, threshold=None, aboveBaseline=10):
+        AnalysisKernel.__init__(self, threshold, aboveBaseline)
+        self.plan = plan or ChannelPlan()
+
+    def update(self, partial, seconds, freqs, power):
+        binThreshold = self.binThreshold(freqs)
+        if binThreshold is None:
+            raise ValueError('No baseline data available, give an absolute threshold instead')
+        active, channels = self.plan.reduce(power, binThreshold, freqs)
+        chunk = ChannelActivity.fromChunk(channels, active, seconds)
+        return chunk if partial is None else partial.merge(chunk)
+
+    def mergeTime(self, first, second):
+        return first.merge(second)
+
+    def joinFrequency(self, parts):
+        return parts[0] if len(parts) == 1 else ChannelActivity.join(parts)
+
+    def alignCut(self, freqs, cut):
+        #Move the cut up to the first bin of the next channel
+        channel = self.plan.channelMap(freqs)
+        while cut < len(channel) and channel[cut] >= 0 and channel[cut] == channel[cut - 1]:
+            cut += 1
+        return cut
+
+
+def analyzeOccupancy(sessionID, plan=None, DB_Name="EARS_DB.h5", threshold=None, aboveBaseline=10, workers=None, nParts=None, freqSpans=1):
+    '''
+    Occupancy analysis of a whole stored session. The session is split into pieces on sweep
+    boundaries (and optionally freqSpans spans of channels) which are run in a process pool by
+    AnalysisRunner, then stitched back together in order.
+    Uses threshold (absolute dB) if given, otherwise baseline + aboveBaseline.
+    Returns a ChannelActivity; call .summary(plan) on it for the table.
+    '''
+    kernel = OccupancyKernel(plan, threshold, aboveBaseline)
+    return runAnalysis([sessionID], [kernel], DB_Name, workers, nParts, freqSpans)[sessionID][kernel.name]
+
+def checkSplits(seconds=60, sweepsPerSecond=4):
+    '''
+    Analyze the same simulated session with different numbers of workers and pieces and check that
+    every split gives the same table. The first channel is on the whole time, so its duty cycle has
+    to be exactly 100%.
+    '''
+    import os
+    import tempfile
+    from tables import open_file
+    from DBManager import appendSweeps
+    from FrequencyGrid import gridFor
+    nSweeps = seconds*sweepsPerSecond
+    plan = ChannelPlan([(30_000_000, 30_100_000, 25_000)])
+    freqs = np.arange(30_000_000, 30_100_001, 12_500, dtype=np.float64)
+    rng = np.random.default_rng(0)
+    power = np.full((nSweeps, len(freqs)), -60, dtype=np.float32)
+    power[:, :2] = -20
+    power[:, 4:6] = np.where(rng.random((nSweeps, 1)) < .3, -20, -60)
+    stamps = np.array(['2024:01:01:00:{:02d}:{:02d}'.format(s//60, s%60) for s in np.arange(nSweeps)//sweepsPerSecond], dtype='S20')
+    fileName = os.path.join(tempfile.mkdtemp(), 'check.h5')
+    with open_file(fileName, mode='w') as h5file:
+        appendSweeps(h5file, 'check', gridFor(freqs)[0], stamps, power)
+    first = None
+    for workers, nParts in ((1, 1), (1, 7), (2, None), (3, 5)):
+        table = analyzeOccupancy('check', plan, fileName, threshold=-40, workers=workers, nParts=nParts).summary(plan)
+        print('workers {}, parts {}: duty cycle {}'.format(workers, nParts, ', '.join('{:.3f}'.format(d) for d in table['dutyCycle'])))
+        if first is None:
+            first = table
+            assert np.isclose(table['dutyCycle'][0], 100), 'Channel which is always on is not at 100%'
+        else:
+            pd.testing.assert_frame_equal(table, first)
+    os.remove(fileName)
+    print('Same result for every split')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Channel occupancy of stored sessions')
+    parser.add_argument('--check', action='store_true', help='Check that splitting a session up does not change the result')
+    args = parser.parse_args()
+    if args.check:
+        checkSplits()
+    else:
+        parser.print_help()
@@ -0,0 +1,220 @@
+'''
+Peak list - the strongest peaks of a live scan, found in the scan process so the GUI only gets a short
+list instead of having to search the spectrum itself.
+
+Each sweep, on its frequency grid (FrequencyGrid.py):
+1. The grid is cut into blocks, and each block is boiled down to a few numbers: its floor (median), its
+   noise (84th percentile less the median, one standard deviation for gaussian noise), the height of
+   each peak found in it last time, and its highest bin more than spacingHz from those peaks. A block is
+   only searched again if, since it was last searched,
+    ~its floor has moved by more than changeDb, or
+    ~one of its peaks has moved by more than changeDb (it's changed, or gone), or
+    ~its highest other bin has moved by more than changeDb and is within 2 x noise of being prominence
+     over the floor (a new peak)
+   and the peaks of the other blocks are kept as they are. Single noise bins can't set off a search: they
+   are rarely that far over the floor, and one more high noise bin hardly moves the highest bin.
+2. The blocks that changed are searched all at once as one (blocks x bins) array, each block with
+   enough of its neighbours either side to see its surroundings:
+    ~a peak is a local maximum (higher than the bin before it, at least as high as the one after)
+    ~its prominence is its height over the higher of the lowest bins within windowHz either side, and
+     has to be at least prominence dB
+    ~it has to be the highest bin within spacingHz either side, so one signal is one peak
+   The windowed minimum and maximum are running min/max along the rows (van Herk / Gil-Werman), so the
+   search is a handful of passes over the array whatever the window size.
+3. Peaks are matched to tracked peaks within spacingHz. Each track keeps its first seen and last seen
+   time, current and max power and how many sweeps it was seen in. Tracks not seen for expire seconds
+   are dropped.
+
+peaks() gives the topN tracks by max power, which ScanProcessor sends with every sweep.
+'''
+
+import numpy as np
+
+def runningMin(rows, width):
+    '''Minimum of rows[:, i:i + width] for each i that fits (van Herk / Gil-Werman)'''
+    n, length = rows.shape
+    if width <= 1:
+        return rows.copy()
+    chunks = -(-length//width)
+    padded = np.full((n, chunks*width), np.inf)
+    padded[:, :length] = rows
+    padded = padded.reshape(n, chunks, width)
+    prefix = np.minimum.accumulate(padded, axis=2).reshape(n, -1)
+    suffix = np.minimum.accumulate(padded[:, :, ::-1], axis=2)[:, :, ::-1].reshape(n, -1)
+    return np.minimum(suffix[:, :length - width + 1], prefix[:, width - 1:length])
+
+def findPeaks(rows, margin, prominence, window, spacing):
+    '''
+    Peaks in the middle of each row of a (blocks x bins) array, where each row has margin bins either
+    side taken from its neighbours (margin >= window, spacing). Returns (row, column) of each peak, with
+    the column counted from the start of the middle.
+    '''
+    middle = rows.shape[1] - 2*margin
+    center = rows[:, margin:margin + middle]
+    local = (center > rows[:, margin - 1:margin - 1 + middle]) & (center >= rows[:, margin + 1:margin + 1 + middle])
+    #Lowest bin within window either side. runningMin(...)[i] covers rows[i:i + window + 1].
+    lows = runningMin(rows, window + 1)
+    base = np.maximum(lows[:, margin - window:margin - window + middle], lows[:, margin:margin + middle])
+    #Highest bin within spacing either side
+    highs = -runningMin(-rows, 2*spacing + 1)[:, margin - spacing:margin - spacing + middle]
+    return np.nonzero(local & (center - base >= prominence) & (center >= highs))
+
+
+class PeakTracker():
+    '''
+    Incremental peak finding and tracking on one grid at a time (see the module notes). A sweep on a
+    different grid starts over.
+    '''
+    def __init__(self, topN=20, prominence=10.0, spacingHz=25_000, windowHz=200_000, blockBins=1024,
+                 changeDb=3.0, expire=60.0, maxTracks=200):
+        self.topN = topN
+        self.prominence = prominence
+        self.spacingHz = spacingHz
+        self.windowHz = windowHz
+        self.blockBins = blockBins
+        self.changeDb = changeDb
+        self.expire = expire
+        self.maxTracks = maxTracks
+        self.gridID = None
+        self.searched = 0
+
+    def _setup(self, grid):
+        self.grid = grid
+        self.gridID = grid.id
+        self.spacing = max(1, int(round(self.spacingHz/grid.step)))
+        self.window = max(1, int(round(self.windowHz/grid.step)))
+        self.margin = max(self.window, self.spacing)
+        #Blocks much smaller than the margin would spend most of the search on their neighbours
+        self.block = max(self.blockBins, 2*self.margin)
+        self.nBlocks = -(-grid.count//self.block)
+        self.referenceFloor = None
+        self.peakBins = np.zeros(0, dtype=np.int64)
+        self.peakPower = np.zeros(0)
+        self.trackBins = np.zeros(0, dtype=np.int64)
+        self.firstSeen = np.zeros(0)
+        self.lastSeen = np.zeros(0)
+        self.power = np.zeros(0)
+        self.maxPower = np.zeros(0)
+        self.hits = np.zeros(0, dtype=np.int64)
+
+    def _highestOther(self, body, blocks):
+        '''Highest bin of each of blocks (sorted) more than spacing bins from the known peaks'''
+        highest = (body if len(blocks) == self.nBlocks else body[blocks]).max(axis=1)
+        near = (self.peakBins[:, np.newaxis] + np.arange(-self.spacing, self.spacing + 1)).ravel()
+        near = near[(near >= 0) & (near < body.size)]
+        near = near[np.isin(near//self.block, blocks)]
+        if len(near):
+            #Only the few blocks with peaks in them need doing again, without the bins near the peaks
+            hit = np.unique(near//self.block)
+            rows = body[hit]
+            rows[np.searchsorted(hit, near//self.block), near % self.block] = -np.inf
+            highest[np.searchsorted(blocks, hit)] = rows.max(axis=1)
+        return highest
+
+    def update(self, grid, row, t):
+        '''Take a sweep (one value per bin of grid, as from grid.place) seen at t seconds. Returns the peak bins.'''
+        if grid.id != self.gridID:
+            self._setup(grid)
+        row = np.asarray(row, dtype=np.float32)
+        if np.isnan(row).any():
+            row = np.where(np.isnan(row), np.nanmin(row) if not np.isnan(row).all() else 0.0, row)
+        size = self.nBlocks*self.block
+        padded = np.pad(row, (self.margin, size - len(row) + self.margin), mode='edge')
+        body = padded[self.margin:self.margin + size].reshape(self.nBlocks, self.block)
+        #Median and 84th percentile from one partial sort
+        middle, upper = self.block//2, int(self.block*.841)
+        quantiles = np.partition(body, (middle, upper), axis=1)
+        floor = quantiles[:, middle]
+        noise = quantiles[:, upper] - floor
+        if self.referenceFloor is None:
+            changed = np.ones(self.nBlocks, dtype=bool)
+        else:
+            other = self._highestOther(body, np.arange(self.nBlocks))
+            changed = (np.abs(floor - self.referenceFloor) > self.changeDb) | \
+                      ((np.abs(other - self.referenceOther) > self.changeDb) &
+                       (other > floor + self.prominence - 2*noise))
+            moved = np.abs(row[self.peakBins] - self.peakPower) > self.changeDb
+            changed[self.peakBins[moved]//self.block] = True
+            #A peak near the edge of a block can move into (or be outdone from) the next block, so the
+            #neighbours of a changed block are searched too
+            changed[1:] |= changed[:-1].copy()
+            changed[:-1] |= changed[1:].copy()
+        blocks = np.flatnonzero(changed)
+        self.searched = len(blocks)
+        if len(blocks):
+            windows = padded[(blocks*self.block)[:, np.newaxis] + np.arange(self.block + 2*self.margin)]
+            which, column = findPeaks(windows, self.margin, self.prominence, self.window, self.spacing)
+            found = blocks[which]*self.block + column
+            found = found[found < grid.count]
+            kept = ~changed[self.peakBins//self.block]
+            order = np.argsort(np.concatenate((self.peakBins[kept], found)), kind='stable')
+            self.peakBins = np.concatenate((self.peakBins[kept], found))[order]
+            self.peakPower = np.concatenate((self.peakPower[kept], row[found]))[order]
+            #What the searched blocks are compared with from now on
+            if self.referenceFloor is None:
+                self.referenceFloor = floor.copy()
+                self.referenceOther = np.zeros(self.nBlocks)
+            self.referenceFloor[blocks] = floor[blocks]
+            self.referenceOther[blocks] = self._highestOther(body, blocks)
+        self._track(self.peakBins, row[self.peakBins], t)
+        return self.peakBins
+
+    def _track(self, bins, power, t):
+        #Nearest track either side of each peak, by bin
+        matched = np.full(len(bins), -1)
+        if len(self.trackBins) and len(bins):
+            order = np.argsort(self.trackBins)
+            sortedBins = self.trackBins[order]
+            right = np.clip(np.searchsorted(sortedBins, bins), 0, len(sortedBins) - 1)
+            left = np.clip(right - 1, 0, len(sortedBins) - 1)
+            nearer = np.where(np.abs(sortedBins[left] - bins) <= np.abs(sortedBins[right] - bins), left, right)
+            close = np.abs(sortedBins[nearer] - bins) <= self.spacing
+            matched[close] = order[nearer[close]]
+            #Two peaks on one track: the first keeps it, the other starts its own
+            taken = matched >= 0
+            first = np.unique(matched[taken], return_index=True)[1]
+            again = np.ones(taken.sum(), dtype=bool)
+            again[first] = False
+            matched[np.flatnonzero(taken)[again]] = -1
+        hit = matched[matched >= 0]
+        self.trackBins[hit] = bins[matched >= 0]
+        self.lastSeen[hit] = t
+        self.power[hit] = power[matched >= 0]
+        self.maxPower[hit] = np.maximum(self.maxPower[hit], power[matched >= 0])
+        self.hits[hit] += 1
+        new = matched < 0
+        nNew = new.sum()
+        self.trackBins = np.concatenate((self.trackBins, bins[new]))
+        self.firstSeen = np.concatenate((self.firstSeen, np.full(nNew, t)))
+        self.lastSeen = np.concatenate((self.lastSeen, np.full(nNew, t)))
+        self.power = np.concatenate((self.power, power[new]))
+        self.maxPower = np.concatenate((self.maxPower, power[new]))
+        self.hits = np.concatenate((self.hits, np.ones(nNew, dtype=np.int64)))
+        #Forget tracks gone quiet, and the weakest of the rest if there are too many
+        keep = t - self.lastSeen <= self.expire
+        if keep.sum() > self.maxTracks:
+            strongest = np.argsort(-np.where(keep, self.maxPower, -np.inf), kind='stable')[:self.maxTracks]
+            keep = np.zeros(len(keep), dtype=bool)
+            keep[strongest] = True
+        for name in ('trackBins', 'firstSeen', 'lastSeen', 'power', 'maxPower', 'hits'):
+            setattr(self, name, getattr(self, name)[keep])
+        self.lastUpdate = t
+
+    def peaks(self, topN=None):
+        '''The strongest tracked peaks (by max power) as dicts, strongest first'''
+        if self.gridID is None:
+            return []
+        top = np.argsort(-self.maxPower, kind='stable')[:topN or self.topN]
+        freqs = self.grid.start + self.grid.step*self.trackBins[top]
+        return [{'frequency': float(freq), 'power': float(self.power[i]), 'maxPower': float(self.maxPower[i]),
+                 'firstSeen': float(self.firstSeen[i]), 'lastSeen': float(self.lastSeen[i]),
+                 'hits': int(self.hits[i]), 'live': bool(self.lastSeen[i] == self.lastUpdate)}
+                for freq, i in zip(freqs, top)]
+
+
+def drawPeaks(ax, peaks):
+    '''Mark the tracked peaks on a matplotlib axes, numbered strongest first like the peak table'''
+    for n, peak in enumerate(peaks):
+        ax.plot(peak['frequency'], peak['maxPower'], 'v', color='c' if peak['live'] else 'gray', markersize=5)
+        ax.annotate(str(n + 1), (peak['frequency'], peak['maxPower']), textcoords='offset points', xytext=(0, 6),
+                    ha='center', color='c', fontsize=7)
@@ -0,0 +1,229 @@
+'''
+Min/max decimation of spectra for plotting, so drawing a sweep costs about the same whatever its size.
+
+A Full Scan (30M:1.7G) is millions of bins, but the plot is maybe 1500 pixels wide. Each pixel column
+only needs the lowest and the highest value that falls in it: drawn as a line, those two points per
+column trace the same envelope as all of the bins, narrow peaks included. minMaxDecimate() does that
+for every column at once with np.fmin/np.fmax.reduceat over the column boundaries.
+
+PlotDecimator keeps decimated series between draws. Columns are laid out on fixed zoom levels (level k
+is 2^(k/4) bins per column, lined up with the first bin) and a level covers the whole series, so panning is
+a slice of what's already cached and zooming back to a level seen before costs nothing. A view uses the
+finest level whose columns are at least a pixel wide, which keeps it to at most 2 points per pixel. A
+series is only decimated again when set() is given different data.
+
+    decimator = PlotDecimator()
+    decimator.set('current', freqs, power)
+    x, y = decimator.view('current', freqLow, freqHigh, widthPx)
+    drawSpectrum(ax, decimator, df, maxDF, baseline)       #What the live plots draw for a scan payload
+
+The live plots can be zoomed and panned (ZoomPan). The visible range goes back to the scan process,
+which from then on only sends what that view needs (reduceForView): the bins in view at full resolution
+and a min/max overview of the rest, so narrowing in on 200 kHz of a Full Scan doesn't cost any more to
+ship or draw than showing all of it.
+'''
+
+from collections import OrderedDict
+import numpy as np
+
+#Quarter octave steps between zoom levels, so a view's columns are never much wider than a pixel
+LEVELS_PER_OCTAVE = 4
+
+def minMaxDecimate(x, y, columns):
+    '''
+    The lowest and highest point of each run of equal numbers in columns (the pixel column of each point,
+    non decreasing), kept in x order. nan is ignored unless a column is all nan. Returns (x, y) with two
+    points per column, or one where a column only has one point.
+    '''
+    n = len(x)
+    if n == 0:
+        return x, y
+    starts = np.flatnonzero(np.concatenate(([True], columns[1:] != columns[:-1])))
+    counts = np.diff(np.append(starts, n))
+    index = np.arange(n)
+    #Where the first min and the first max of each column are. All nan columns fall back to their first point.
+    lows = np.repeat(np.fmin.reduceat(y, starts), counts)
+    highs = np.repeat(np.fmax.reduceat(y, starts), counts)
+    iLow = np.minimum.reduceat(np.where(y == lows, index, n), starts)
+    iHigh = np.minimum.reduceat(np.where(y == highs, index, n), starts)
+    iLow = np.where(iLow == n, starts, iLow)
+    iHigh = np.where(iHigh == n, starts, iHigh)
+    #Each pair in frequency order so the line never doubles back
+    pick = np.column_stack((np.minimum(iLow, iHigh), np.maximum(iLow, iHigh))).ravel()
+    keep = np.ones(len(pick), dtype=bool)
+    keep[1::2] = pick[1::2] != pick[0::2]
+    pick = pick[keep]
+    return x[pick], y[pick]
+
+
+def reduceForView(x, y, low=None, high=None, widthPx=1000):
+    '''
+    The points of a series a viewer showing low..high (everything if None) on widthPx pixels
+    needs: every bin in view, or their per-pixel min/max once there are more than 2 per pixel (which
+    looks the same), plus a widthPx column min/max overview of the rest so the view can be panned before
+    the next sweep arrives. At most about 4*widthPx points whatever the size of the series.
+    '''
+    if len(x) <= 2*widthPx:
+        return x, y
+    if np.any(x[1:] < x[:-1]):
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+    if x[-1] <= x[0]:
+        return x, y
+    low = x[0] if low is None else max(low, x[0])
+    high = x[-1] if high is None else min(high, x[-1])
+    start, stop = np.searchsorted(x, low, 'left'), np.searchsorted(x, high, 'right')
+    viewX, viewY = x[start:stop], y[start:stop]
+    if len(viewX) > 2*widthPx and high > low:
+        viewX, viewY = minMaxDecimate(viewX, viewY, ((viewX - low)//((high - low)/widthPx)).astype(np.int64))
+    overX, overY = minMaxDecimate(x, y, ((x - x[0])//((x[-1] - x[0])/widthPx)).astype(np.int64))
+    left, right = overX < low, overX > high
+    return np.concatenate((overX[left], viewX, overX[right])), np.concatenate((overY[left], viewY, overY[right]))
+
+
+class PlotDecimator():
+    '''Named (frequency, power) series and their decimations, cached per zoom level (see the module notes)'''
+    def __init__(self, cachedLevels=4):
+        self.cachedLevels = cachedLevels
+        self.series = {}
+        self.cache = {}
+
+    def set(self, name, x, y):
+        '''New data for a series. The cached levels are kept if it's the same as before.'''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        old = self.series.get(name)
+        if old is not None and len(old[0]) == len(x) and np.array_equal(old[1], y, equal_nan=True) \
+                and np.array_equal(old[0], x):
+            return
+        if len(x) > 1 and np.any(x[1:] < x[:-1]):
+            order = np.argsort(x, kind='stable')
+            x, y = x[order], y[order]
+        step = (x[-1] - x[0])/(len(x) - 1) if len(x) > 1 else 0.0
+        self.series[name] = (x, y, step)
+        self.cache[name] = OrderedDict()
+
+    def level(self, name, xLow, xHigh, widthPx):
+        '''Finest zoom level whose columns are at least a pixel wide for this view. 0 is the raw data.'''
+        step = self.series[name][2]
+        pixel = (xHigh - xLow)/max(widthPx, 1)
+        if step <= 0 or pixel <= step:
+            return 0
+        return int(np.ceil(LEVELS_PER_OCTAVE*np.log2(pixel/step)))
+
+    def view(self, name, xLow=None, xHigh=None, widthPx=1000):
+        '''
+        (x, y) of a series to draw between xLow and xHigh (all of it by default) on widthPx pixels. One
+        point either side of the view is included, so the line runs out to the edges.
+        '''
+        x, y, step = self.series[name]
+        if not len(x):
+            return x, y
+        xLow = x[0] if xLow is None else xLow
+        xHigh = x[-1] if xHigh is None else xHigh
+        level = self.level(name, xLow, xHigh, widthPx)
+        if level:
+            cached = self.cache[name]
+            if level not in cached:
+                columns = ((x - x[0])//(step*2**(level/LEVELS_PER_OCTAVE))).astype(np.int64)
+                cached[level] = minMaxDecimate(x, y, columns)
+                while len(cached) > self.cachedLevels:
+                    cached.popitem(last=False)
+            cached.move_to_end(level)
+            x, y = cached[level]
+        low = max(np.searchsorted(x, xLow, 'left') - 1, 0)
+        high = np.searchsorted(x, xHigh, 'right') + 1
+        return x[low:high], y[low:high]
+
+
+def drawSpectrum(ax, decimator, df, maxDF, baseline, view=None):
+    '''
+    Draw the current sweep, max hold and baseline of a scan payload, decimated to the width of ax. view
+    is the (low, high) frequency range to show, the whole sweep by default. Returns the range shown.
+    '''
+    decimator.set('max hold', maxDF['freqCompare'].values, maxDF['power'].values)
+    decimator.set('current', df['frequency'].values, df['power'].values)
+    decimator.set('baseline', baseline['frequency'].values, baseline['power'].values)
+    if view is None:
+        freqs = df['frequency'].values
+        view = (min(freqs.min(), maxDF['freqCompare'].values.min()), max(freqs.max(), maxDF['freqCompare'].values.max()))
+    low, high = view
+    widthPx = ax.get_window_extent().width
+    x, y = decimator.view('max hold', low, high, widthPx)
+    ax.plot(x, y, 'y', linewidth=.5, label='max hold')
+    x, y = decimator.view('current', low, high, widthPx)
+    lines = ax.plot(x, y, linewidth=.5, alpha=.7, label='current')
+    ax.fill_between(x, y, np.nanmin(df['power'].values), alpha=.5, color=lines[0].get_color())
+    if len(baseline):
+        x, y = decimator.view('baseline', low, high, widthPx)
+        ax.plot(x, y, 'r-.', linewidth=.5, alpha=.7, label='baseline')
+    ax.set_xlim(low, high)
+    ax.set_xlabel('frequency')
+    ax.set_title('ScanView')
+    ax.grid(True)
+    ax.legend()
+    return view
+
+
+class ZoomPan():
+    '''
+    Zoom and pan for a live spectrum plot: scroll zooms around the cursor, dragging pans and a double
+    click goes back to the whole range. The live plots clear their axes every sweep, so the view is kept
+    here and passed to drawSpectrum. redraw() is called as the view moves, and onChange(low, high, widthPx)
+    once it settles (scroll, or the end of a drag), with (None, None, widthPx) for the whole range.
+    '''
+    def __init__(self, canvas, ax, redraw=None, onChange=None, zoomStep=1.5):
+        self.ax = ax
+        self.redraw = redraw
+        self.onChange = onChange
+        self.zoomStep = zoomStep
+        self.view = None
+        self.dragFrom = None
+        canvas.mpl_connect('scroll_event', self.scroll)
+        canvas.mpl_connect('button_press_event', self.press)
+        canvas.mpl_connect('motion_notify_event', self.drag)
+        canvas.mpl_connect('button_release_event', self.release)
+        #A wider plot needs more points
+        canvas.mpl_connect('resize_event', lambda event: self.setView(self.view))
+
+    def widthPx(self):
+        return int(self.ax.get_window_extent().width)
+
+    def setView(self, view, settled=True):
+        self.view = view
+        if self.redraw is not None:
+            self.redraw()
+        if settled and self.onChange is not None:
+            low, high = view if view is not None else (None, None)
+            self.onChange(low, high, self.widthPx())
+
+    def scroll(self, event):
+        if event.inaxes is not self.ax or event.xdata is None:
+            return
+        low, high = self.ax.get_xlim()
+        scale = self.zoomStep**-event.step
+        self.setView((event.xdata - (event.xdata - low)*scale, event.xdata + (high - event.xdata)*scale))
+
+    def press(self, event):
+        if event.inaxes is not self.ax or event.button != 1:
+            return
+        if event.dblclick:
+            self.dragFrom = None
+            self.setView(None)
+            return
+        self.dragFrom = (event.x, self.ax.get_xlim())
+
+    def drag(self, event):
+        if self.dragFrom is None or event.x is None:
+            return
+        x, (low, high) = self.dragFrom
+        shift = (event.x - x)*(high - low)/max(self.widthPx(), 1)
+        self.setView((low - shift, high - shift), settled=False)
+
+    def release(self, event):
+        if self.dragFrom is None:
+            return
+        x, start = self.dragFrom
+        self.dragFrom = None
+        if self.view is not None and tuple(self.view) != tuple(start):
+            self.setView(self.view)
@@ -0,0 +1,156 @@
+'''
+How power is stored in the sweep store (/sweeps/g<gridID>/power in the EARS database).
+
+RTL-SDR dB readings are only good to a few tenths of a dB, so 4 byte floats mostly store noise, and
+noise doesn't compress. The codecs trade that away for smaller files and less writing to the SD card:
+
+    ~float32 - as measured (the default, unless EARS_POWER_CODEC says otherwise)
+    ~fixed   - int16 in 0.1 dB steps. Exact to 0.05 dB over +-3276 dB.
+    ~int16   - int16 with a scale and offset per sweep fitted to that sweep's range. Error under
+               range/65534, ex. 0.001 dB for an 80 dB sweep.
+    ~int8    - int8 with a scale and offset per sweep. Error under range/508, ex. 0.16 dB for 80 dB.
+The int arrays go through the shuffle filter and zlib like the float ones. The most negative value of
+each int type is kept for missing (NaN) bins.
+
+A grid's group says which codec it was made with (its 'codec' attribute; groups from before codecs
+existed are float32), so a database can mix them and DBManager decodes whatever it reads. The per
+sweep scale and offset are stored next to power as /sweeps/g<gridID>/scale and /offset. The codec is
+picked when a grid's group is made, so a new codec applies to grids which weren't stored yet.
+
+    python PowerCodec.py    #Size, write and read speed and error of each codec on simulated sweeps
+'''
+
+import os
+import numpy as np
+
+#Codec for new grids when the writer doesn't say. EARS_POWER_CODEC=int8 makes every logger use int8.
+DEFAULT_CODEC = os.environ.get('EARS_POWER_CODEC', 'float32')
+
+class PowerCodec():
+    '''
+    :param dtype: numpy type stored
+    :param step: fixed dB per step, or None to fit a scale and offset to every sweep
+    '''
+    def __init__(self, name, dtype, step=None):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.step = step
+        self.quantized = self.dtype.kind == 'i'
+        self.perSweep = self.quantized and step is None
+        if self.quantized:
+            info = np.iinfo(self.dtype)
+            self.missing = info.min
+            self.maxLevel = info.max
+
+    def __repr__(self):
+        return 'PowerCodec({})'.format(self.name)
+
+    def encode(self, power):
+        '''(values, scale, offset) for (sweeps x bins) power. scale and offset have one entry per sweep.'''
+        power = np.atleast_2d(np.asarray(power, dtype=np.float32))
+        if not self.quantized:
+            return power, None, None
+        missing = np.isnan(power)
+        if self.perSweep:
+            #Fit each sweep into -maxLevel..maxLevel
+            low = np.nanmin(np.where(missing.all(axis=1, keepdims=True), 0, power), axis=1)
+            high = np.nanmax(np.where(missing.all(axis=1, keepdims=True), 0, power), axis=1)
+            scale = np.maximum((high - low)/(2*self.maxLevel), 1e-6).astype(np.float32)
+            offset = (low + scale*self.maxLevel).astype(np.float32)
+        else:
+            scale = np.full(len(power), self.step, dtype=np.float32)
+            offset = np.zeros(len(power), dtype=np.float32)
+        values = np.rint((power - offset[:, np.newaxis])/scale[:, np.newaxis])
+        values = np.clip(np.nan_to_num(values), -self.maxLevel, self.maxLevel).astype(self.dtype)
+        values[missing] = self.missing
+        return values, scale, offset
+
+    def decode(self, values, scale=None, offset=None):
+        '''float32 power from what encode() gave'''
+        if not self.quantized:
+            return np.asarray(values, dtype=np.float32)
+        if scale is None:
+            scale = np.full(len(values), self.step, dtype=np.float32)
+            offset = np.zeros(len(values), dtype=np.float32)
+        power = values.astype(np.float32)*scale[:, np.newaxis] + offset[:, np.newaxis]
+        power[values == self.missing] = np.nan
+        return power
+
+
+CODECS = {codec.name: codec for codec in (PowerCodec('float32', np.float32), PowerCodec('fixed', np.int16, .1),
+                                          PowerCodec('int16', np.int16), PowerCodec('int8', np.int8))}
+
+def getCodec(name):
+    '''Codec by name, ValueError if there's no such codec. None is DEFAULT_CODEC.'''
+    if name is None:
+        name = DEFAULT_CODEC
+    if isinstance(name, bytes):
+        name = name.decode()
+    if name not in CODECS:
+        raise ValueError('Unknown power codec {}. Pick one of {}'.format(name, ', '.join(CODECS)))
+    return CODECS[name]
+
+
+def benchmark(nSweeps=200, freqRange='30M:400M', blockRows=1):
+    '''
+    File size, write and read throughput and worst error for each codec on nSweeps simulated sweeps.
+    blockRows=1 sends them one at a time through DB_Logger, which opens the file for every sweep like it
+    does for a live scan. More than 1 writes blockRows at a time to one open file with DBManager.appendSweeps
+    in bulk sized chunks, like the rtl_power importer.
+    '''
+    import tempfile
+    import time
+    from tables import open_file
+    from DBManager import DB_Logger, appendSweeps, iterSessionSweeps
+    from SDRSimulator import SimulatedSDR
+    from ScanPlan import compilePlan
+    plan = compilePlan(freqRange)
+    sdr = SimulatedSDR(plan, [(100_000_000, 40, 200_000), (300_000_000, 25, 0)], seed=0)
+    sweeps = sdr.sweeps(nSweeps)
+    times = np.array(['2024:01:01:00:00:00']*nSweeps, dtype='S20')
+    rawMB = sweeps.nbytes/1e6
+
+    class LogQueue():
+        #Stands in for the logger's queue, making each sweep's packet as it's asked for
+        def __init__(self):
+            self.sent = 0
+        def get(self):
+            self.sent += 1
+            if self.sent > nSweeps:
+                return 'Quit'
+            return ('2024:01:01:00:00:00', np.column_stack((plan.grid.freqs, sweeps[self.sent - 1])), False, 'measurement')
+        def empty(self):
+            return True
+        def close(self):
+            pass
+
+    print('{} sweeps of {} bins ({:.1f} MB as float32), {}'.format(nSweeps, plan.nBins, rawMB,
+          'one at a time through DB_Logger' if blockRows == 1 else 'written {} at a time'.format(blockRows)))
+    print('{:10s} {:>10s} {:>8s} {:>12s} {:>12s} {:>10s}'.format('codec', 'file MB', 'B/sweep', 'write MB/s', 'read MB/s', 'err dB'))
+    for name in CODECS:
+        fileName = os.path.join(tempfile.mkdtemp(), 'bench.h5')
+        start = time.perf_counter()
+        if blockRows == 1:
+            import DBManager
+            DB_Logger(LogQueue(), fileName, buildPyramid=False, codec=name)
+            sessionID = DBManager.sessionID
+        else:
+            sessionID = 'bench'
+            with open_file(fileName, mode='w') as h5file:
+                for i in range(0, nSweeps, blockRows):
+                    appendSweeps(h5file, sessionID, plan.grid, times[i:i + blockRows], sweeps[i:i + blockRows], codec=name,
+                                 chunkRows=None)
+        writeTime = time.perf_counter() - start
+        size = os.path.getsize(fileName)
+        start = time.perf_counter()
+        with open_file(fileName, mode='r') as h5file:
+            read = np.vstack([power for t, f, power in iterSessionSweeps(sessionID, h5file=h5file)])
+        readTime = time.perf_counter() - start
+        print('{:10s} {:10.2f} {:8.0f} {:12.1f} {:12.1f} {:10.3f}'.format(name, size/1e6, size/nSweeps, rawMB/writeTime,
+                                                                       rawMB/readTime, np.abs(read - sweeps).max()))
+        os.remove(fileName)
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark(blockRows=50)
@@ -0,0 +1,205 @@
+'''
+Importer for captures made with the old rtl_power (see rtl_power_script.py and SpectroViewer.py), so
+they can be browsed and analyzed like anything EARS logs itself.
+
+rtl_power writes one CSV line per hop:
+    date, time, Hz low, Hz high, Hz step, samples, dB, dB, ...
+Bin n of a line is at Hz low + n*Hz step. A sweep is the run of hops with the same time stamp, from the
+lowest Hz low up to the highest, so a sweep is spread over many lines.
+
+The importer reads a file a chunk of lines at a time, works out the bins per hop from the first line,
+and assembles each sweep into one row on a FrequencyGrid covering all of its hops. Rows go into the
+sweep store of the database (DBManager.appendSweeps) as one new session per file, so memory stays
+bounded no matter how big the archive is. All of the rearranging is done with array indexing: the
+sweeps in a chunk go into their rows in one assignment.
+
+    sessionID, nSweeps = importRtlPower('Data/220221_090207_VHF_scan.csv')
+    python RtlPowerImport.py Data/*.csv --db EARS_DB.h5
+
+~A sweep with fewer hops than one already seen on the same range (the capture was stopped part way
+ through it) is skipped, and counted in the report.
+~Gaps between hops are filled in from the neighbouring bins. Where hops overlap the later one wins.
+~If the range changes part way through a file, the sweeps after the change go on their own grid.
+'''
+
+import os
+import numpy as np
+import pandas as pd
+from uuid import uuid4
+from FrequencyGrid import FrequencyGrid, registerGrid
+
+CSV_COLUMNS = ['date', 'time', 'HzLow', 'HzHigh', 'HzStep', 'samples']
+
+def binsPerHop(fileName):
+    '''Number of dB columns in an rtl_power CSV, from its first line'''
+    with open(fileName) as f:
+        for line in f:
+            if line.strip():
+                return len(line.split(',')) - len(CSV_COLUMNS)
+    return 0
+
+def readRtlPowerChunks(fileName, chunkRows=50_000, bins=None):
+    '''The lines of an rtl_power CSV as DataFrames of up to chunkRows lines (power columns power0...)'''
+    bins = bins or binsPerHop(fileName)
+    powCols = ['power'+str(i) for i in range(bins)]
+    dtypes = dict({'date': str, 'time': str, 'HzLow': np.float64, 'HzHigh': np.float64, 'HzStep': np.float64,
+                   'samples': np.float64}, **{col: np.float32 for col in powCols})
+    return pd.read_csv(fileName, header=None, names=CSV_COLUMNS + powCols, dtype=dtypes, index_col=False,
+                       skipinitialspace=True, chunksize=chunkRows)
+
+
+class _Layout():
+    '''Where each hop of one kind of sweep goes on its grid, and how to fill the gaps between hops.'''
+    def __init__(self, hzLows, step, bins):
+        hzLows = np.unique(hzLows)
+        self.nHops = len(hzLows)
+        self.low, self.high = hzLows[0], hzLows[-1]
+        self.bins = bins
+        self.grid = registerGrid(FrequencyGrid(self.low, step, int(np.rint((self.high - self.low)/step)) + bins))
+        covered = np.zeros(self.grid.count, dtype=bool)
+        for offset in self.grid.indexOf(hzLows):
+            covered[offset:offset + bins] = True
+        self.holes = np.flatnonzero(~covered)
+        if len(self.holes):
+            #Each gap bin is interpolated from the nearest covered bins either side
+            filled = np.flatnonzero(covered)
+            upper = np.clip(np.searchsorted(filled, self.holes), 1, len(filled) - 1)
+            self.left, self.right = filled[upper - 1], filled[upper]
+            self.weight = ((self.holes - self.left)/(self.right - self.left)).astype(np.float32)
+
+    def covers(self, low, high, nHops):
+        return self.low <= low and high <= self.high and nHops < self.nHops
+
+    def fill(self, sweepRows, hzLows, values, nSweeps):
+        '''(nSweeps x grid.count) rows from the hops of nSweeps sweeps (sweepRows says which sweep each hop is in)'''
+        rows = np.full((nSweeps, self.grid.count), np.nan, dtype=np.float32)
+        columns = self.grid.indexOf(hzLows)[:, np.newaxis] + np.arange(self.bins)
+        rows[sweepRows[:, np.newaxis], columns] = values
+        if len(self.holes):
+            rows[:, self.holes] = rows[:, self.left]*(1 - self.weight) + rows[:, self.right]*self.weight
+        return rows
+
+
+class SweepAssembler():
+    '''
+    Turns rtl_power lines into sweeps, a chunk at a time. add() yields (grid, times, power) blocks for the
+    complete sweeps it has been given; the last sweep of a chunk is held back in case it continues in the
+    next one, until finish().
+    '''
+    def __init__(self, bins):
+        self.bins = bins
+        self.layouts = {}
+        self.pending = None
+        self.nSweeps = 0
+        self.skipped = 0
+
+    def add(self, chunk):
+        if self.pending is not None:
+            chunk = pd.concat((self.pending, chunk), ignore_index=True)
+        chunk = chunk.dropna(subset=['HzLow', 'HzStep'])
+        if not len(chunk):
+            return
+        stamps = (chunk['date'].str.strip().str.replace('-', ':') + ':' + chunk['time'].str.strip()).values.astype('S20')
+        hzLows = chunk['HzLow'].values
+        #A new sweep starts when the time stamp changes, or the hops start over from the bottom
+        starts = np.flatnonzero(np.concatenate(([True], (stamps[1:] != stamps[:-1]) | (hzLows[1:] <= hzLows[:-1]))))
+        self.pending = chunk.iloc[starts[-1]:]
+        if len(starts) > 1:
+            yield from self._assemble(chunk.iloc[:starts[-1]], stamps, starts[:-1])
+
+    def finish(self):
+        if self.pending is not None and len(self.pending):
+            chunk, self.pending = self.pending, None
+            stamps = (chunk['date'].str.strip().str.replace('-', ':') + ':' + chunk['time'].str.strip()).values.astype('S20')
+            yield from self._assemble(chunk, stamps, np.array([0]))
+
+    def _assemble(self, chunk, stamps, starts):
+        hzLows = chunk['HzLow'].values
+        steps = chunk['HzStep'].values
+        values = chunk.iloc[:, len(CSV_COLUMNS):len(CSV_COLUMNS) + self.bins].values.astype(np.float32, copy=False)
+        nHops = np.diff(np.append(starts, len(chunk)))
+        lows = np.minimum.reduceat(hzLows, starts)
+        highs = np.maximum.reduceat(hzLows, starts)
+        sweepOf = np.repeat(np.arange(len(starts)), nHops)
+        #Sweeps in a chunk are nearly always all the same kind, so this loop is over one or two keys
+        keys = np.column_stack((nHops, lows, highs, steps[starts]))
+        unique, kind = np.unique(keys, axis=0, return_inverse=True)
+        kind = kind.ravel()
+        for k, (n, low, high, step) in enumerate(unique):
+            layout = self._layout(int(n), low, high, step, hzLows[starts[kind == k][0]:][:int(n)])
+            sweeps = np.flatnonzero(kind == k)
+            if layout is None:
+                self.skipped += len(sweeps)
+                continue
+            #Renumber the chosen sweeps 0..len-1 for their rows of the block
+            rowOf = np.full(len(starts), -1)
+            rowOf[sweeps] = np.arange(len(sweeps))
+            hops = rowOf[sweepOf] >= 0
+            power = layout.fill(rowOf[sweepOf][hops], hzLows[hops], values[hops], len(sweeps))
+            self.nSweeps += len(sweeps)
+            yield layout.grid, stamps[starts[sweeps]], power
+
+    def _layout(self, nHops, low, high, step, hzLows):
+        key = (nHops, low, high, step)
+        if key not in self.layouts:
+            if any(layout.covers(low, high, nHops) for layout in self.layouts.values() if layout is not None):
+                #Part of a sweep we've seen whole
+                self.layouts[key] = None
+            else:
+                self.layouts[key] = _Layout(hzLows, step, self.bins)
+        return self.layouts[key]
+
+
+def iterRtlPowerSweeps(fileName, chunkRows=50_000, assembler=None):
+    '''(grid, times, power) blocks of the sweeps in an rtl_power CSV, a chunk of lines at a time'''
+    bins = binsPerHop(fileName)
+    if bins <= 0:
+        return
+    assembler = assembler or SweepAssembler(bins)
+    for chunk in readRtlPowerChunks(fileName, chunkRows, bins):
+        yield from assembler.add(chunk)
+    yield from assembler.finish()
+
+def importRtlPower(fileName, DB_Name="EARS_DB.h5", sessionID=None, chunkRows=50_000, buildPyramid=True, codec=None):
+    '''
+    Import an rtl_power CSV as a new session of the EARS database. Returns (sessionID, sweeps imported).
+    The session's pyramid is built afterwards so it shows up in the history browser. codec is how power
+    is stored for grids new to the database (see PowerCodec.py).
+    '''
+    from tables import open_file
+    from DBManager import appendSweeps, logCommand
+    sessionID = sessionID or str(uuid4())
+    assembler = SweepAssembler(binsPerHop(fileName))
+    with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+        first = None
+        for grid, times, power in iterRtlPowerSweeps(fileName, chunkRows, assembler):
+            appendSweeps(h5file, sessionID, grid, times, power, codec=codec, chunkRows=None)
+            if first is None:
+                first = times[0]
+        if first is None:
+            print('No sweeps found in {}'.format(fileName))
+            return sessionID, 0
+        logCommand(h5file, sessionID, first, 'rtl_power import {}'.format(os.path.basename(fileName))[:100])
+    print('Imported {} sweeps from {} as session {}'.format(assembler.nSweeps, fileName, sessionID))
+    if assembler.skipped:
+        print('Skipped {} incomplete sweeps'.format(assembler.skipped))
+    if buildPyramid:
+        from SpectrumPyramid import buildSessionPyramid
+        buildSessionPyramid(sessionID, DB_Name)
+    return sessionID, assembler.nSweeps
+
+
+if __name__ == '__main__':
+    import argparse
+    from PowerCodec import CODECS
+    parser = argparse.ArgumentParser(description='Import rtl_power CSV captures into the EARS database')
+    parser.add_argument('files', nargs='+', help='rtl_power CSV files, or folders of them')
+    parser.add_argument('--db', default='EARS_DB.h5')
+    parser.add_argument('--chunk', type=int, default=50_000, help='Lines read at a time')
+    parser.add_argument('--no-pyramid', action='store_true', help="Don't build history pyramids")
+    parser.add_argument('--codec', default=None, choices=list(CODECS), help='Power storage for new grids')
+    args = parser.parse_args()
+    for path in args.files:
+        names = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.csv')] if os.path.isdir(path) else [path]
+        for name in names:
+            importRtlPower(name, args.db, chunkRows=args.chunk, buildPyramid=not args.no_pyramid, codec=args.codec)
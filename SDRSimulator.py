@@ -1,51 +1,69 @@
 '''
-This module contains functions to handle a command with the same arguments as the sdr drivers, and return a similar file handle with a bystream connected to it. It will further take arguments on whether to simulate any known profile.
-
-VHF Simple - narrow frequency band of high energy in VHF.
-VHF Tactical - frequency hopping sim. high energy is randomly applied to freqs across tactical spectrum.
-UHF Simple - narrow frequency band of high energy in UHF.
-UHF Tactical - frequency hopping sim. high energy is randomly applied to freqs across tactical spectrum.
-UHF Wideband Satcom - Low signature, four stable 'bands' of higher energy each spanning 10 MHz at random intervals.
-####################################################################################################
-Typical values are used for hardware.
-Bandwidth: 2000000
-
-
-####################################################################################################
-From keyFunctions.py:
-    This module contains helper functions for making calls to the backend
-    rtl_power_fftw, which is much faster then rtl_power. The output data is
-    output to a binary file which is encoded with C, so the importing and post
-    processing are a bit more complicated.
-
-    The output file contains a matrix in the following format:
-    f1  f2  f3  ... f4  f5  f6
-    db  db  db      db  db  db
-    db  db  db      db  db  db
-    db  db  db      db  db  db
-
-    where f1 is hzLow and f6 is hzHigh. The step size is (hzHigh-hzLow)/numBins.
-    The time step between the scans is not known until the end.
-    The data can be read in with struct.unpack('f'*n, file(4*n)) where n is the
-    number of bins * the number of hops. This will output a tuple with one line of data, presuming
-    there is data left to read in the file. We multiply by 4 because each reading is represented by a 4 byte value.
-    The number of hops is roundup((hzHigh-HzLow)/actualBandwidth).
-    The number of columns is numHops*numBins
-    The data is written out to the file in full scans at a time.
-    The binary file will have the name 'fileName.bin'. When the scan ends, a
-    metadata file named fileName.met will be written out with miscellaneous info.
-
-    Further help: https://github.com/AD-Vega/rtl-power-fftw/blob/master/README.md
-    https://github.com/AD-Vega/rtl-power-fftw/blob/master/doc/rtl_power_fftw.1.md
-####################################################################################################
+A fake rtl_power_fftw, for benchmarks, CI and working without an SDR plugged in. It takes the same
+command line as the real driver and produces output in the same formats, but the spectrum is made up:
+a noise floor with the driver's per hop roll-off, plus any emitters asked for with --signal.
+
+    python3 SDRSimulator.py -f 30M:50M -b 500 -n 100 -g 100 -q                 #One sweep, text to stdout
+    python3 SDRSimulator.py -f 30M:1.7G -b 500 -e 5m -q -m myscanfilename      #5 minutes, binary matrix
+    python3 SDRSimulator.py -f 30M:1.7G -c --rate 0 -m bench --sweeps 1000     #As fast as it can go
+
+Driver flags understood:
+    -f low:high      frequency range (K/M/G suffixes OK, same parser as the rest of EARS)
+    -b bins          bins per hop
+    -n repeats       FFTs averaged per hop. Only changes how long a realistic sweep takes.
+    -g gain          gain in tenths of dB. Moves the noise floor.
+    -r rate          sample rate, which is the bandwidth of one hop
+    -e duration      keep sweeping for this long (ex. 90s, 5m, 1h). Like -c, but stops on its own.
+    -c               keep sweeping until killed
+    -q               quiet, no progress messages on stderr
+    -m basename      write the binary matrix to basename.bin and the metadata to basename.met instead
+                     of text on stdout
+With neither -c nor -e it does one sweep and exits, like rtl_power_fftw.
+
+Simulator only:
+    --rate N         sweeps per second. 0 is as fast as possible. The default is about what the real
+                     hardware manages for the plan (repeats*bins samples per hop, plus retuning).
+    --sweeps N       stop after N sweeps
+    --signal F:P[:W] an emitter at F with power P dB above the floor, W Hz wide. Can be repeated.
+    --seed N         repeatable noise
+
+Text output (stdout) is what rtl_power_fftw prints: a comment block per hop, then one 'frequency power'
+line per bin and a blank line between hops, which is what processRFScan reads.
+
+Binary output (-m) is what rtl_power_fftw -m writes:
+    The .bin file is a matrix of 4 byte floats, one row per sweep, numHops*numBins columns, written a
+    whole sweep (or a block of sweeps) at a time. Read a row with np.fromfile(f, np.float32, n).
+    The .met file says how to read it:
+    136080 # frequency bins (columns)
+    0 # scans (rows)
+    30000000 # startFreq (Hz)
+    49985714 # endFreq (Hz)
+    14285 # stepFreq (Hz)
+    0.0007 # effective integration time secs
+    4 # avgScanDur (sec)
+    2022-09-22 06:06:35 UTC # firstAcqTimestamp UTC
+    2022-09-22 06:07:35 UTC # lastAcqTimestamp UTC
+The .met file is written when the scan starts (0 rows) and rewritten with the real row count at the end,
+including when the simulator is killed.
+
+Rows are generated as NumPy blocks. With --rate 0 a block is a few MB of sweeps at once, so the
+simulator goes well past what a disk or a pipe can take.
+
+Further help on the real driver: https://github.com/AD-Vega/rtl-power-fftw/blob/master/doc/rtl_power_fftw.1.md
 '''
 import sys
 import datetime
-import io
-import statistics
-import struct
+import signal
 import time
-import random
+import argparse
+import numpy as np
+from ScanPlan import compilePlan, parseFreq, parseDuration, writeMetadata, HOP_BANDWIDTH
+
+#Bytes of sweeps generated at once when not rate limited
+BLOCK_BYTES = 4_000_000
+#Noise floor at gain 100, and the standard deviation of the noise on it
+FLOOR_DB = -60
+NOISE_DB = 1.5
 
 
 def SIM_makeScanCall(fileName="default", hzLow="89000000", hzHigh="90000000", numBins="500", gain="500",  repeats="100", exitTimer="5m"):
@@ -57,121 +75,182 @@ def SIM_makeScanCall(fileName="default", hzLow="89000000", hzHigh="90000000", nu
 
 
 def SIM_calcLineLength(call):
-    import math
-    #Bandwidth is a representative number from hardware testing.
-    BW = 2000000
     #calculates the number of bytes in a line of data from the matrix binary output file for a given call
-    elements = call.split(' ')
-    for index, element in enumerate(elements):
-        if element == '-f':
-            freqRange = elements[index+1].split(':')
-            hzHigh = freqRange[1].strip().upper()
-            hzLow = freqRange[0].strip().upper()
-            if 'G' in hzHigh:
-                hzHigh = str(int(float(hzHigh[0:-1])*1000000000))
-            elif 'M' in hzHigh:
-                hzHigh = str(int(float(hzHigh[0:-1])*1000000))
-            elif 'K' in hzHigh:
-                hzHigh = str(int(float(hzHigh[0:-1])*1000))
-            if 'G' in hzLow:
-                hzLow = str(int(float(hzLow[0:-1])*1000000000))
-            elif 'M' in hzLow:
-                hzLow = str(int(float(hzLow[0:-1])*1000000))
-            elif 'K' in hzLow:
-                hzLow = str(int(float(hzLow[0:-1])*1000))
-        if element == '-b':
-            numBins = int(elements[index+1].strip())
-    print('using freq range '+hzLow + ' to '+hzHigh)
-    hzLow = int(hzLow)
-    hzHigh = int(hzHigh)
-    #Now that we have the freqs in Hz, calculate the number of bytes
-    binaryLineLength = int(math.ceil((hzHigh - hzLow)/BW)*4*numBins)
-    print('Number of bytes in a row is '+str(binaryLineLength))
-    return binaryLineLength, BW
+    args = parseArgs(_driverArgs(call))
+    plan = args.plan
+    print('using freq range {} to {}'.format(plan.low, plan.high))
+    print('Number of bytes in a row is '+str(plan.rowBytes))
+    return plan.rowBytes, plan.hopBandwidth
 
 
 def SIM_startDataPipe(call):
-    #This will start a process that hands off data to a bytestream
-    #Similar to the c drivers that are typically used to communicate with the hardware, this will generate a meta data file then a data file will be periodically written to.
-    print('Entered Sim data pipe startup')
-    print(call)
-    BW = 2000000
-    #process arguments
-    for index, element in enumerate(call):
-        if element == '-f':
-            freqRange = call[index+1].split(':')
-            hzHigh = freqRange[1].strip().upper()
-            hzLow = freqRange[0].strip().upper()
-            if 'G' in hzHigh:
-                hzHigh = str(int(float(hzHigh[0:-1])*1000000000))
-            elif 'M' in hzHigh:
-                hzHigh = str(int(float(hzHigh[0:-1])*1000000))
-            elif 'K' in hzHigh:
-                hzHigh = str(int(float(hzHigh[0:-1])*1000))
-            if 'G' in hzLow:
-                hzLow = str(int(float(hzLow[0:-1])*1000000000))
-            elif 'M' in hzLow:
-                hzLow = str(int(float(hzLow[0:-1])*1000000))
-            elif 'K' in hzLow:
-                hzLow = str(int(float(hzLow[0:-1])*1000))
-        if element == '-b':
-            numBins = int(call[index+1].strip())
-    print('using freq range '+hzLow + ' to '+hzHigh)
-    hzLow = int(hzLow)
-    hzHigh = int(hzHigh)
-    filenameBase = call[-1]
-    #Generate the meta data file
-    '''
-    SAMPLE:
-    136080 # frequency bins (columns)
-    0 # scans (rows)
-    30000000 # startFreq (Hz)
-    49985714 # endFreq (Hz)
-    14285 # stepFreq (Hz)
-    0.0007 # effective integration time secs
-    4 # avgScanDur (sec)
-    2022-09-22 06:06:35 UTC # firstAcqTimestamp UTC
-    2022-09-22 06:07:35 UTC # lastAcqTimestamp UTC
-    '''
-    with open(filenameBase+'.met', 'w') as f:
-        f.write('#########################\n')
-        f.write('SIMULATED DATA\n')
-        f.write(str(numBins) + ' # frequency bins (columns)\n')
-        f.write('0 # scans (rows)\n')
-        f.write(str(hzLow) + ' # startFreq (Hz)\n')
-        f.write(str(hzHigh) + ' # endFreq (Hz)\n')
-        stepSize = (hzHigh - hzLow)/numBins
-        f.write(str(stepSize) + ' # stepFreq (Hz)\n')
-        f.write('0.0007 # effective integration time secs\n')
-        f.write('.5 # avgScanDur (sec)\n')
-        f.write(datetime.datetime.now().strftime(
-            '%Y-%m-%d %H:%M:%S') + ' local # firstAcqTimestamp local')
-
-    #for this case, we are just going to generate noise (a random number for power)
-    #We will write 1000 rows of data for this case.
-    with io.FileIO(filenameBase+'.bin', 'w') as f:
-        #Use a normally distributed, low power distrubution. You shouldn't really see any pattern in this data
-        dist = statistics.NormalDist(-50, 3)
-        for i in range(0, 10000):
-            #Generate a noisy measurement for each freq bin in our range.
-            data = dist.samples(numBins)
-            #Set 1 target freq to have way higher power then others.
-            #tgtHz = 40000000
-            #deltaHz = tgtHz - hzLow
-            #tgtBin = deltaHz/BW
-            #data[int(round(tgtBin, 0))] += 30
-            binData = struct.pack('f'*numBins, *data)
-            f.write(binData)
-            #wait to sim hardware retuning time.
-            time.sleep(random.random()/1000)
-
-    print('Closed the data file, updating meta file')
-    with open(filenameBase+'.met', 'a') as f:
-        f.write(datetime.datetime.now().strftime(
-            '%Y-%m-%d %H:%M:%S') + ' local # lastAcqTimestamp local')
-        f.write('#########################\n')
+    '''Run the simulator for a call made by SIM_makeScanCall (a string or an argv list)'''
+    return runSimulator(parseArgs(_driverArgs(call)))
+
+
+def _driverArgs(call):
+    #Drop 'python3 SDRSimulator.py' (or argv[0]) from the front of a call
+    if isinstance(call, str):
+        call = call.split()
+    call = list(call)
+    while call and not call[0].startswith('-'):
+        call.pop(0)
+    return call
+
+
+def _duration(text):
+    try:
+        return parseDuration(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def parseSignal(text):
+    '''(frequency, power, width) from F:P[:W], ex. 145M:30 or 300M:20:25K'''
+    parts = text.split(':')
+    try:
+        if len(parts) not in (2, 3):
+            raise ValueError
+        return parseFreq(parts[0]), float(parts[1]), parseFreq(parts[2]) if len(parts) == 3 else 0
+    except ValueError:
+        raise argparse.ArgumentTypeError('Signal "{}" should look like freq:power[:width], ex. 145M:30'.format(text)) from None
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Simulated rtl_power_fftw')
+    parser.add_argument('-f', dest='freqRange', required=True, help='Frequency range low:high, ex. 30M:50M')
+    parser.add_argument('-b', dest='bins', type=int, default=512, help='Bins per hop')
+    parser.add_argument('-n', dest='repeats', type=int, default=1, help='FFTs averaged per hop')
+    parser.add_argument('-g', dest='gain', type=float, default=100, help='Gain in tenths of dB')
+    parser.add_argument('-r', dest='sampleRate', type=parseFreq, default=HOP_BANDWIDTH, help='Sample rate (hop bandwidth)')
+    parser.add_argument('-e', dest='duration', type=_duration, default=None, help='Sweep for this long, ex. 5m')
+    parser.add_argument('-c', dest='endless', action='store_true', help='Sweep until killed')
+    parser.add_argument('-q', dest='quiet', action='store_true', help='No progress messages')
+    parser.add_argument('-m', dest='matrix', default=None, help='Write basename.bin and basename.met instead of text')
+    #rtl_power_fftw flags that don't mean anything for simulated data
+    parser.add_argument('-p', dest='ppm', default=None, help='Ignored')
+    parser.add_argument('--rate', type=float, default=None, help='Sweeps per second, 0 for as fast as possible. Default: hardware speed')
+    parser.add_argument('--sweeps', type=int, default=None, help='Stop after this many sweeps')
+    parser.add_argument('--signal', dest='signals', type=parseSignal, action='append', default=[], help='Emitter freq:power[:width]')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+    try:
+        args.plan = compilePlan(args.freqRange, args.bins, args.repeats, args.gain, args.sampleRate)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+class SimulatedSDR():
+    '''Makes up sweeps on a plan's grid. The expected spectrum is worked out once; each sweep is it plus noise.'''
+    def __init__(self, plan, signals=(), seed=None):
+        self.plan = plan
+        self.rng = np.random.default_rng(seed)
+        freqs = plan.grid.freqs
+        #Each hop rolls off a few dB towards its edges, like the real driver's output
+        position = np.arange(plan.nBins) % plan.binsPerHop/max(1, plan.binsPerHop - 1)
+        floor = FLOOR_DB + (plan.gain - 100)/10 - 3*(2*position - 1)**8 + 2*np.sin(freqs/7e6)
+        for freq, power, width in signals:
+            if width > 0:
+                floor = floor + power*np.exp(-.5*((freqs - freq)/(width/2.355))**2)
+            else:
+                floor[plan.grid.indexOf([freq]).clip(0, plan.nBins - 1)] += power
+        self.floor = floor.astype(np.float32)
+
+    def sweeps(self, n):
+        '''(n x nBins) float32 block of sweeps'''
+        block = self.rng.standard_normal((n, self.plan.nBins), dtype=np.float32)
+        block *= NOISE_DB
+        block += self.floor
+        return block
+
+
+def formatText(plan, block, start, end):
+    '''rtl_power_fftw's text output for a block of sweeps'''
+    freqs = plan.grid.freqs.reshape(plan.nHops, plan.binsPerHop)
+    header = '# rtl-power-fftw output (simulated)\n# Acquisition start: {}\n# Acquisition end: {}\n#\n' \
+             '# frequency [Hz] power spectral density [dB/Hz]\n#\n'.format(start, end)
+    lines = '%.2f %.2f\n'*plan.binsPerHop
+    text = []
+    for sweep in block:
+        for hopFreqs, hopPower in zip(freqs, sweep.reshape(plan.nHops, plan.binsPerHop)):
+            text.append(header)
+            #One % for the whole hop is much faster than formatting line by line
+            pairs = np.empty(2*plan.binsPerHop)
+            pairs[0::2] = hopFreqs
+            pairs[1::2] = hopPower
+            text.append(lines % tuple(pairs.tolist()))
+            text.append('\n')
+    return ''.join(text).encode()
+
+
+def runSimulator(args):
+    '''Sweep until the plan, -e, --sweeps or a kill says to stop. Returns the number of sweeps written.'''
+    plan = args.plan
+    sdr = SimulatedSDR(plan, args.signals, args.seed)
+    rate = args.rate if args.rate is not None else 1/plan.sweepTime
+    maxSweeps = args.sweeps
+    if maxSweeps is None and not (args.endless or args.duration):
+        maxSweeps = 1
+    blockSize = max(1, BLOCK_BYTES//plan.rowBytes) if rate <= 0 else 1
+    if args.matrix is None and rate <= 0:
+        #Text is far slower to make than noise, keep blocks small so output streams out
+        blockSize = 1
+
+    def log(msg):
+        if not args.quiet:
+            print(msg, file=sys.stderr)
+
+    #Stop cleanly (and finish the metadata) when killed, like the real driver
+    try:
+        signal.signal(signal.SIGTERM, lambda *unused: sys.exit(0))
+    except ValueError:
+        #Not the main thread, whoever started us handles signals
+        pass
+    log('Simulating {} at {} sweeps/s'.format(plan, 'max' if rate <= 0 else '{:.3g}'.format(rate)))
+    if args.matrix is not None:
+        out = open(args.matrix + '.bin', 'wb')
+        first = datetime.datetime.utcnow()
+        writeMetadata(args.matrix + '.met', plan.grid, 0, first, first, plan.sweepTime, plan.integrationTime, 'SIMULATED DATA')
+    else:
+        out = sys.stdout.buffer
+    startTime = time.monotonic()
+    stopTime = startTime + args.duration if args.duration else None
+    first = datetime.datetime.utcnow()
+    written = 0
+    try:
+        while maxSweeps is None or written < maxSweeps:
+            now = time.monotonic()
+            if stopTime is not None and now >= stopTime:
+                break
+            n = blockSize if maxSweeps is None else min(blockSize, maxSweeps - written)
+            if rate > 0:
+                #Hold each sweep back until the hardware would have finished it
+                due = startTime + (written + n)/rate
+                if stopTime is not None and due > stopTime:
+                    time.sleep(max(0, stopTime - now))
+                    break
+                time.sleep(max(0, due - now))
+            block = sdr.sweeps(n)
+            if args.matrix is not None:
+                out.write(block.tobytes())
+            else:
+                stamp = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')
+                out.write(formatText(plan, block, stamp, stamp))
+            out.flush()
+            written += n
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        elapsed = time.monotonic() - startTime
+        if args.matrix is not None:
+            out.close()
+            writeMetadata(args.matrix + '.met', plan.grid, written, first, datetime.datetime.utcnow(),
+                          elapsed/written if written else plan.sweepTime, plan.integrationTime, 'SIMULATED DATA')
+        log('{} sweeps in {:.2f} s ({:.1f} sweeps/s, {:.1f} MB/s of matrix)'.format(
+            written, elapsed, written/elapsed if elapsed else 0, written*plan.rowBytes/1e6/elapsed if elapsed else 0))
+    return written
 
 
 if __name__ == "__main__":
-    print('started script')
-    SIM_startDataPipe(sys.argv)
+    runSimulator(parseArgs())
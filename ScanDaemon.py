@@ -0,0 +1,274 @@
+'''
+Headless scan daemon. Runs the scan manager without Qt and serves a small socket API, so a display-less
+Pi can scan and the operator's tablet can attach as a thin viewer.
+
+    python ScanDaemon.py --port 5050 --unix /tmp/ears.sock --scan 30M:50M
+
+Clients send one JSON command per line:
+    {"cmd": "start", "range": "88M:100M"}                    -> {"scanID": 0}
+    {"cmd": "stop", "scanID": 0}
+    {"cmd": "subscribe", "scanID": 0, "detections": true}   -> live frames for that scan from now on
+    {"cmd": "unsubscribe", "scanID": 0}
+    {"cmd": "view", "scanID": 0, "low": 88e6, "high": 90e6, "widthPx": 800}
+                                                            -> from now on only what a plot of low..high
+                                                               on widthPx pixels needs (see below)
+    {"cmd": "status"}                                       -> running scans, clients, uptime
+
+The daemon sends back length prefixed messages: 4 byte big endian length, 1 byte kind, then the body.
+    ~kind b'J' - JSON. Replies ({"type": "reply", "ok": ...}), detections ({"type": "detections", ...}:
+                 hoppers and jamming status per sweep) and scan ended notices ({"type": "ended", ...})
+    ~kind b'F' - a spectrum frame in the FrameProtocol format (decode with FrameProtocol.FrameDecoder,
+                 one per scan)
+
+Each sweep is encoded once and the same bytes go to every client watching that scan. Every client has a
+short outgoing queue; when a client falls behind the oldest frame is dropped, so a slow link gets fewer
+frames rather than older ones. Frames are delta encoded, so a new viewer or a dropped frame makes the
+next frame of that scan a keyframe.
+
+A client zoomed in on part of a scan sends the view command, and gets that scan's sweeps cut down to the
+view (PlotDecimator.reduceForView: the bins in view, or their per-pixel min/max, and a min/max overview of
+the rest) as sparse frames from an encoder of its own, instead of the whole sweep. low or high null is the
+edge of the scan, and widthPx null goes back to whole sweeps.
+
+The API has no authentication. It listens on localhost unless --host says otherwise.
+'''
+
+import asyncio
+import json
+import signal
+import struct
+import threading
+import time
+import numpy as np
+from ScanManager import ScanManager
+from ScanPlan import parseRange
+from FrameProtocol import FrameEncoder
+from PlotDecimator import reduceForView
+
+def packMessage(kind, body):
+    return struct.pack('>IB', len(body), ord(kind)) + body
+
+def _jsonDefault(obj):
+    #numpy scalars and arrays from the detectors
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+def packJSON(msg):
+    return packMessage('J', json.dumps(msg, default=_jsonDefault).encode())
+
+
+class _Client():
+    '''One connection. Outgoing messages go through a short queue which drops its oldest entry when full.'''
+    def __init__(self, writer, maxQueue):
+        self.writer = writer
+        self.queue = asyncio.Queue(maxQueue)
+        self.detections = set()
+        #scanID: (low, high, widthPx, encoder) of the scans this client has a view on
+        self.views = {}
+
+    def send(self, message):
+        '''Returns True if an older message had to be dropped to make room.'''
+        dropped = self.queue.full()
+        if dropped:
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+        return dropped
+
+    async def run(self):
+        while True:
+            message = await self.queue.get()
+            self.writer.write(message)
+            await self.writer.drain()
+
+
+class ScanDaemon():
+    def __init__(self, DB_Name="EARS_DB.h5", frameOptions=None, clientQueue=4):
+        '''frameOptions are passed to FrameEncoder (bits, resolution, delta, compression...)'''
+        self.DB_Name = DB_Name
+        self.frameOptions = frameOptions or {}
+        self.clientQueue = clientQueue
+        self.scanManager = None
+        self.scans = {}
+        self.nextScanID = 0
+        self.clients = set()
+        self.startTime = time.time()
+
+    async def serve(self, host='127.0.0.1', port=5050, unixPath=None, autostart=()):
+        '''Run until stop() is called (or SIGINT/SIGTERM).'''
+        self.loop = asyncio.get_running_loop()
+        self.stopEvent = asyncio.Event()
+        self.scanManager = ScanManager(self.DB_Name)
+        servers = []
+        if port is not None:
+            servers.append(await asyncio.start_server(self.handleClient, host, port))
+        if unixPath is not None:
+            servers.append(await asyncio.start_unix_server(self.handleClient, unixPath))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stopEvent.set)
+            except (NotImplementedError, RuntimeError):
+                #Not on the main thread, or not a unix system
+                pass
+        for cmdFreq in autostart:
+            self.startScan(cmdFreq)
+        print('Scan daemon listening')
+        await self.stopEvent.wait()
+        print('Scan daemon stopping...')
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        for client in list(self.clients):
+            client.writer.close()
+        await self.loop.run_in_executor(None, self.scanManager.shutdown)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopEvent.set)
+
+    def startScan(self, cmdFreq):
+        #Raises ValueError for a range that makes no sense, before the manager is asked for anything
+        parseRange(cmdFreq)
+        scanID = self.nextScanID
+        self.nextScanID += 1
+        subscription = self.scanManager.subscribe(cmdFreq)
+        self.scans[scanID] = {'range': cmdFreq, 'subscription': subscription, 'clients': set(),
+                              'sweeps': 0, 'started': time.time(), 'encoder': FrameEncoder(**self.frameOptions)}
+        #Manager queues block, so each scan gets a thread handing its sweeps over to the event loop
+        threading.Thread(target=self._bridge, args=(scanID, subscription), daemon=True).start()
+        return scanID
+
+    def stopScan(self, scanID):
+        #The bridge thread cleans up once the manager confirms with 'Done'
+        self.scans[scanID]['subscription'].unsubscribe()
+
+    def _bridge(self, scanID, subscription):
+        while True:
+            payload = subscription.queue.get()
+            if isinstance(payload, str):
+                break
+            self.loop.call_soon_threadsafe(self._dispatch, scanID, payload)
+        self.loop.call_soon_threadsafe(self._scanEnded, scanID)
+
+    def _dispatch(self, scanID, payload):
+        scan = self.scans.get(scanID)
+        if scan is None:
+            return
+        scan['sweeps'] += 1
+        if not scan['clients']:
+            return
+        df, maxDF, baseline, extras = payload
+        freqs, power = df['frequency'].values, df['power'].values
+        frame = None
+        detections = None
+        for client in scan['clients']:
+            view = client.views.get(scanID)
+            if view is not None:
+                low, high, widthPx, encoder = view
+                if np.any(freqs[1:] < freqs[:-1]):
+                    order = np.argsort(freqs, kind='stable')
+                    freqs, power = freqs[order], power[order]
+                viewFreqs, viewPower = reduceForView(freqs, power, low, high, widthPx)
+                client.send(packMessage('F', encoder.encodeSparse(freqs, np.searchsorted(freqs, viewFreqs), viewPower)))
+            else:
+                if frame is None:
+                    frame = packMessage('F', scan['encoder'].encode(freqs, power))
+                if client.send(frame):
+                    #That client lost a frame and can't follow the deltas any more
+                    scan['encoder'].forceKeyframe()
+            if scanID in client.detections:
+                if detections is None:
+                    #The recent hop history is only for drawing, leave it out to save bandwidth
+                    hoppers = [{k: v for k, v in hopper.items() if k != 'recent'} for hopper in extras.get('hoppers', [])]
+                    detections = packJSON({'type': 'detections', 'scanID': scanID, 'seq': scan['sweeps'],
+                                           'hoppers': hoppers, 'jamming': extras.get('jamming')})
+                client.send(detections)
+
+    def _scanEnded(self, scanID):
+        scan = self.scans.pop(scanID, None)
+        if scan is None:
+            return
+        for client in scan['clients']:
+            client.send(packJSON({'type': 'ended', 'scanID': scanID}))
+
+    def status(self):
+        return {'uptime': time.time() - self.startTime, 'clients': len(self.clients),
+                'scans': [{'scanID': scanID, 'range': scan['range'], 'sweeps': scan['sweeps'],
+                           'viewers': len(scan['clients']), 'running': time.time() - scan['started']}
+                          for scanID, scan in self.scans.items()]}
+
+    def handleCommand(self, client, msg):
+        cmd = msg.get('cmd')
+        if cmd == 'status':
+            return self.status()
+        if cmd == 'start':
+            return {'scanID': self.startScan(msg['range'])}
+        scanID = msg.get('scanID')
+        if scanID not in self.scans:
+            raise ValueError('No scan with ID {}'.format(scanID))
+        if cmd == 'stop':
+            self.stopScan(scanID)
+        elif cmd == 'subscribe':
+            self.scans[scanID]['clients'].add(client)
+            self.scans[scanID]['encoder'].forceKeyframe()
+            if msg.get('detections'):
+                client.detections.add(scanID)
+        elif cmd == 'unsubscribe':
+            self.scans[scanID]['clients'].discard(client)
+            client.detections.discard(scanID)
+            client.views.pop(scanID, None)
+        elif cmd == 'view':
+            widthPx = msg.get('widthPx')
+            if widthPx is None:
+                client.views.pop(scanID, None)
+                #Back on the shared frames, which it has to pick up from a keyframe
+                self.scans[scanID]['encoder'].forceKeyframe()
+            else:
+                low, high = msg.get('low'), msg.get('high')
+                low, high = (None if low is None else float(low)), (None if high is None else float(high))
+                if int(widthPx) < 1 or (low is not None and high is not None and high <= low):
+                    raise ValueError('View needs widthPx of at least 1 and high above low')
+                client.views[scanID] = (low, high, int(widthPx), FrameEncoder(**self.frameOptions))
+        else:
+            raise ValueError('Unknown command {}'.format(cmd))
+        return {}
+
+    async def handleClient(self, reader, writer):
+        client = _Client(writer, self.clientQueue)
+        self.clients.add(client)
+        sender = asyncio.ensure_future(client.run())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                    reply = {'type': 'reply', 'cmd': msg.get('cmd'), 'ok': True}
+                    reply.update(self.handleCommand(client, msg))
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    reply = {'type': 'reply', 'ok': False, 'error': str(e)}
+                client.send(packJSON(reply))
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
+            for scan in self.scans.values():
+                scan['clients'].discard(client)
+            sender.cancel()
+            writer.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    from multiprocessing import set_start_method
+    #Same as the GUIs - pytables deadlocks with forked processes
+    set_start_method("spawn")
+    parser = argparse.ArgumentParser(description='Headless EARS scan daemon')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. 0.0.0.0 for remote viewers.')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--unix', default=None, help='Also listen on this unix socket path')
+    parser.add_argument('--scan', action='append', default=[], help='Start scanning this range right away, ex. 30M:50M')
+    parser.add_argument('--db', default='EARS_DB.h5')
+    args = parser.parse_args()
+    daemon = ScanDaemon(args.db)
+    asyncio.get_event_loop().run_until_complete(daemon.serve(args.host, args.port, args.unix, args.scan))
@@ -0,0 +1,218 @@
+'''
+Scan session manager. One process owns the SDR and every scan view subscribes to it, instead of each
+view running its own rtl_power_fftw and fighting over the device.
+
+    ~Views subscribe with a frequency range and get back a ScanSubscription, which holds the queue
+     their sweeps arrive on. The subscription can be passed to another process (ex. a scan window).
+    ~Overlapping subscribed ranges are merged into one sweep plan (mergeRanges), so two viewers of
+     overlapping bands cost one sweep. Ranges that don't overlap are swept one after the other.
+    ~Each sweep is logged to the database once, then cut up and fanned out to every subscriber whose
+     range it covers. Each subscriber has its own ScanProcessor, so max hold, hopper tracking and
+     jamming detection are per view, the same as with streamScan.
+    ~A view that is zoomed in says so with subscription.setView(), and only gets what it shows.
+    ~A view that falls behind has sweeps dropped rather than holding up the others.
+
+Typical use (in the GUI process):
+    scanManager = ScanManager()
+    subscription = scanManager.subscribe('225M:400M')
+    Process(target=startScanWindow, args=('225M:400M', False, None, subscription)).start()
+    ...
+    subscription.unsubscribe()  #Done by the scan window when it closes
+    scanManager.shutdown()
+'''
+
+import asyncio
+import datetime
+import threading
+import numpy as np
+from itertools import count
+from multiprocessing import Process, Queue, Manager
+from queue import Full, Empty
+from BinarySpectroViewer import ScanProcessor
+from ScanPlan import parseRange, mergeRanges
+from Calibration import runSweepAsync
+
+class ScanSubscription():
+    '''A view's handle on the scan manager. Picklable, so it can be handed to the view's own process.'''
+    def __init__(self, subID, cmdFreq, queue, requests):
+        self.subID = subID
+        self.cmdFreq = cmdFreq
+        self.queue = queue
+        self.requests = requests
+
+    def setView(self, low=None, high=None, widthPx=1000):
+        '''Tell the manager what the view is showing, so it only sends that (ScanProcessor.setView)'''
+        self.requests.put(('view', self.subID, low, high, widthPx))
+
+    def unsubscribe(self):
+        '''Stop receiving sweeps. The manager puts 'Done' on the queue once it has let go.'''
+        self.requests.put(('unsubscribe', self.subID))
+
+
+class ScanManager():
+    '''Started once in the GUI process. Owns the manager process and hands out subscriptions.'''
+    def __init__(self, DB_Name="EARS_DB.h5", gain=100, repeats=100):
+        #Manager queues can be passed between processes after they're created, plain ones can't
+        self.manager = Manager()
+        self.requests = self.manager.Queue()
+        self.ids = count()
+        self.process = Process(target=scanManagerLoop, args=(self.requests, DB_Name, gain, repeats))
+        self.process.start()
+
+    def subscribe(self, cmdFreq, maxQueue=25):
+        subID = next(self.ids)
+        queue = self.manager.Queue(maxQueue)
+        self.requests.put(('subscribe', subID, cmdFreq, queue))
+        return ScanSubscription(subID, cmdFreq, queue, self.requests)
+
+    def shutdown(self, timeout=60):
+        self.requests.put(('shutdown', ))
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.manager.shutdown()
+
+
+def scanManagerLoop(requests, DB_Name="EARS_DB.h5", gain=100, repeats=100):
+    '''
+    The manager process. Handles subscription requests as they come in, and sweeps the merged plan
+    for as long as anyone is subscribed.
+    '''
+    asyncio.run(_scanManagerLoop(requests, DB_Name, gain, repeats))
+
+async def _scanManagerLoop(requests, DB_Name, gain, repeats):
+    '''
+    Event driven: a thread blocked on the requests queue hands each request to the event loop, and the
+    sweep runs as an asyncio subprocess. With nobody subscribed the process just sleeps. A sweep nobody
+    wants any more (last viewer of that segment left, or shutdown) is cancelled, which kills the driver.
+    '''
+    from DBManager import DB_Logger
+    loop = asyncio.get_event_loop()
+    subscribers = {}
+    plan = []
+    state = {'running': True, 'changed': False}
+    wake = asyncio.Event()
+    logQueue = Queue(25)
+    #One logger for every view, so the database only has one writer
+    logger = Process(target=DB_Logger, args=(logQueue, DB_Name))
+    logger.start()
+
+    def handle(msg):
+        if msg[0] == 'subscribe':
+            subID, cmdFreq, queue = msg[1:]
+            try:
+                lowF, highF = parseRange(cmdFreq)
+            except ValueError:
+                print('Could not understand scan range {}'.format(cmdFreq))
+                _sendDone(queue)
+                return
+            print('Scan manager: subscriber {} on {}'.format(subID, cmdFreq))
+            subscribers[subID] = {'low': lowF, 'high': highF, 'queue': queue,
+                                  'processor': ScanProcessor(lowF, highF)}
+            state['changed'] = True
+        elif msg[0] == 'view':
+            sub = subscribers.get(msg[1])
+            if sub is not None:
+                sub['processor'].setView(*msg[2:])
+            return
+        elif msg[0] == 'unsubscribe':
+            sub = subscribers.pop(msg[1], None)
+            if sub is not None:
+                _sendDone(sub['queue'])
+            state['changed'] = True
+        elif msg[0] == 'shutdown':
+            state['running'] = False
+        wake.set()
+
+    def readRequests():
+        while True:
+            msg = requests.get()
+            loop.call_soon_threadsafe(handle, msg)
+            if msg[0] == 'shutdown':
+                return
+    threading.Thread(target=readRequests, daemon=True).start()
+
+    def wanted(lowF, highF):
+        return state['running'] and any(sub['low'] <= highF and sub['high'] >= lowF for sub in subscribers.values())
+
+    async def waitForWake(timeout=None):
+        try:
+            await asyncio.wait_for(wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+    while state['running']:
+        if not subscribers:
+            #Nothing to sweep - sleep until a request comes in
+            await waitForWake()
+            continue
+        if state['changed']:
+            state['changed'] = False
+            plan = mergeRanges([(sub['low'], sub['high']) for sub in subscribers.values()])
+            print('Scan manager: sweep plan {}'.format(plan))
+
+        for lowF, highF in plan:
+            if state['changed'] or not state['running']:
+                break
+            sweep = asyncio.ensure_future(runSweepAsync(lowF, highF, repeats=repeats, gain=gain))
+            while not sweep.done():
+                waiter = asyncio.ensure_future(wake.wait())
+                await asyncio.wait((sweep, waiter), return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                wake.clear()
+                if not sweep.done() and not wanted(lowF, highF):
+                    sweep.cancel()
+            if sweep.cancelled():
+                continue
+            result = sweep.result()
+            if isinstance(result, str):
+                #Most likely the SDR isn't plugged in. Don't spin on it, but do wake up for requests.
+                print(result)
+                await waitForWake(1)
+                continue
+            freqs, power = result
+            curTime = datetime.datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
+            #The log queue can block for a moment if the logger is busy; keep that off the event loop
+            loop.run_in_executor(None, _passToLogger, logQueue, (curTime, list(zip(freqs, power)), False, 'measurement'))
+            sweepData = np.column_stack((freqs, power))
+            for sub in subscribers.values():
+                if sub['high'] < lowF or sub['low'] > highF:
+                    continue
+                inRange = (freqs >= sub['low']) & (freqs <= sub['high'])
+                if not inRange.any():
+                    continue
+                payload = sub['processor'].process(sweepData[inRange])
+                try:
+                    sub['queue'].put_nowait(payload)
+                except Full:
+                    Warning('Software bus overflow: Dropping measurement data')
+
+    #Let everyone still subscribed know we're done, then close the logger
+    for sub in subscribers.values():
+        _sendDone(sub['queue'])
+    print('Closing logger...')
+    logQueue.put('Quit')
+    logger.join()
+
+def _sendDone(queue):
+    '''
+    Put 'Done' on a subscriber's queue without ever blocking the loop. A subscriber leaving may not have
+    read its queue in a while, so what's left on it is thrown away first; if it's still full (or gone),
+    the subscriber isn't listening anyway.
+    '''
+    try:
+        while True:
+            queue.get_nowait()
+    except (Empty, EOFError, OSError):
+        pass
+    try:
+        queue.put_nowait('Done')
+    except (Full, EOFError, OSError):
+        pass
+
+def _passToLogger(logQueue, pkt):
+    try:
+        logQueue.put(pkt, timeout=5)
+    except Full:
+        Warning('Log Buffer overflow. Dropping data.')
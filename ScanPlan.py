@@ -0,0 +1,171 @@
+'''
+Frequency range parsing and scan plans, in one place.
+
+Ranges come in as text from the GUI and the command line ('30M:1.7G', '1227590000:1227610000',
+'88.5m:108M') or as (low, high) numbers. parseFreq/parseRange turn them into Hz; suffixes K, M and G
+are case insensitive and can follow decimals.
+
+compilePlan() turns a range plus driver options into a ScanPlan: how the driver will hop across the
+range, the frequency grid a sweep comes back on, how long a sweep takes, how many bytes one sweep takes
+in the driver's binary output (see writeMetadata for its .met file), and the driver command line. Plans are memoized, so the scan loops, the simulator and the
+viewers all share one precomputed geometry instead of each re-parsing the range string every sweep.
+
+    plan = compilePlan('30M:1.7G', bins=500, repeats=100)
+    plan.args        #['rtl_power_fftw', '-f', '30000000:1700000000', ...]
+    plan.nHops, plan.grid.count, plan.rowBytes
+'''
+
+import os
+import shlex
+from functools import lru_cache
+from FrequencyGrid import FrequencyGrid, registerGrid
+
+SUFFIXES = {'K': 1_000, 'M': 1_000_000, 'G': 1_000_000_000}
+#Bandwidth covered by one hop of rtl_power_fftw. A representative number from hardware testing.
+HOP_BANDWIDTH = 2_400_000
+#Seconds to retune between hops, from hardware testing
+RETUNE_TIME = .005
+#Driver gain (-g) for scans and baselines unless told otherwise
+DEFAULT_GAIN = 100
+#What the RTL-SDR can tune to. Outside this the driver errors out.
+TUNING_RANGE = (24_000_000, 1_766_000_000)
+#The driver command. Set EARS_DRIVER to run without hardware, ex. EARS_DRIVER="python3 SDRSimulator.py --rate 0"
+DRIVER = os.environ.get('EARS_DRIVER', 'rtl_power_fftw')
+
+@lru_cache(maxsize=256)
+def _parseFreqText(text):
+    text = text.strip().replace('_', '').upper()
+    multiplier = SUFFIXES.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    try:
+        return int(round(float(text)*multiplier))
+    except ValueError:
+        raise ValueError('Could not understand frequency "{}". Use Hz, or a number ending in K, M or G (ex. 1.2M)'.format(text)) from None
+
+def parseFreq(value):
+    '''Frequency in Hz from a number or text like '1.2M', '433.92m' or '1227590000' '''
+    if isinstance(value, (int, float)):
+        return int(round(value))
+    if isinstance(value, bytes):
+        value = value.decode()
+    return _parseFreqText(str(value))
+
+def parseRange(freqRange):
+    '''(low, high) in Hz from 'low:high' text or a (low, high) pair. Raises ValueError if it makes no sense.'''
+    if isinstance(freqRange, bytes):
+        freqRange = freqRange.decode()
+    if isinstance(freqRange, str):
+        parts = freqRange.split(':')
+        if len(parts) != 2:
+            raise ValueError('Frequency range "{}" should look like low:high, ex. 30M:88M'.format(freqRange))
+    else:
+        parts = freqRange
+    low, high = (parseFreq(part) for part in parts)
+    if low <= 0 or high <= low:
+        raise ValueError('Frequency range {}:{} Hz is empty or backwards'.format(low, high))
+    return low, high
+
+def parseDuration(value):
+    '''Seconds from a number or rtl_power style text: 30, 30s, 5m, 2h, 1d'''
+    if isinstance(value, (int, float)):
+        return float(value)
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    text = str(value).strip().lower()
+    try:
+        if text[-1:] in units:
+            return float(text[:-1])*units[text[-1]]
+        return float(text)
+    except ValueError:
+        raise ValueError('Could not understand duration "{}". Use ex. 90s, 5m or 1h'.format(text)) from None
+
+def mergeRanges(ranges, gap=0):
+    '''
+    Merge (low, high) ranges which overlap, or are less than gap Hz apart, into one sweep plan.
+    Returns a sorted list of (low, high).
+    '''
+    plan = []
+    for low, high in sorted(ranges):
+        if plan and low <= plan[-1][1] + gap:
+            plan[-1] = (plan[-1][0], max(plan[-1][1], high))
+        else:
+            plan.append((low, high))
+    return plan
+
+
+class ScanPlan():
+    '''
+    Geometry of one scan: the driver sweeps [low, high] in nHops hops of binsPerHop bins each, repeating
+    each hop `repeats` times at the given gain. Build these with compilePlan().
+    '''
+    def __init__(self, low, high, bins, repeats, gain, hopBandwidth, driver):
+        self.low = low
+        self.high = high
+        self.binsPerHop = bins
+        self.repeats = repeats
+        self.gain = gain
+        self.hopBandwidth = hopBandwidth
+        self.nHops = max(1, -(-(high - low)//hopBandwidth))
+        self.nBins = self.nHops*bins
+        #The grid a sweep is expected on (what the simulators produce; gridFor() fits the real one)
+        self.grid = registerGrid(FrequencyGrid(low, (high - low)/(self.nBins - 1) if self.nBins > 1 else 0.0, self.nBins))
+        #One sweep in rtl_power_fftw's binary matrix output, 4 byte floats
+        self.rowBytes = 4*self.nBins
+        self.args = tuple(shlex.split(driver)) + ('-f', '{}:{}'.format(low, high), '-b', str(bins), '-n', str(repeats), '-g', str(gain), '-q')
+        self.inTuningRange = TUNING_RANGE[0] <= low and high <= TUNING_RANGE[1]
+
+    @property
+    def integrationTime(self):
+        '''Seconds of samples averaged for each hop'''
+        return self.repeats*self.binsPerHop/self.hopBandwidth
+
+    @property
+    def sweepTime(self):
+        '''About how long the hardware takes for one sweep: the samples for every hop, plus retuning'''
+        return self.nHops*(self.integrationTime + RETUNE_TIME)
+
+    @property
+    def commandLine(self):
+        return ' '.join(self.args)
+
+    @property
+    def freqRange(self):
+        '''The range in the 'low:high' form the rest of EARS passes around'''
+        return '{}:{}'.format(self.low, self.high)
+
+    def __repr__(self):
+        return 'ScanPlan({}, {} hops x {} bins, {} bytes/row)'.format(self.freqRange, self.nHops, self.binsPerHop, self.rowBytes)
+
+
+def compilePlan(freqRange, bins=500, repeats=100, gain=DEFAULT_GAIN, hopBandwidth=HOP_BANDWIDTH, driver=None):
+    '''
+    Validated, memoized ScanPlan for a range ('30M:1.7G' or (low, high)) and driver options. The same
+    arguments always give back the same plan object. driver defaults to DRIVER.
+    '''
+    if bins <= 0 or repeats <= 0:
+        raise ValueError('Need at least one bin and one repeat per hop')
+    low, high = parseRange(freqRange)
+    return _compilePlan(low, high, int(bins), int(repeats), gain, int(hopBandwidth), driver or DRIVER)
+
+@lru_cache(maxsize=128)
+def _compilePlan(low, high, bins, repeats, gain, hopBandwidth, driver):
+    return ScanPlan(low, high, bins, repeats, gain, hopBandwidth, driver)
+
+
+def writeMetadata(fileName, grid, scans, first, last, sweepTime, integrationTime=0, note=None):
+    '''
+    The .met file rtl_power_fftw -m writes next to its binary matrix, which says how to read the matrix.
+    first and last are datetimes in UTC.
+    '''
+    with open(fileName, 'w') as f:
+        f.write('{} # frequency bins (columns)\n'.format(grid.count))
+        f.write('{} # scans (rows)\n'.format(scans))
+        f.write('{:.0f} # startFreq (Hz)\n'.format(grid.start))
+        f.write('{:.0f} # endFreq (Hz)\n'.format(grid.stop))
+        f.write('{:.0f} # stepFreq (Hz)\n'.format(grid.step))
+        f.write('{:.6g} # effective integration time secs\n'.format(integrationTime))
+        f.write('{:.6g} # avgScanDur (sec)\n'.format(sweepTime))
+        f.write(first.strftime('%Y-%m-%d %H:%M:%S') + ' UTC # firstAcqTimestamp UTC\n')
+        f.write(last.strftime('%Y-%m-%d %H:%M:%S') + ' UTC # lastAcqTimestamp UTC\n')
+        if note:
+            f.write(note + '\n')
@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import pdb
+from RtlPowerImport import iterRtlPowerSweeps
+from FrequencyGrid import resample
 
 #Baseline data - 220221_090207_VHF_scan.csv
 #Last measurement - 220221_090645_VHF_scan.csv
@@ -21,38 +23,31 @@ hz MIN and hz MAX we have to look at multiple lines.
 To work with this data easily, we will want to rectangularize it - that is, we would really like this:
 
 date, time, hz min, hz 1, hz 2 .... hz max 
+
+RtlPowerImport does that, and can put old captures in the EARS database (python RtlPowerImport.py Data/).
 '''
 
 plt.ion()
 plt.style.use('dark_background')
 
-def getFreqVsPower(data):
-    #Make our baseline plot
-    minFreqList = data['HzLow'].unique()
-    maxData = data.groupby('HzLow').max() #This is a dataframe with the max of every column against each sweep
-    deltaFreq = data['HzStep'][0]
-    snap = []
-    for minFreq in minFreqList:
-        freqData = maxData.query('index == @minFreq')
-        freqList = [n*deltaFreq + minFreq for n in range(129)]
-        i = 0
-        for f in freqList:
-            #Use format (freq, power)
-            pow = float(freqData['power'+str(i)])
-            #Data format is frequency in MHz and power in dBm
-            snap.append((f/1000000, pow))
-            i += 1
-
-    SnapDF = pd.DataFrame(snap, columns=['frequency', 'power'])
-    return SnapDF
+def getFreqVsPower(fileName):
+    #Max hold over every sweep in the file, as (frequency in MHz, power in dBm)
+    #The file is read a chunk at a time and put together into sweeps by RtlPowerImport
+    maxGrid, maxPower = None, None
+    for grid, times, power in iterRtlPowerSweeps(fileName):
+        if maxGrid is None or grid.count > maxGrid.count:
+            #Keep the widest sweep's grid if the range changed part way through
+            newMax = power.max(axis=0)
+            if maxGrid is not None:
+                newMax = np.fmax(newMax, resample(maxPower, maxGrid, grid, 'nearest'))
+            maxGrid, maxPower = grid, newMax
+        else:
+            maxPower = np.fmax(maxPower, resample(power, grid, maxGrid, 'nearest').max(axis=0))
+    return pd.DataFrame({'frequency': maxGrid.freqs/1000000, 'power': maxPower})
 
-powCols = ['power'+str(i) for i in range(129)]
-baselineData = pd.read_csv('Data//220221_090207_VHF_scan.csv', index_col=False\
-    , names=['date', 'time', 'HzLow', 'HzHigh', 'HzStep', 'samples']+powCols)
-currentData = pd.read_csv('Data//220221_090645_VHF_scan.csv', index_col=False\
-    , names=['date', 'time', 'HzLow', 'HzHigh', 'HzStep', 'samples']+powCols)
-prevData = pd.read_csv('Data//220221_091804_VHF_scan.csv', index_col=False\
-    , names=['date', 'time', 'HzLow', 'HzHigh', 'HzStep', 'samples']+powCols)
+baselineData = 'Data//220221_090207_VHF_scan.csv'
+currentData = 'Data//220221_090645_VHF_scan.csv'
+prevData = 'Data//220221_091804_VHF_scan.csv'
 
 fig, ax = plt.subplots()
 
@@ -0,0 +1,279 @@
+'''
+Multi-resolution (pyramid) copy of a session's spectrum data for fast zoom and pan in history playback.
+
+Level 0 is the raw (sweeps x bins) matrix, which is already in the sweep store (/sweeps, see
+DBManager.appendSweeps) and isn't copied. Every level above it halves both the number of sweeps and
+the number of frequency bins, keeping the max and the mean of each 2x2 block:
+
+    level 0:  N sweeps     x B bins        (read from /sweeps)
+    level 1:  N/2 sweeps   x B/2 bins
+    level 2:  N/4 sweeps   x B/4 bins
+    ...
+
+The mean is taken on the dB values directly. That isn't a true power average, but it's what the rest of
+EARS does with dB data and it's good enough for picking out where to zoom in.
+
+The pyramid is stored next to the measurements in the EARS database under /pyramid/<session>, one
+max and one mean EArray per level from 1 up. A session with sweeps on more than one frequency grid (ex. the scan
+manager sweeping two separate bands) gets one pyramid per grid; the first grid uses the plain session
+node and the others /pyramid/<session>_g<gridID>. It can be built two ways:
+1. Incrementally while logging. DB_Logger feeds every sweep it writes into a PyramidStore.
+2. Offline, for sessions recorded before this existed, with buildSessionPyramid().
+
+To view a window of a session, PyramidView.getView() works out for each axis on its own the coarsest level
+which still has a cell per screen pixel along it, takes the coarser of the two, then reads only that slice.
+That's at most about 2x2 cells per pixel, so the amount of data read depends on the screen size, not the
+session length, and an overnight session zooms just as fast as a five minute one. The price is that a
+narrow band over a long stretch of time comes back with fewer bins than the screen is wide.
+
+Note: a block at level k is only made once all 2^k sweeps in it have arrived, and the logger writes the
+levels a block of sweeps at a time (see PyramidStore), so the newest sweeps of a live session are only at
+level 0 until the session ends or the next block is written.
+'''
+
+import numpy as np
+from tables import *
+from DBManager import iterSessionSweeps, getSessionSweepRanges, readSessionSweeps
+from FrequencyGrid import gridFor
+
+def sessionNodeName(sessionID, gridID=None):
+    '''Pytables node names need to be valid python identifiers, so we can't use the raw UUID.'''
+    if isinstance(sessionID, bytes):
+        sessionID = sessionID.decode()
+    name = 's' + sessionID.replace('-', '_')
+    return name if gridID is None else '{}_g{}'.format(name, gridID)
+
+def halveFrequency(maxRow, meanRow):
+    '''Reduce a pair of rows by 2 along frequency. Odd lengths repeat the last bin.'''
+    if len(maxRow) % 2:
+        maxRow = np.append(maxRow, maxRow[-1])
+        meanRow = np.append(meanRow, meanRow[-1])
+    return maxRow.reshape(-1, 2).max(axis=1), meanRow.reshape(-1, 2).mean(axis=1)
+
+def _axisLevel(n, px, maxLevel):
+    '''Coarsest level which still has at least px cells out of n along one axis'''
+    level = 0
+    while level < maxLevel and (n >> (level + 1)) >= px:
+        level += 1
+    return level
+
+def chooseLevel(nSweeps, nBins, widthPx, heightPx, maxLevel):
+    '''
+    Level to read a window of nSweeps x nBins at. Each axis picks the coarsest level which still has
+    a cell per pixel along it, and the coarser of the two wins, so neither axis reads more than about
+    2 cells per pixel (up to maxLevel). The other axis may then have fewer cells than pixels.
+    '''
+    return max(_axisLevel(nSweeps, heightPx, maxLevel), _axisLevel(nBins, widthPx, maxLevel))
+
+
+class PyramidBuilder():
+    '''
+    Builds the pyramid one sweep at a time. Each level keeps at most one row waiting for its partner,
+    so memory is O(bins) regardless of the number of sweeps.
+    addSweep returns the rows of level 1 and up that became complete as a list of (level, maxRow, meanRow),
+    and level 0 (the sweep itself) as well if keepLevel0 is set.
+    '''
+    def __init__(self, freqs, maxLevels=16, keepLevel0=False):
+        freqs = np.asarray(freqs, dtype=np.float64)
+        self.nBins = len(freqs)
+        self.freqStart = float(freqs[0])
+        self.freqStep = float(np.median(np.diff(freqs))) if len(freqs) > 1 else 0.0
+        self.maxLevels = maxLevels
+        self.keepLevel0 = keepLevel0
+        self.pending = [None]*maxLevels
+        self.nSweeps = 0
+
+    def addSweep(self, power):
+        power = np.asarray(power, dtype=np.float32)
+        if len(power) != self.nBins:
+            raise ValueError('Sweep has {} bins, pyramid expects {}'.format(len(power), self.nBins))
+        self.nSweeps += 1
+        out = [(0, power, power)] if self.keepLevel0 else []
+        maxRow, meanRow = power, power
+        for level in range(self.maxLevels - 1):
+            if self.pending[level] is None:
+                self.pending[level] = (maxRow, meanRow)
+                break
+            prevMax, prevMean = self.pending[level]
+            self.pending[level] = None
+            #Combine in time, then in frequency
+            maxRow, meanRow = halveFrequency(np.maximum(prevMax, maxRow), (prevMean + meanRow)/2)
+            out.append((level + 1, maxRow, meanRow))
+        return out
+
+
+def _powerOf2(n):
+    '''Largest power of 2 <= n, at least 1'''
+    return 1 << max(0, int(n).bit_length() - 1)
+
+class PyramidStore():
+    '''
+    Writes a session's pyramid on one grid into an h5 file. Rows are buffered and appended blockRows
+    sweeps at a time (flush(force=False) after every sweep), since appending a few rows to a compressed
+    EArray rewrites its last, partly filled chunk, and HDF5 doesn't reuse the space of the old copy.
+    blockRows is a power of 2 and each level's chunks are a power of 2 rows that divides what one block
+    adds to that level, so blocks always end on a chunk boundary. Only the last flush of a session
+    (force=True, at the end of it) leaves a partial chunk. blockRows defaults to as many sweeps (up to
+    256) as fit in about 64 MB of buffered rows.
+
+    Level 0 is only stored here with keepLevel0, for sessions which aren't in the sweep store.
+    '''
+    def __init__(self, sessionID, grid, maxLevels=16, blockRows=None, firstGrid=True, keepLevel0=False):
+        #The session's first grid keeps the plain session node name
+        self.node = sessionNodeName(sessionID, None if firstGrid else grid.id)
+        self.sessionID = sessionID.decode() if isinstance(sessionID, bytes) else sessionID
+        self.gridID = grid.id
+        self.builder = PyramidBuilder(grid.freqs, maxLevels, keepLevel0)
+        #Bytes buffered per sweep: max and mean in float32, each a third of a sweep over levels 1 and up
+        perSweep = (8 + 8/3 if keepLevel0 else 8/3)*grid.count
+        self.blockRows = _powerOf2(min(256, 64_000_000//perSweep) if blockRows is None else blockRows)
+        self.buffers = {}
+        self.times = []
+
+    def addSweep(self, power, time=''):
+        for level, maxRow, meanRow in self.builder.addSweep(power):
+            self.buffers.setdefault(level, ([], []))
+            self.buffers[level][0].append(maxRow)
+            self.buffers[level][1].append(meanRow)
+        self.times.append(time)
+
+    def pendingRows(self):
+        return len(self.times)
+
+    def chunkRows(self, level, nBins):
+        '''Rows per chunk at a level: divides what a block adds to it, and at most about 1 MB'''
+        return _powerOf2(min(64, max(1, self.blockRows >> level), max(1, 1_048_576//(4*nBins))))
+
+    def flush(self, h5file, force=True):
+        '''Append buffered rows. If force is False, only flush once a full block has built up.'''
+        group = self._getGroup(h5file)
+        if not force and len(self.times) < self.blockRows:
+            return
+        for level, (maxRows, meanRows) in self.buffers.items():
+            if not maxRows:
+                continue
+            nBins = len(maxRows[0])
+            for name, rows in (('max', maxRows), ('mean', meanRows)):
+                arrName = '{}{}'.format(name, level)
+                if arrName not in group:
+                    h5file.create_earray(group, arrName, Float32Atom(), (0, nBins),
+                                         'Level {} {}'.format(level, name), filters=Filters(complevel=1, complib='zlib'),
+                                         chunkshape=(self.chunkRows(level, nBins), nBins))
+                group._f_get_child(arrName).append(np.vstack(rows))
+            maxRows.clear()
+            meanRows.clear()
+        if self.times:
+            group.times.append(np.array(self.times, dtype='S20'))
+            self.times.clear()
+        group._v_attrs.nSweeps = self.builder.nSweeps
+        group._v_attrs.nLevels = max(self.buffers, default=0) + 1
+
+    def _getGroup(self, h5file):
+        if 'pyramid' not in h5file.root:
+            h5file.create_group('/', 'pyramid', 'Multi-resolution spectrum data')
+        if self.node not in h5file.root.pyramid:
+            group = h5file.create_group(h5file.root.pyramid, self.node, 'Session pyramid')
+            group._v_attrs.sessionID = self.sessionID
+            group._v_attrs.gridID = self.gridID
+            group._v_attrs.freqStart = self.builder.freqStart
+            group._v_attrs.freqStep = self.builder.freqStep
+            group._v_attrs.nBins = self.builder.nBins
+            group._v_attrs.nSweeps = 0
+            group._v_attrs.nLevels = 1
+            h5file.create_earray(group, 'times', StringAtom(20), (0,), 'Sweep time stamps')
+        return h5file.root.pyramid._f_get_child(self.node)
+
+
+def buildSessionPyramid(sessionID, DB_Name="EARS_DB.h5", maxLevels=16):
+    '''
+    Offline pass over a stored session. Reads the session one chunk at a time and writes its pyramid,
+    replacing any pyramid already stored for it. Returns the number of sweeps processed.
+    '''
+    with open_file(DB_Name, mode="a", title="EARS Measurements Record") as h5file:
+        node = sessionNodeName(sessionID)
+        if 'pyramid' in h5file.root:
+            for old in [name for name in h5file.root.pyramid._v_children if name == node or name.startswith(node + '_g')]:
+                h5file.remove_node(h5file.root.pyramid, old, recursive=True)
+        #Sessions only in the row table have no level 0 to read back in the sweep store
+        keepLevel0 = not getSessionSweepRanges(sessionID, DB_Name, h5file)
+        #One pyramid per grid, the first grid under the plain session node
+        stores = {}
+        for times, freqs, power in iterSessionSweeps(sessionID, DB_Name, h5file=h5file):
+            grid, index = gridFor(freqs)
+            if grid.id not in stores:
+                stores[grid.id] = PyramidStore(sessionID, grid, maxLevels, firstGrid=not stores, keepLevel0=keepLevel0)
+            store = stores[grid.id]
+            for time, row in zip(times, power):
+                store.addSweep(grid.place(index, row), time)
+                store.flush(h5file, force=False)
+        for store in stores.values():
+            store.flush(h5file)
+        return sum(store.builder.nSweeps for store in stores.values())
+
+
+def sessionPyramids(sessionID, DB_Name="EARS_DB.h5"):
+    '''gridID argument for PyramidView of each pyramid a session has (None for the first grid's).'''
+    node = sessionNodeName(sessionID)
+    with open_file(DB_Name, mode="r") as h5file:
+        if 'pyramid' not in h5file.root:
+            return []
+        names = sorted(h5file.root.pyramid._v_children)
+    return [None if name == node else int(name[len(node) + 2:]) for name in names if name == node or name.startswith(node + '_g')]
+
+
+class PyramidView():
+    '''
+    Read side of the pyramid, for the history browser.
+
+    view = PyramidView(sessionID)
+    freqs, sweepIndex, data, level = view.getView(0, view.nSweeps, 30e6, 88e6, widthPx=800, heightPx=480)
+    Pass gridID for a session's pyramids on its other grids (see sessionPyramids). Level 0 is read from
+    the sweep store, so it's up to date with a live session.
+    '''
+    def __init__(self, sessionID, DB_Name="EARS_DB.h5", gridID=None):
+        self.sessionID = sessionID
+        self.DB_Name = DB_Name
+        self.h5file = open_file(DB_Name, mode="r", title="EARS Measurements Record")
+        self.group = self.h5file.root.pyramid._f_get_child(sessionNodeName(sessionID, gridID))
+        attrs = self.group._v_attrs
+        self.freqStart = attrs.freqStart
+        self.freqStep = attrs.freqStep
+        self.nBins = attrs.nBins
+        self.nSweeps = attrs.nSweeps
+        self.nLevels = attrs.nLevels
+        #Pyramids from before level 0 was left in the sweep store have their own copy
+        self.gridID = None if 'max0' in self.group else attrs.gridID
+        if self.gridID is not None:
+            self.nSweeps = max(self.nSweeps, sum(stop - start for grid, start, stop
+                                                 in getSessionSweepRanges(sessionID, DB_Name, self.h5file) if grid == self.gridID))
+
+    def close(self):
+        self.h5file.close()
+
+    def levelFreqs(self, level, start=0, stop=None):
+        '''Center frequency of bins [start, stop) at a given level.'''
+        size = 1 << level
+        if stop is None:
+            stop = -(-self.nBins >> level)
+        return self.freqStart + (np.arange(start, stop)*size + (size - 1)/2)*self.freqStep
+
+    def getView(self, sweepStart, sweepStop, freqLow, freqHigh, widthPx, heightPx, stat='max'):
+        '''
+        Returns (freqs, sweepIndex, data, level) for the window. data is (rows x bins) at the chosen
+        level, and sweepIndex holds the first level 0 sweep covered by each row.
+        '''
+        binStart = max(0, int((freqLow - self.freqStart)//self.freqStep)) if self.freqStep else 0
+        binStop = min(self.nBins, int(np.ceil((freqHigh - self.freqStart)/self.freqStep)) + 1) if self.freqStep else self.nBins
+        sweepStart = max(0, sweepStart)
+        sweepStop = min(self.nSweeps, sweepStop)
+        level = chooseLevel(sweepStop - sweepStart, binStop - binStart, widthPx, heightPx, self.nLevels - 1)
+        if level == 0 and self.gridID is not None:
+            times, data = readSessionSweeps(self.sessionID, self.gridID, sweepStart, sweepStop, binStart, binStop,
+                                            self.DB_Name, self.h5file)
+            return self.levelFreqs(0, binStart, binStop), np.arange(sweepStart, sweepStart + len(data)), data, 0
+        arr = self.group._f_get_child('{}{}'.format(stat, level))
+        rowStart, rowStop = sweepStart >> level, min(arr.nrows, -(-sweepStop >> level))
+        colStart, colStop = binStart >> level, min(arr.shape[1], -(-binStop >> level))
+        data = arr[rowStart:rowStop, colStart:colStop]
+        sweepIndex = np.arange(rowStart, rowStop) << level
+        return self.levelFreqs(level, colStart, colStop), sweepIndex, data, level
@@ -0,0 +1,92 @@
+'''
+Startup time of each kind of EARS process, and a check that none of them imports more than it needs.
+
+The GUIs start their scan, calibration and scan window processes with the spawn start method (pytables
+deadlocks after a fork). A spawned process starts a fresh interpreter, imports the GUI script again (as
+__mp_main__, so its __main__ block doesn't run) and then imports the module of its target function. On
+a Pi every heavy import here costs about a second, paid at launch and again by every scan.
+
+So the heavy modules are imported where they're used, and this script keeps an eye on it:
+
+    python StartupTime.py          #Time each role in a fresh interpreter
+    python StartupTime.py -n 5     #Median of 5 runs each
+
+A role FAILs if importing it loads a heavy module it isn't allowed, and the exit code is 1. Roles whose
+modules can't be imported here (ex. no PyQt5 on a dev box) are skipped.
+'''
+
+import json
+import os
+import subprocess
+import sys
+
+HEAVY = ('pandas', 'matplotlib', 'tables', 'PyQt5')
+
+#(role, what it imports, heavy modules it's allowed). Scripts are run the way spawn re-imports them.
+ROLES = [
+    ('python itself', None, ()),
+    ('GUIFramework.py re-import', 'GUIFramework.py', ('PyQt5',)),
+    ('mainGUI.py re-import', 'mainGUI.py', ('PyQt5',)),
+    ('scan process (streamScan)', 'BinarySpectroViewer', ()),
+    ('worker pool (GUI side)', 'WorkerPool', ()),
+    ('calibration process', 'Calibration', ()),
+    ('scan manager process', 'ScanManager', ()),
+    ('database logger (DB_Logger)', 'DBManager', ('tables',)),
+    ('scan window (EARSscan)', 'EARSscan', ('PyQt5', 'matplotlib', 'pandas')),
+]
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+try:
+    target = {target!r}
+    if target is None:
+        pass
+    elif target.endswith('.py'):
+        import runpy
+        runpy.run_path(target, run_name='__mp_main__')
+    else:
+        __import__(target)
+except ImportError as e:
+    print(json.dumps({{'skipped': str(e)}}))
+    sys.exit()
+print(json.dumps({{'seconds': time.perf_counter() - start, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def probe(target):
+    '''Import target in a fresh interpreter. Returns the probe's report, with total wall time added.'''
+    import time
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', PROBE.format(target=target, heavy=HEAVY)], capture_output=True,
+                         text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall = time.perf_counter() - start
+    if out.returncode != 0:
+        return {'skipped': out.stderr.strip().splitlines()[-1] if out.stderr.strip() else 'exit code {}'.format(out.returncode)}
+    report = json.loads(out.stdout.strip().splitlines()[-1])
+    report['wall'] = wall
+    return report
+
+def startupTimes(runs=3):
+    '''Print a table of import and total process start time per role. Returns False if any role failed.'''
+    ok = True
+    print('{:32s} {:>10s} {:>10s}  {}'.format('role', 'import s', 'process s', 'heavy modules'))
+    for role, target, allowed in ROLES:
+        reports = [probe(target) for i in range(runs)]
+        if 'skipped' in reports[0]:
+            print('{:32s} {:>10s} {:>10s}  skipped: {}'.format(role, '-', '-', reports[0]['skipped']))
+            continue
+        seconds = sorted(r['seconds'] for r in reports)[len(reports)//2]
+        wall = sorted(r['wall'] for r in reports)[len(reports)//2]
+        extra = [m for m in reports[0]['heavy'] if m not in allowed]
+        ok &= not extra
+        print('{:32s} {:10.3f} {:10.3f}  {}{}'.format(role, seconds, wall, ', '.join(reports[0]['heavy']) or '-',
+                                                      '   FAIL: should not import ' + ', '.join(extra) if extra else ''))
+    return ok
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Startup time of each kind of EARS process')
+    parser.add_argument('-n', type=int, default=3, help='Runs per role (the median is shown)')
+    args = parser.parse_args()
+    sys.exit(0 if startupTimes(args.n) else 1)
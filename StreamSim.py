@@ -13,7 +13,9 @@ frequencies and power distributions.
 
 import numpy as np
 import random
+from queue import Empty
 from time import sleep
+from ScanPlan import parseRange
 
 class responseObject():
     def __init__(self):
@@ -26,17 +28,29 @@ class responseObject():
         self.stderr = ''
         self.returncode = 0
 
-def convertFreqtoInt(freqStr):
-    '''commanded freqs typically use an easy to read notation with prefixes. 
-    for example, cmdFreq = '30M:35M'
-    This utility converts them into normal ints.
+def streamToQueue(queue, s, period=.33, cmdQueue=None):
     '''
-    lowFreq, highFreq = freqStr.split(':')
-    rep = [('M', '_000_000'), ('G', '_000_000_000'), ('K', '_000')]
-    for p, i in rep:
-        lowFreq = lowFreq.replace(p, i)
-        highFreq = highFreq.replace(p, i)
-    return (int(lowFreq), int(highFreq))
+    Keep handing s out on the queue at around 3 Hz until a 'QUIT' turns up. With a cmdQueue, QUIT is read
+    from there, and the wait between sweeps is spent blocked on it so a QUIT is seen as soon as it's put.
+    Without one QUIT comes on the data queue, so after each period the queue is checked once: a sweep
+    still sitting there wasn't wanted and is dropped, so the queue doesn't grow behind a slow reader.
+    '''
+    while True:
+        queue.put(s)
+        if cmdQueue is not None:
+            try:
+                if cmdQueue.get(timeout=period) == 'QUIT':
+                    return
+            except Empty:
+                pass
+            continue
+        sleep(period)
+        try:
+            curCmd = queue.get_nowait()
+        except Empty:
+            continue
+        if curCmd == 'QUIT':
+            return
 
 def simFrontEnd():
     '''This function deals with taking in the user requested behavior, selecting 
@@ -44,7 +58,7 @@ def simFrontEnd():
     back the string for parsing just like the normal hardware routine does. '''
     pass
 
-def genFixedFreq(queue = None, scannedFreqRange='30M:35M', selectedFreq = 32_000_000, peakPower=0, snr=10):
+def genFixedFreq(queue = None, scannedFreqRange='30M:35M', selectedFreq = 32_000_000, peakPower=0, snr=10, cmdQueue=None):
     '''Generates fixed frequency transmission simulation with power centered on 
     selected frequency. The default behavior is to select a random center frequency
     between 30 and 88MHz
@@ -57,7 +71,7 @@ def genFixedFreq(queue = None, scannedFreqRange='30M:35M', selectedFreq = 32_000
     s = responseObject()
 
     
-    freqLow, freqHigh = convertFreqtoInt(scannedFreqRange)
+    freqLow, freqHigh = parseRange(scannedFreqRange)
 
     # If Frequency not selected give random
     if selectedFreq == 0:
@@ -104,20 +118,13 @@ def genFixedFreq(queue = None, scannedFreqRange='30M:35M', selectedFreq = 32_000
     data = list(zip(freqs, power))
     s.stdout = '\\n'.join([str(x)+' '+str(y) for x,y in data])
    
-    curCmd = None
-
     if queue:
-        while curCmd != 'QUIT':
-            if not queue.empty():
-                curCmd = queue.get()
-            else:
-                queue.put(s)
-                sleep(.33) #running at around 3 hz
+        streamToQueue(queue, s, cmdQueue=cmdQueue)
     else:
         return s
 
 
-def genFreqHopping(queue = None, scannedFreqRange='30M:35M', peakPower=0, snr=10):
+def genFreqHopping(queue = None, scannedFreqRange='30M:35M', peakPower=0, snr=10, cmdQueue=None):
     """
     Generates frequency hopping transmission simulation with power center moving frequency every hopDuration seconds.
     If hopDuration or power is not provided, a random value within the proper parameters is chosen.
@@ -131,7 +138,7 @@ def genFreqHopping(queue = None, scannedFreqRange='30M:35M', peakPower=0, snr=10
     #This is using a hard coded peak power of 0 dB at the Rx, and a channel width of nearly 12.5kHz. 
     s = responseObject()
 
-    freqLow, freqHigh = convertFreqtoInt(scannedFreqRange)
+    freqLow, freqHigh = parseRange(scannedFreqRange)
     selectedFreq = np.random.uniform(freqLow + 50_000 , freqHigh - 50_001)
 
     # If peak power not selected give random
@@ -173,19 +180,12 @@ def genFreqHopping(queue = None, scannedFreqRange='30M:35M', peakPower=0, snr=10
     data = list(zip(freqs, power))
     s.stdout = '\\n'.join([str(x)+' '+str(y) for x,y in data])
    
-    curCmd = None
-
     if queue:
-        while curCmd != 'QUIT':
-            if not queue.empty():
-                curCmd = queue.get()
-            else:
-                queue.put(s)
-                sleep(.33) #running at around 3 hz
+        streamToQueue(queue, s, cmdQueue=cmdQueue)
     else:
         return s
 
-def genWidebandTransmission(queue = None, scannedFreqRange='30M:35M', selectedFreq1 = 31_000_000, selectedFreq2 = 32_000_000, selectedFreq3 = 33_000_000, selectedFreq4 = 34_000_000, peakPower=0, snr=10):
+def genWidebandTransmission(queue = None, scannedFreqRange='30M:35M', selectedFreq1 = 31_000_000, selectedFreq2 = 32_000_000, selectedFreq3 = 33_000_000, selectedFreq4 = 34_000_000, peakPower=0, snr=10, cmdQueue=None):
     '''Generates wideband transmission simulation with 4 channels centered at 
     selected frequencies with selected center power. The default behavior is 
     to select 4 random center frequencies between 300M to 1.7G at randomly selected
@@ -200,7 +200,7 @@ def genWidebandTransmission(queue = None, scannedFreqRange='30M:35M', selectedFr
     #This is using a hard coded peak power of 0 dB at the Rx, and a channel width of nearly 12.5kHz. 
     s = responseObject()
 
-    freqLow, freqHigh = convertFreqtoInt(scannedFreqRange)
+    freqLow, freqHigh = parseRange(scannedFreqRange)
 
     # If Frequency not selected give random for each of the four frequencies
     if selectedFreq1 == 0:
@@ -258,19 +258,12 @@ def genWidebandTransmission(queue = None, scannedFreqRange='30M:35M', selectedFr
     data = list(zip(freqs, power))
     s.stdout = '\\n'.join([str(x)+' '+str(y) for x,y in data])
    
-    curCmd = None
-
     if queue:
-        while curCmd != 'QUIT':
-            if not queue.empty():
-                curCmd = queue.get()
-            else:
-                queue.put(s)
-                sleep(.33) #running at around 3 hz
+        streamToQueue(queue, s, cmdQueue=cmdQueue)
     else:
         return s
 
-def genQuickAndDirtySimForWes(queue = None, scannedFreqRange='30M:35M', txCenterFreq = 32_000_000, peakPower=0):
+def genQuickAndDirtySimForWes(queue = None, scannedFreqRange='30M:35M', txCenterFreq = 32_000_000, peakPower=0, cmdQueue=None):
     '''Wes did this so he would have something to use for mobile testing. 
     It takes the range you are scanning (in hz), the peak power (in dB) and center frequency (in hz) 
     of the modeled signal, and returns the familiar string of frequency, power comma seperated pairs
@@ -281,7 +274,7 @@ def genQuickAndDirtySimForWes(queue = None, scannedFreqRange='30M:35M', txCenter
     s = responseObject()
 
     #Figure out how long the array is. It's max freq - min freq, step size of 200 hz
-    lowF, highF = convertFreqtoInt(scannedFreqRange)
+    lowF, highF = parseRange(scannedFreqRange)
     freqs = np.arange(lowF, highF+200, 200) #This is our x axis, or list of frequencies
     txCenterFreqDiff = np.absolute(freqs - int(txCenterFreq)) #Absolute Difference between center tx freq and all freq values
     txCenterFreqIndex =  txCenterFreqDiff.argmin() #This is the index of frequency at which the center freq of transmission is found
@@ -293,14 +286,7 @@ def genQuickAndDirtySimForWes(queue = None, scannedFreqRange='30M:35M', txCenter
     data = list(zip(freqs, power))
     s.stdout = '\\n'.join([str(x)+' '+str(y) for x,y in data])
    
-    curCmd = None
-
     if queue:
-        while curCmd != 'QUIT':
-            if not queue.empty():
-                curCmd = queue.get()
-            else:
-                queue.put(s)
-                sleep(.33) #running at around 3 hz
+        streamToQueue(queue, s, cmdQueue=cmdQueue)
     else:
         return s
\ No newline at end of file
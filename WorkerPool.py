@@ -0,0 +1,218 @@
+'''
+Scan and logger processes started once with the GUI and reused for every scan.
+
+Started fresh, a scan costs a new streamScan process and a new DB_Logger process, and under spawn each
+of them pays for a whole interpreter plus its imports (see StartupTime.py) before the first sweep is
+even asked for. The pool starts them when the app does, while the user is still picking a band:
+
+    pool = WorkerPool()                      #Once, at startup
+    job = pool.startScan('30M:50M')          #Handed straight to a warm worker
+    payload = job.get()                      #Same payloads as streamScan puts on SWBqueue
+    job.setView(low, high, widthPx)          #Zoomed in, only send what's on screen
+    job.stop()                               #QUIT, and wait for the worker to be free again
+    pool.shutdown()                          #When the app closes
+
+~One logger serves every scan. Each job starts a new session in it, so the database looks the same as
+ if each scan had its own logger.
+~Queues can't be sent through queues, so each worker owns its data and command queues for life. A
+ job only reads them; stop() drains the data queue up to the job's 'Done' so the next job starts clean.
+~A worker which doesn't finish within the stop timeout (a stuck driver) is terminated and replaced.
+'''
+
+from multiprocessing import Process, Queue
+from queue import Empty
+from importlib import import_module
+import datetime
+
+def scanWorker(jobs, dataQueue, cmdQueue, logQueue):
+    '''
+    Body of a pooled scan process. Does its imports up front, then runs one streamScan job at a time,
+    as they come in on jobs, until it gets None.
+    '''
+    #Everything a scan loads, loaded now instead of when the user presses a button
+    for name in ('pandas', 'DBManager', 'StreamSim'):
+        import_module(name)
+    from BinarySpectroViewer import streamScan
+    print('Scan worker ready')
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        jobID, cmdFreq, simFlag, simConfig = job
+        streamScan(cmdFreq, dataQueue, simFlag, simConfig, cmdQueue, logTo=logQueue, jobID=jobID)
+
+
+class _Worker():
+    '''One pooled scan process and the queues it owns'''
+    def __init__(self, logQueue):
+        self.logQueue = logQueue
+        self.process = None
+        self.job = None
+        self.start()
+
+    def start(self):
+        self.jobs = Queue()
+        self.data = Queue(25)
+        self.commands = Queue()
+        self.process = Process(target=scanWorker, args=(self.jobs, self.data, self.commands, self.logQueue), daemon=True)
+        self.process.start()
+
+    def restart(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout=5)
+        for queue in (self.jobs, self.data, self.commands):
+            queue.close()
+        self.start()
+
+    def stop(self, timeout=5):
+        self.jobs.put(None)
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ScanJob():
+    '''
+    A scan running on a pool worker. Read it like the SWBqueue of a streamScan process (empty(), get());
+    'Done' is the last thing it gives. stop() ends it.
+    '''
+    def __init__(self, worker, jobID):
+        self.worker = worker
+        self.jobID = jobID
+        self.finished = False
+
+    def empty(self):
+        return self.finished or self.worker.data.empty()
+
+    def get(self, block=True, timeout=None):
+        payload = self.worker.data.get(block, timeout)
+        if isinstance(payload, str) and payload == 'Done':
+            self._release()
+        return payload
+
+    def setView(self, low=None, high=None, widthPx=1000):
+        '''Tell the scan what the viewer is showing, so it only sends that (ScanProcessor.setView)'''
+        if not self.finished:
+            self.worker.commands.put(('VIEW', self.jobID, low, high, widthPx))
+
+    def _release(self):
+        self.finished = True
+        if self.worker.job is self:
+            self.worker.job = None
+
+    def stop(self, timeout=60):
+        '''
+        Quit the scan (right away, even mid sweep) and wait up to timeout seconds for it to say it's done.
+        Returns False if it didn't, in which case its worker was replaced.
+        '''
+        if self.finished:
+            return True
+        self.worker.commands.put(('QUIT', self.jobID))
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        while not self.finished and datetime.datetime.now() < deadline:
+            try:
+                self.get(timeout=.5)
+            except Empty:
+                if not self.worker.process.is_alive():
+                    break
+        if not self.finished:
+            Warning('Scan job {} did not stop, restarting its worker'.format(self.jobID))
+            self.worker.restart()
+            self._release()
+            return False
+        return True
+
+
+class WorkerPool():
+    '''
+    Pre-started scan workers sharing one pre-started DB_Logger. startScan() hands a scan to an idle
+    worker and returns its ScanJob. Must be created after set_start_method.
+    '''
+    def __init__(self, scanWorkers=1, DB_Name="EARS_DB.h5"):
+        self.DB_Name = DB_Name
+        self.nextJob = 0
+        self._startLogger()
+        self.workers = [_Worker(self.logQueue) for i in range(scanWorkers)]
+
+    def _startLogger(self):
+        from DBManager import DB_Logger
+        self.logQueue = Queue(25)
+        self.logger = Process(target=DB_Logger, args=(self.logQueue, self.DB_Name), daemon=True)
+        self.logger.start()
+
+    def startScan(self, cmdFreq, simFlag=False, simConfig=None):
+        '''Run streamScan(cmdFreq, ...) on an idle worker. Returns its ScanJob.'''
+        if not self.logger.is_alive():
+            #Workers hold the old log queue, so they go too. Only stopped workers reach here.
+            Warning('Logger died, restarting the worker pool')
+            self.shutdown()
+            self._startLogger()
+            self.workers = [_Worker(self.logQueue) for i in range(len(self.workers))]
+        idle = [worker for worker in self.workers if worker.job is None]
+        if not idle:
+            raise RuntimeError('All {} scan workers are busy'.format(len(self.workers)))
+        worker = idle[0]
+        if not worker.process.is_alive():
+            worker.restart()
+        self.nextJob += 1
+        worker.job = ScanJob(worker, self.nextJob)
+        worker.jobs.put((self.nextJob, cmdFreq, simFlag, simConfig))
+        return worker.job
+
+    def shutdown(self, timeout=60):
+        '''Stop any running scans, then the workers and the logger'''
+        for worker in self.workers:
+            if worker.job is not None:
+                worker.job.stop(timeout)
+            worker.stop()
+        self.logQueue.put('Quit')
+        self.logger.join(timeout=30)
+        if self.logger.is_alive():
+            self.logger.terminate()
+
+
+def scanLatency(runs=5, cmdFreq='30M:31M'):
+    '''
+    Seconds from asking for a simulated scan to its first payload, with a fresh streamScan process and
+    with a warm pool worker. Writes to EARS_DB.h5 like a real scan. The simulator makes a bin every
+    100 Hz, so the default range is narrow to keep the sweep itself from swamping the start up time.
+    '''
+    import time
+    from types import SimpleNamespace
+    from BinarySpectroViewer import streamScan
+    #Stands in for GUIFramework.simConfigObj, which needs PyQt5 to import
+    simConfig = SimpleNamespace(scanType='fixedFreq', selectedFreq=0, peakPower=0, snr=20)
+    fresh, pooled = [], []
+    for i in range(runs):
+        start = time.perf_counter()
+        data, commands = Queue(25), Queue()
+        process = Process(target=streamScan, args=(cmdFreq, data, True, simConfig, commands))
+        process.start()
+        data.get()
+        fresh.append(time.perf_counter() - start)
+        commands.put('QUIT')
+        while data.get() != 'Done':
+            pass
+        process.join()
+        #A user doesn't press the next button instantly either
+        time.sleep(1)
+    pool = WorkerPool()
+    #The pool starts with the app, long before the first button press
+    time.sleep(5)
+    for i in range(runs):
+        start = time.perf_counter()
+        job = pool.startScan(cmdFreq, True, simConfig)
+        job.get()
+        pooled.append(time.perf_counter() - start)
+        job.stop()
+        time.sleep(1)
+    pool.shutdown()
+    print('first payload, fresh process: {:.3f} s (median of {})'.format(sorted(fresh)[runs//2], runs))
+    print('first payload, pooled worker: {:.3f} s (median of {})'.format(sorted(pooled)[runs//2], runs))
+
+
+if __name__ == '__main__':
+    from multiprocessing import set_start_method
+    set_start_method("spawn")
+    scanLatency()
@@ -14,11 +14,19 @@ Dev Notes:
 
 import pickle
 from PyQt5.QtWidgets import QMainWindow, QDialog, QDialogButtonBox, QCheckBox, QMessageBox, QPushButton, QScrollArea, QApplication, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QGroupBox, QFileDialog
+from PyQt5.QtCore import QTimer
 import sys
 import os.path
-from BinarySpectroViewer import *
-from multiprocessing import set_start_method
-from EARSscan import *
+from multiprocessing import Process, Queue, set_start_method
+from Calibration import calibrationWorker
+from ScanManager import ScanManager
+#With spawn, every process this window starts imports this module again, so only the light modules are
+#imported up here. The scan window (EARSscan, matplotlib) is only imported by the process that shows it.
+
+def runScanWindow(cmdFreq, simFlag, simConfig, subscription):
+    '''Process target for a scan window. Importing EARSscan here keeps it out of this process.'''
+    from EARSscan import startScanWindow
+    startScanWindow(cmdFreq, simFlag, simConfig, subscription)
 
 class confirmDialog(QDialog):
     def __init__(self, parent=None):
@@ -66,6 +74,8 @@ class MainWindow(QMainWindow):
 
         #General storage space for variables
         self.configData = {'Sim': False}
+        #Owns the SDR for all the scan windows. Started with the first scan.
+        self.scanManager = None
         #Main Layout creation
         self.CentralWindow = QWidget()
         MainLayout = QVBoxLayout()
@@ -139,17 +149,27 @@ class MainWindow(QMainWindow):
         self.setWindowTitle('Tactical Footprint Scanner')
         self.showMaximized()
 
+    def openScanWindow(self, cmdFreq):
+        '''Scan windows get their sweeps from the scan manager, which is started on first use.'''
+        if self.scanManager is None:
+            self.scanManager = ScanManager()
+        scanWindowProcess = Process(target=runScanWindow, args=(cmdFreq, False, None, self.scanManager.subscribe(cmdFreq)))
+        scanWindowProcess.start()
+
+    def closeEvent(self, event):
+        if self.scanManager is not None:
+            self.scanManager.shutdown()
+        event.accept()
+
     def UHFScanMethod(self):
         if not self.configData['Sim']:
             #streamScan('225M:400M')
             '''
-            Sigh..... this starts a brand new process for the scan window, then this window's
-            process blocks until we close the new window. HOWEVER - this doesn't stop the user 
-            from opening multiple windows. That's also fine, but it will make both windows 
-            appear to perform quite poorly as the two compete for use of the SDR.
+            This starts a brand new process for the scan window. The user can open as many
+            as they like; the scan manager owns the SDR and shares its sweeps between them, so
+            they don't compete for it.
             '''
-            scanWindowProcess = Process(target=startScanWindow, args=('225M:400M', ))
-            scanWindowProcess.start()
+            self.openScanWindow('225M:400M')
         else:
             #Sim is not implemented yet
             return
@@ -157,8 +177,7 @@ class MainWindow(QMainWindow):
     def VHFScanMethod(self):
         if not self.configData['Sim']:
             #streamScan('30M:50M')
-            scanWindowProcess = Process(target=startScanWindow, args=('30M:50M', ))
-            scanWindowProcess.start()
+            self.openScanWindow('30M:50M')
         else:
             #Sim is not implemented yet
             return    
@@ -166,8 +185,7 @@ class MainWindow(QMainWindow):
     def FullScanMethod(self):
         if not self.configData['Sim']:
             #streamScan('30M:1.7G')
-            scanWindowProcess = Process(target=startScanWindow, args=('30M:1.7G', ))
-            scanWindowProcess.start()
+            self.openScanWindow('30M:1.7G')
         else:
             #Sim is not implemented yet
             return
@@ -175,8 +193,7 @@ class MainWindow(QMainWindow):
     def GPSScanMethod(self):
         if not self.configData['Sim']:
             #streamScan('1227590000:1227610000')
-            scanWindowProcess = Process(target=startScanWindow, args=('1227590000:1227610000', ))
-            scanWindowProcess.start()
+            self.openScanWindow('1227590000:1227610000')
         else:
             #Sim is not implemented yet
             return
@@ -189,40 +206,56 @@ class MainWindow(QMainWindow):
         will later be used to determine whether anything unexpected is happening
         in the spectrum.
 
-        'rtl_power_fftw -f 30M:1.7G -b 500 -n 500 -g 100 -q'
-        frequency range is from 30 MHz to 1.7 GHz. 
-        Each fft bin is sampled 500 times.
+        The calibration runs in its own process (Calibration.calibrationWorker) one band segment
+        at a time, and each segment is stored as soon as it's measured. checkCalibration polls the
+        progress queue so the window stays responsive while it runs.
         '''
-        #This takes forever, so Popup a message that the cal is starting.
+        if getattr(self, 'calibrationProcess', None) is not None and self.calibrationProcess.is_alive():
+            self.statusBar().showMessage('Calibration already running')
+            return
         print("starting Calibration")
+        self.calibrationQueue = Queue()
+        self.calibrationProcess = Process(target=calibrationWorker, args=(self.calibrationQueue, ), kwargs={'simFlag': self.configData['Sim']})
+        self.calibrationProcess.start()
+        self.statusBar().showMessage('Calibrating')
+        self.calibrationTimer = QTimer()
+        self.calibrationTimer.timeout.connect(self.checkCalibration)
+        #Update interval is set in milliseconds
+        self.calibrationTimer.setInterval(250)
+        self.calibrationTimer.start()
+
+    def checkCalibration(self):
+        '''Show calibration progress and pop up the result when the worker is finished.'''
+        finished = None
+        while not self.calibrationQueue.empty():
+            msg = self.calibrationQueue.get()
+            if msg[0] == 'progress':
+                self.statusBar().showMessage('Calibrating {} ({} of {})'.format(msg[3], msg[1] + 1, msg[2]))
+            elif msg[0] in ('done', 'error'):
+                finished = msg
+        if finished is None and self.calibrationProcess.is_alive():
+            return
+        if finished is None:
+            #The worker died without saying why
+            finished = ('error', 'Calibration process exited with code {}'.format(self.calibrationProcess.exitcode))
+        self.calibrationTimer.stop()
+        self.calibrationProcess.join()
+        self.calibrationProcess = None
         self.msgBox = QMessageBox()
-        self.msgBox.setWindowTitle('Calibrating')
         self.msgBox.setIcon(QMessageBox.Information)
-        self.msgBox.setText("Calibrating system...\nThis typically takes several minutes")
         self.msgBox.setStandardButtons(QMessageBox.Ok)
-        self.statusBar().showMessage('Calibrating')
-        self.msgBox.exec()
-
-        if takeBaselineMeasurement() == 'Error':
-            self.msgBox.close()
-            self.msgBox = QMessageBox()
+        if finished[0] == 'error':
+            print(finished[1])
             self.msgBox.setWindowTitle('Error!')
-            self.msgBox.setIcon(QMessageBox.Information)
             self.msgBox.setText("Failed to Calibrate System\nCheck hardware connections")
-            self.msgBox.setStandardButtons(QMessageBox.Ok)
             self.statusBar().showMessage('Error Calibrating')
-            self.msgBox.exec()
         else:
-            self.msgBox.close()
             #Popup a message that the cal was successful.
             print("succesfully performed Calibration")
-            self.msgBox = QMessageBox()
             self.msgBox.setWindowTitle('Sucess!')
-            self.msgBox.setIcon(QMessageBox.Information)
             self.msgBox.setText("Successfully Calibrated System")
-            self.msgBox.setStandardButtons(QMessageBox.Ok)
             self.statusBar().showMessage('Done Calibrating')
-            self.msgBox.exec()
+        self.msgBox.exec()
 
     def setSimMode(self, checkBox):
         '''
@@ -1,3 +1,4 @@
+#Old capture loop with rtl_power. CaptureScheduler.py runs scheduled captures with rtl_power_fftw now.
 import os
 import schedule
 import time